@@ -0,0 +1,184 @@
+"""
+Offline throughput benchmarks of arcrest2shp against the mock ArcGIS REST server.
+
+Measures the crawl rate (pages/s), the download throughput (features/s, MB/s), the clip throughput
+(features/s) and the end-to-end run time and peak memory of `arcrest2shp()`. Results are printed and
+can be saved as JSON to compare runs.
+
+Example:
+    python benchmarks/benchmark_arcrest2shp.py --features 20000 --latency 0.02 --output before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import geopandas as gpd
+from shapely.geometry import box
+
+from arcrest2shp import arcrest2shp
+from arcrest2shp_mock import MockArcGISServer, synthetic_services
+from arcrest2shp_utils import HttpTransport, crawl_catalog, iter_layer_features, features_to_gdf, clip_to_aoi, FeaturePage
+
+def write_aoi (folder, extent, fraction, crs):
+    """
+    Write an AOI shapefile covering the centre of an extent.
+
+    Args:
+        folder (str): The directory of the shapefile.
+        extent (tuple): The extent (xmin, ymin, xmax, ymax) in EPSG:4326.
+        fraction (float): The fraction of the extent width and height covered by the AOI.
+        crs (int): The EPSG code of the shapefile.
+
+    Returns:
+        str: The path of the shapefile.
+    """
+    xmin, ymin, xmax, ymax = extent
+    dx, dy = (xmax - xmin) * (1 - fraction) / 2, (ymax - ymin) * (1 - fraction) / 2
+    path = os.path.join(folder, 'aoi.shp')
+    aoi = gpd.GeoDataFrame({'id': [1]}, geometry=[box(xmin + dx, ymin + dy, xmax - dx, ymax - dy)], crs=4326)
+    aoi.to_crs(crs).to_file(path)
+    return path
+def bench_crawl (server, crawl_threads):
+    """
+    Measure the crawl of the whole directory.
+
+    Returns:
+        tuple: The benchmark result dict and the discovered Catalog.
+    """
+    requests_before = server.stats['requests']
+    transport = HttpTransport (crawl_threads)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        catalog = crawl_catalog (server.url, transport, crawl_threads)
+    elapsed = time.perf_counter() - start
+    pages = server.stats['requests'] - requests_before
+    return {'seconds': elapsed, 'pages': pages, 'pages_per_s': pages / elapsed, 'layers': len(catalog.layers)}, catalog
+def bench_download (server, catalog, page_threads, transfer_format):
+    """
+    Measure the download of every vector layer, without clipping.
+
+    Returns:
+        tuple: The benchmark result dict and the features of the first layer.
+    """
+    transport = HttpTransport (page_threads * 2)
+    bytes_before = server.stats['bytes']
+    features = 0
+    sample = None
+    start = time.perf_counter()
+    for layer in catalog.layers:
+        if layer.type != 'Vector':
+            continue
+        layer_pages = []
+        for page in iter_layer_features (transport, layer.url, {}, layer.metadata, page_threads, transfer_format=transfer_format):
+            features += len(page)
+            if sample is None:
+                layer_pages.append(page)
+        if sample is None:
+            sample = (FeaturePage.concat (layer_pages), layer.metadata)
+    elapsed = time.perf_counter() - start
+    megabytes = (server.stats['bytes'] - bytes_before) / 1e6
+    return {'seconds': elapsed, 'features': features, 'features_per_s': features / elapsed,
+            'megabytes': megabytes, 'mb_per_s': megabytes / elapsed}, sample
+def bench_clip (sample, aoi_path, repeat):
+    """
+    Measure the reprojection and clip of the features of one layer.
+
+    Returns:
+        dict: The benchmark result.
+    """
+    features, layer_json = sample
+    aoi = gpd.read_file(aoi_path)
+    geometry = aoi.geometry.union_all() if hasattr(aoi.geometry, 'union_all') else aoi.geometry.unary_union
+    gdf = features_to_gdf (features, layer_json).to_crs(aoi.crs)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        clipped = clip_to_aoi (gdf, geometry)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    return {'seconds': best, 'features': len(gdf), 'features_per_s': len(gdf) / best, 'clipped': len(clipped)}
+def run_end_to_end (url, aoi_path, out_path, kwargs, results):
+    """
+    Run `arcrest2shp()` in a child process and report its time and peak memory.
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        arcrest2shp (url, aoi_path, out_path, **kwargs)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+    results.put({'seconds': elapsed, 'peak_rss_mb': peak_mb})
+def bench_end_to_end (server, aoi_path, out_path, kwargs):
+    """
+    Measure a full `arcrest2shp()` run in a fresh process, so its peak memory is not mixed with the benchmark's.
+
+    Returns:
+        dict: The benchmark result.
+    """
+    requests_before, bytes_before = server.stats['requests'], server.stats['bytes']
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_end_to_end, args=(server.url, aoi_path, out_path, kwargs, results))
+    process.start()
+    result = results.get()
+    process.join()
+    result['requests'] = server.stats['requests'] - requests_before
+    result['megabytes'] = (server.stats['bytes'] - bytes_before) / 1e6
+    return result
+def main ():
+    parser = argparse.ArgumentParser(description='Benchmark arcrest2shp against a local mock ArcGIS REST server.')
+    parser.add_argument('--folders', type=int, default=2)
+    parser.add_argument('--services', type=int, default=2, help='map and feature services per folder')
+    parser.add_argument('--layers', type=int, default=3, help='vector layers per service')
+    parser.add_argument('--features', type=int, default=5000, help='features per layer')
+    parser.add_argument('--max-record-count', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--aoi-fraction', type=float, default=0.5, help='fraction of the extent covered by the AOI')
+    parser.add_argument('--aoi-crs', type=int, default=3857)
+    parser.add_argument('--crawl-threads', type=int, default=8)
+    parser.add_argument('--num-threads', type=int, default=10)
+    parser.add_argument('--page-threads', type=int, default=4)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--cpu-workers', type=int, default=0)
+    parser.add_argument('--transfer-format', choices=('auto', 'pbf', 'json'), default='auto')
+    parser.add_argument('--no-gzip', action='store_true', help='serve uncompressed responses')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of the clip benchmark (best is kept)')
+    parser.add_argument('--skip-end-to-end', action='store_true')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    args = parser.parse_args()
+
+    services = synthetic_services (args.folders, args.services, args.layers, args.features, args.max_record_count, image_services=0)
+    results = {'config': vars(args), 'python': platform.python_version(), 'platform': platform.platform()}
+    with MockArcGISServer (services, latency=args.latency, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, retry_after=0, gzip=not args.no_gzip) as server, tempfile.TemporaryDirectory() as folder:
+        aoi_path = write_aoi (folder, services[0].extent, args.aoi_fraction, args.aoi_crs)
+        results['crawl'], catalog = bench_crawl (server, args.crawl_threads)
+        results['download'], sample = bench_download (server, catalog, args.page_threads, args.transfer_format)
+        results['clip'] = bench_clip (sample, aoi_path, args.repeat)
+        if not args.skip_end_to_end:
+            kwargs = {'num_threads': args.num_threads, 'crawl_threads': args.crawl_threads, 'page_threads': args.page_threads,
+                      'stream': args.stream, 'cpu_workers': args.cpu_workers, 'transfer_format': args.transfer_format}
+            results['end_to_end'] = bench_end_to_end (server, aoi_path, os.path.join(folder, 'out'), kwargs)
+
+    for name in ('crawl', 'download', 'clip', 'end_to_end'):
+        if name in results:
+            print(f'{name:<11}' + '  '.join(f'{key}={value:.3f}' if isinstance(value, float) else f'{key}={value}'
+                                            for key, value in results[name].items()))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+if __name__ == '__main__':
+    main()
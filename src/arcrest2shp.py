@@ -1,7 +1,12 @@
 import concurrent.futures
-from arcrest2shp_utils import create_folder, create_csv, process_links, download_data, check_geojson, create_csv_error_log
+from arcrest2shp_utils import create_folder, crawl_catalog, download_data, check_geojson, HttpTransport, write_retry_log, AoiCache, RunManifest, DownloadOptions, ResultSink, CpuStage, AdaptiveLimiter, RunMetrics, CrawlFilter, build_aoi_batch, download_data_batch, output_folder, geometry_query_params, schedule_layers, record_layer_error
 
-def arcrest2shp (url_base, shp, out_path, num_threads = 10):
+def arcrest2shp (url_base, shp, out_path, num_threads = 10, crawl_threads = 8, page_threads = 4, cache_dir = None,
+                 stream = False, max_memory_mb = 512, spatial_filter = 'bbox', summary_formats = (), cpu_workers = 0,
+                 cpu_queue_size = None, max_host_concurrency = None, max_requests_per_second = None, metrics_hooks = (),
+                 profiler = None, crawl_filter = None, prune_by_extent = True, raster = False, raster_resolution = None,
+                 raster_tile_size = 1024, output_format = 'shp', transfer_format = 'auto', geometry_precision = None,
+                 max_allowable_offset = None, quantization_parameters = None, count_layers = True):
     """
     Download and process data from multiple URLs.
 
@@ -10,6 +15,50 @@ def arcrest2shp (url_base, shp, out_path, num_threads = 10):
         shp (str): The path to the shapefile.
         out_path (str): The path to the output folder.
         num_threads (int, optional): The number of threads to use for concurrent processing. Defaults to 10.
+        crawl_threads (int, optional): The maximum number of concurrent requests while crawling the directory. Defaults to 8.
+        page_threads (int, optional): The maximum number of query pages fetched concurrently per layer. Defaults to 4.
+        cache_dir (str, optional): A directory where directory, service and layer descriptions are cached and
+            revalidated with conditional requests on later runs. Defaults to None (no cache).
+        stream (bool, optional): Stream features through reprojection and clipping straight into the shapefiles,
+            without intermediate GeoJSON files. Defaults to False.
+        max_memory_mb (int, optional): The approximate memory ceiling per layer in streaming mode. Defaults to 512.
+        spatial_filter (str, optional): The server-side spatial filter, 'bbox' to query the shapefile bounding box
+            or 'polygon' to query features intersecting the (simplified) shapefile polygon. Defaults to 'bbox'.
+        summary_formats (tuple, optional): Additional formats of the summaries besides CSV: 'parquet' and/or 'sqlite'.
+            Defaults to ().
+        cpu_workers (int, optional): The number of processes decoding, reprojecting, clipping and writing the layers,
+            separate from the `num_threads` download threads. Defaults to 0 (done in the download threads).
+        cpu_queue_size (int, optional): The maximum number of layers (or streamed chunks) queued for the CPU processes.
+            Download threads wait when it is full. Defaults to twice `cpu_workers`.
+        max_host_concurrency (int, optional): The ceiling of requests in flight per host. The actual limit adapts
+            to the server responses. Defaults to the number of pooled connections.
+        max_requests_per_second (float, optional): The ceiling of requests per second per host. Defaults to None (no cap).
+        metrics_hooks (iterable, optional): Callables receiving every stage and request measurement as a dict,
+            e.g. to feed a metrics sink. Defaults to ().
+        profiler (callable, optional): A function `profiler(stage, url)` returning a context manager wrapped around
+            the stages timed in the download threads, e.g. to profile selected stages. Defaults to None.
+        crawl_filter (CrawlFilter, optional): Include/exclude name patterns for folders, services and layers.
+            Defaults to CrawlFilter(), which skips the '..._FS/MapServer' services.
+        prune_by_extent (bool, optional): Skip services and layers whose extent does not intersect the shapefile
+            while crawling. Defaults to True.
+        raster (bool, optional): Extract the pixels of the raster layers intersecting the shapefile into tiled,
+            compressed GeoTIFF files clipped to the shapefile (requires rasterio). Defaults to False.
+        raster_resolution (float, optional): The pixel size of the GeoTIFF files in the units of the shapefile CRS.
+            Defaults to None (1/4096 of the longer side of the shapefile extent).
+        raster_tile_size (int, optional): The width and height in pixels of the tiles requested from the server.
+            Defaults to 1024.
+        output_format (str, optional): The format of the vector outputs: 'shp' (one shapefile per layer), 'gpkg'
+            (one GeoPackage, 'extracted_data.gpkg', with a table per layer), 'fgb' (one FlatGeobuf file per layer)
+            or 'parquet' (one GeoParquet file per layer, requires pyarrow). Defaults to 'shp'.
+        transfer_format (str, optional): The format of the query responses: 'auto' (the compact Esri PBF format when
+            the layer supports it, JSON otherwise), 'pbf' or 'json'. Defaults to 'auto'.
+        geometry_precision (int, optional): The number of decimals of the downloaded coordinates. Defaults to None
+            (full precision).
+        max_allowable_offset (float, optional): The server-side generalisation tolerance of the downloaded geometries,
+            in degrees. Defaults to None (no generalisation).
+        quantization_parameters (dict, optional): The `quantizationParameters` of the queries. Defaults to None.
+        count_layers (bool, optional): Count the features of each vector layer inside the shapefile before
+            downloading, skip the empty layers and start the largest first. Defaults to True.
 
     Returns:
         None
@@ -17,10 +66,36 @@ def arcrest2shp (url_base, shp, out_path, num_threads = 10):
     Note:
         - The function downloads and processes data from multiple URLs based on the `url_base`.
         - It creates necessary folders for data processing, including a main folder, a GeoJSON folder,
-          and a Shapefile folder inside the `out_path`.
-        - The function creates CSV files to summarize vectors and rasters, and an error log.
-        - It retrieves all links from the `url_base` and filters out links containing 'FS/MapServer' in the URL.
+          and a folder of the vector outputs (named after the `output_format`) inside the `out_path`.
+        - The function creates CSV files to summarize vectors and rasters, and an error log. The workers send their
+          results through a queue to a single writer that appends them in batches and records each layer once.
+        - All requests share one pooled keep-alive HTTP session with timeouts and jittered exponential
+          backoff. URLs that needed retries are summarised in 'retry_log.csv'.
+        - A per-host adaptive limiter (token bucket and AIMD concurrency control) shared by the crawler and the
+          downloader raises parallelism while the server stays healthy and backs off on 429/5xx or rising latency.
+        - The wall time of each stage (crawl, query, read, decode, reproject, clip, write), the requests, bytes,
+          retries and features in and out of every layer are written to 'run_report.json' (totals, stages and
+          slowest layers) and 'run_report.ndjson' (one line per layer).
+        - It crawls the `url_base` through the ArcGIS REST JSON API (`?f=json`) with `crawl_threads` concurrent
+          requests. Folders, services and layers rejected by the `crawl_filter` patterns, and services and layers
+          whose `fullExtent`/`extent` does not intersect the shapefile, are never descended into. The layer
+          descriptions captured during the crawl are passed to the download stage, so each layer page is fetched only once.
+        - The shapefile is read once. Its reprojection to each layer CRS is cached and shared by all threads.
         - The filtered data links are processed concurrently using ThreadPoolExecutor and `num_threads` threads.
+          With `cpu_workers` > 0, decoding, reprojection, clipping and writing run in a separate ProcessPoolExecutor,
+          fed through a bounded queue, so network waits and GIL-bound work do not compete for the same threads.
+          Each vector layer is queried in-process in pages of `maxRecordCount` features, `page_threads` at a time.
+        - With `stream=True`, feature pages flow through reprojection and clipping in chunks bounded by
+          `max_memory_mb` and are appended straight to the layer outputs, without intermediate GeoJSON files.
+        - The clipped features are written straight from memory in the `output_format`. Layers that fit in one chunk
+          are written in a single call, larger ones are copied in one transaction once complete, so spatial indexes
+          (GeoPackage R-tree, FlatGeobuf packed Hilbert R-tree) are built once per layer. Tables of the GeoPackage
+          are written by one thread at a time.
+        - With `spatial_filter='polygon'`, layers are queried with the shapefile polygon (esriGeometryPolygon,
+          esriSpatialRelIntersects) instead of its bounding box. The polygon is simplified to fit the request
+          size and large requests are sent as POST.
+        - Progress is recorded per layer in 'manifest.sqlite'. A rerun in the same `out_path` resumes unfinished
+          layers and skips layers whose `editingInfo.lastEditDate` (or downloaded content hash) did not change.
         - GeoJSON files are checked and updated, and vector information is summarized in the CSV file.
 
     Parameters Description:
@@ -28,6 +103,29 @@ def arcrest2shp (url_base, shp, out_path, num_threads = 10):
         - shp (str): The path to the shapefile used for clipping GeoJSON data.
         - out_path (str): The path to the output folder where processed data and CSV files will be stored.
         - num_threads (int, optional): The number of threads to use for concurrent processing. Defaults to 10.
+        - crawl_threads (int, optional): The maximum number of concurrent requests while crawling. Defaults to 8.
+        - page_threads (int, optional): The maximum number of query pages fetched concurrently per layer. Defaults to 4.
+        - cache_dir (str, optional): A persistent HTTP cache directory for the crawl. Defaults to None.
+        - stream (bool, optional): Stream features into the shapefiles in bounded chunks. Defaults to False.
+        - max_memory_mb (int, optional): The approximate memory ceiling per layer when streaming. Defaults to 512.
+        - spatial_filter (str, optional): 'bbox' or 'polygon' server-side spatial filter. Defaults to 'bbox'.
+        - summary_formats (tuple, optional): Additional summary formats ('parquet', 'sqlite'). Defaults to ().
+        - cpu_workers (int, optional): The number of CPU worker processes. Defaults to 0.
+        - cpu_queue_size (int, optional): The maximum number of tasks queued for the CPU processes. Defaults to None.
+        - max_host_concurrency (int, optional): The ceiling of requests in flight per host. Defaults to None.
+        - max_requests_per_second (float, optional): The ceiling of requests per second per host. Defaults to None.
+        - metrics_hooks (iterable, optional): Callables receiving every stage and request measurement. Defaults to ().
+        - profiler (callable, optional): A context manager factory wrapped around timed stages. Defaults to None.
+        - crawl_filter (CrawlFilter, optional): Include/exclude name patterns of the crawl. Defaults to None.
+        - prune_by_extent (bool, optional): Skip services and layers outside the shapefile. Defaults to True.
+        - raster (bool, optional): Extract raster pixels into GeoTIFF files. Defaults to False.
+        - raster_resolution (float, optional): The pixel size of the GeoTIFF files. Defaults to None.
+        - raster_tile_size (int, optional): The tile size in pixels of raster requests. Defaults to 1024.
+        - output_format (str, optional): 'shp', 'gpkg', 'fgb' or 'parquet' vector outputs. Defaults to 'shp'.
+        - transfer_format (str, optional): 'auto', 'pbf' or 'json' query responses. Defaults to 'auto'.
+        - geometry_precision, max_allowable_offset, quantization_parameters (optional): Lower the precision of the
+          downloaded geometries to shrink the responses. Defaults to None (full precision).
+        - count_layers (bool, optional): Schedule the layers by feature count. Defaults to True.
 
     Example:
         arcrest2shp('https://example.com/data/', 'path/to/shapefile.shp', 'output_folder/', num_threads=4)
@@ -35,29 +133,162 @@ def arcrest2shp (url_base, shp, out_path, num_threads = 10):
     # Create necessary folders for the data processing
     export_path = create_folder (out_path) # Main folder
     geojson_out_path = create_folder (export_path, 'geojson') # GeoJSON folder
-    shp_out_path = create_folder (export_path, 'shp') # Shapefile folder 
+    shp_out_path = output_folder (export_path, output_format) # Vector output folder
+    if raster:
+        # Fail early rather than after the vector downloads
+        import rasterio  # noqa: F401
+        create_folder (export_path, 'raster') # GeoTIFF folder
     
-    # Create a CSV file in the export_path to summarise vectors
-    csv_path_vector = create_csv (export_path, 'vector')
-    # Create a CSV file in the export_path to summarise rasters
-    create_csv (export_path, 'raster')
-    # Create a CSV file in the export_path to summarise errors
-    create_csv_error_log (export_path)
+    # Create the CSV files in the export_path to summarise vectors, rasters and errors, written by a single writer
+    sink = ResultSink (export_path, summary_formats)
     
-    # Retrieve all links from the URL base
-    cache = {}  # Dictionary to cache retrieved links
-    visited = set()  # Set to track visited URLs
-    process_links(url_base, cache, visited)
-    #process_links_mthread (url, cache, visited, num_threads) #Not used yet
-    
-    # Filter out links containing 'FS/MapServer' in the URL
-        # Edit in the future for other rest servers -- thin is for dataWa
-    filtered_data = [value for value in list(visited) if 'FS/MapServer' not in value]
+    # Read the area of interest once, its projections are cached and shared by all workers
+    aoi = AoiCache (shp)
+    # CPU-bound stage (decode, reproject, clip, write), separate from the download threads. Its worker
+    # processes start first, so a script without a __main__ guard fails before any download
+    cpu_stage = CpuStage (aoi, cpu_workers, cpu_queue_size)
+    # Settings shared by every layer
+    options = DownloadOptions (export_path, shp_out_path, page_threads, stream, max_memory_mb, spatial_filter,
+                               raster=raster, raster_resolution=raster_resolution, raster_tile_size=raster_tile_size,
+                               output_format=output_format, transfer_format=transfer_format,
+                               geometry_params=geometry_query_params (geometry_precision, max_allowable_offset,
+                                                                      quantization_parameters))
+    # Record progress in a manifest so that reruns resume unfinished layers and skip unchanged ones
+    manifest = RunManifest (export_path, aoi.signature, options.signature)
+    # Share one pooled HTTP session between the crawler and the downloader
+    pool_size = max(num_threads * page_threads, crawl_threads)
+    limiter = AdaptiveLimiter (max_host_concurrency or pool_size, max_requests_per_second)
+    # Measure the stages, requests and features of every layer
+    metrics = RunMetrics (metrics_hooks, profiler)
+    transport = HttpTransport (pool_size, cache_dir=cache_dir, limiter=limiter, metrics=metrics)
+    # Discover all services and layers under the URL base
+    with metrics.stage ('crawl'):
+        catalog = crawl_catalog (url_base, transport, crawl_threads, aoi if prune_by_extent else None,
+                                 crawl_filter or CrawlFilter())
+    filtered_data = catalog.layers
+    if count_layers:
+        # Skip the layers without features in the shapefile and start the largest first
+        with metrics.stage ('count'):
+            filtered_data, empty = schedule_layers (catalog.layers, transport, aoi, options, num_threads, crawl_threads, manifest)
+        for layer in empty:
+            metrics.layer (layer.url, name=layer.name, type=layer.type, state='empty')
+        print(f'Skipped {len(empty)} layers without features in the shapefile')
     #arg list for multithread input
-    args_list = list(zip(filtered_data, [shp] * len(filtered_data), 
-                [export_path] * len(filtered_data), [shp_out_path] * len(filtered_data)))
+    args_list = list(zip(filtered_data, [transport] * len(filtered_data), [aoi] * len(filtered_data),
+                [manifest] * len(filtered_data), [sink] * len(filtered_data),
+                [cpu_stage] * len(filtered_data), [options] * len(filtered_data), [metrics] * len(filtered_data)))
     # Use ThreadPoolExecutor to execute the function concurrently
     with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        executor.map(download_data, args_list)
+        futures = {executor.submit(download_data, args): args[0] for args in args_list}
+        # Record the layers that failed with an unexpected error
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                record_layer_error (futures[future], future.exception(), manifest, metrics, [sink])
+    # Wait for the layers still in the CPU stage
+    cpu_stage.close ()
+    # Write the remaining results before reading the summaries back
+    sink.close ()
     # Check and update geojson files
-    check_geojson (geojson_out_path, csv_path_vector)
\ No newline at end of file
+    check_geojson (geojson_out_path, sink.paths['vector'])
+    # Summarise the URLs that needed retries
+    write_retry_log (export_path, transport)
+    # Write the run report
+    metrics.write_report (export_path, transport)
+    manifest.close ()
+def arcrest2shp_batch (url_base, aois, out_path, id_column = None, num_threads = 10, crawl_threads = 8, page_threads = 4,
+                       cache_dir = None, max_memory_mb = 512, spatial_filter = 'bbox', cluster_distance = None,
+                       summary_formats = (), max_host_concurrency = None, max_requests_per_second = None,
+                       metrics_hooks = (), crawl_filter = None, prune_by_extent = True, output_format = 'shp',
+                       transfer_format = 'auto', geometry_precision = None, max_allowable_offset = None,
+                       quantization_parameters = None, count_layers = True):
+    """
+    Download data once and clip it to many areas of interest.
+
+    Parameters:
+        url_base (str): The base URL for retrieving data.
+        aois (str or list): The path to a shapefile with one AOI per `id_column` value, or a list of shapefile
+            paths (one AOI per file, named after the file).
+        out_path (str): The path to the output folder.
+        id_column (str, optional): The column holding the AOI identifiers. Defaults to None (one AOI per file).
+        num_threads (int, optional): The number of layers processed concurrently. Defaults to 10.
+        crawl_threads (int, optional): The maximum number of concurrent requests while crawling the directory. Defaults to 8.
+        page_threads (int, optional): The maximum number of query pages fetched concurrently per layer. Defaults to 4.
+        cache_dir (str, optional): A directory where directory, service and layer descriptions are cached. Defaults to None.
+        max_memory_mb (int, optional): The approximate memory ceiling of the feature chunks of a layer. Defaults to 512.
+        spatial_filter (str, optional): The server-side spatial filter, 'bbox' or 'polygon'. Defaults to 'bbox'.
+        cluster_distance (float, optional): AOIs whose envelopes are closer than this distance (in the units of the
+            AOI CRS) are queried together, other groups get their own query. Defaults to None (one query per layer
+            with the union of all AOIs).
+        summary_formats (tuple, optional): Additional formats of the summaries: 'parquet' and/or 'sqlite'. Defaults to ().
+        max_host_concurrency (int, optional): The ceiling of requests in flight per host. Defaults to None.
+        max_requests_per_second (float, optional): The ceiling of requests per second per host. Defaults to None.
+        metrics_hooks (iterable, optional): Callables receiving every stage and request measurement. Defaults to ().
+        crawl_filter (CrawlFilter, optional): Include/exclude name patterns of the crawl. Defaults to CrawlFilter().
+        prune_by_extent (bool, optional): Skip services and layers outside all AOIs while crawling. Defaults to True.
+        output_format (str, optional): The format of the vector outputs: 'shp', 'gpkg', 'fgb' or 'parquet'
+            (see `arcrest2shp`). Defaults to 'shp'.
+        transfer_format (str, optional): The format of the query responses: 'auto', 'pbf' or 'json' (see `arcrest2shp`).
+            Defaults to 'auto'.
+        geometry_precision (int, optional): The number of decimals of the downloaded coordinates. Defaults to None.
+        max_allowable_offset (float, optional): The generalisation tolerance of the downloaded geometries in degrees.
+            Defaults to None.
+        quantization_parameters (dict, optional): The `quantizationParameters` of the queries. Defaults to None.
+        count_layers (bool, optional): Count the features of each vector layer inside the AOIs before downloading,
+            skip the empty layers and start the largest first. Defaults to True.
+
+    Returns:
+        None
+
+    Note:
+        - The directory is crawled once, pruned with the union of the AOIs.
+        - Each vector layer is queried once (or once per group of nearby AOIs) and streamed in chunks. The features
+          are assigned to the AOIs they intersect through a spatial index, clipped to each AOI and appended to the
+          outputs of that AOI, so the cost grows with the number of layers rather than layers x AOIs.
+        - Each AOI gets a folder '<out_path>/extracted_data/<aoi_id>' with its layers (a folder named after the
+          `output_format`, or 'extracted_data.gpkg') and summaries.
+          The manifest, retry log and run report of the batch are written in '<out_path>/extracted_data'.
+
+    Example:
+        arcrest2shp_batch('https://example.com/data/', 'path/to/projects.shp', 'output_folder/', id_column='PROJECT')
+    """
+    # Create the main folder, the AOI folders and their summaries
+    export_path = create_folder (out_path)
+    batch = build_aoi_batch (aois, export_path, id_column, cluster_distance, summary_formats, output_format)
+    options = DownloadOptions (export_path, None, page_threads, True, max_memory_mb, spatial_filter, output_format=output_format,
+                               transfer_format=transfer_format,
+                               geometry_params=geometry_query_params (geometry_precision, max_allowable_offset,
+                                                                      quantization_parameters))
+    # Record progress in a manifest so that reruns resume unfinished layers and skip unchanged ones
+    manifest = RunManifest (export_path, batch.aoi.signature, options.signature)
+    # Share one pooled HTTP session between the crawler and the downloader
+    pool_size = max(num_threads * page_threads, crawl_threads)
+    limiter = AdaptiveLimiter (max_host_concurrency or pool_size, max_requests_per_second)
+    metrics = RunMetrics (metrics_hooks)
+    transport = HttpTransport (pool_size, cache_dir=cache_dir, limiter=limiter, metrics=metrics)
+    # Discover all services and layers under the URL base once for all AOIs
+    with metrics.stage ('crawl'):
+        catalog = crawl_catalog (url_base, transport, crawl_threads, batch.aoi if prune_by_extent else None,
+                                 crawl_filter or CrawlFilter())
+    layers = catalog.layers
+    if count_layers:
+        # Skip the layers without features in any AOI and start the largest first
+        with metrics.stage ('count'):
+            layers, empty = schedule_layers (catalog.layers, transport, batch.aoi, options, num_threads, crawl_threads, manifest)
+        for layer in empty:
+            metrics.layer (layer.url, name=layer.name, type=layer.type, state='empty')
+        print(f'Skipped {len(empty)} layers without features in the AOIs')
+    args_list = [(layer, transport, batch, manifest, options, metrics) for layer in layers]
+    # Use ThreadPoolExecutor to process the layers concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {executor.submit(download_data_batch, args): args[0] for args in args_list}
+        # Record the layers that failed with an unexpected error
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                record_layer_error (futures[future], future.exception(), manifest, metrics, list(batch.sinks.values()))
+    # Write the remaining results of every AOI
+    batch.close ()
+    # Summarise the URLs that needed retries
+    write_retry_log (export_path, transport)
+    # Write the run report
+    metrics.write_report (export_path, transport)
+    manifest.close ()
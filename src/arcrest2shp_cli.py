@@ -0,0 +1,173 @@
+"""
+Command line interface of arcrest2shp.
+
+    python src/arcrest2shp_cli.py catalog URL [-o catalog.json|catalog.csv]
+    python src/arcrest2shp_cli.py extract URL OUT_PATH --aoi AOI.shp [--format gpkg] [--stream] ...
+    python src/arcrest2shp_cli.py resume OUT_PATH
+
+Only the standard library and requests are imported at startup. The GIS stack (geopandas, shapely...)
+is imported when a command needs it, so `catalog` starts quickly and runs without it unless `--aoi`
+is given to prune the crawl by extent.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+# The arguments of `extract`, saved next to the outputs so `resume` can run it again
+RUN_CONFIG = 'run_config.json'
+def add_crawl_arguments (parser):
+    """
+    Add the crawl options shared by every command.
+    """
+    parser.add_argument('--crawl-threads', type=int, default=8, help='concurrent requests while crawling')
+    parser.add_argument('--cache-dir', help='persistent HTTP cache of the directory, service and layer descriptions')
+    parser.add_argument('--max-host-concurrency', type=int, help='ceiling of requests in flight per host')
+    parser.add_argument('--max-requests-per-second', type=float, help='ceiling of requests per second per host')
+    for level in ('folders', 'services', 'layers'):
+        for action in ('include', 'exclude'):
+            parser.add_argument(f'--{action}-{level}', nargs='+', metavar='PATTERN',
+                                help=f'wildcard patterns of the {level} to {"visit" if action == "include" else "skip"}')
+def crawl_filter_from_args (args):
+    """
+    Build the CrawlFilter of the `--include-*`/`--exclude-*` options.
+
+    Returns:
+        CrawlFilter: The name patterns, with the default excluded services unless `--exclude-services` is given.
+    """
+    from arcrest2shp_utils import CrawlFilter
+    patterns = {}
+    for level in ('folders', 'services', 'layers'):
+        for action in ('include', 'exclude'):
+            values = getattr(args, f'{action}_{level}')
+            if values is not None:
+                patterns[f'{action}_{level}'] = tuple(values)
+    return CrawlFilter(**patterns)
+def run_catalog (args):
+    """
+    Crawl a services directory and export its services and layers to JSON or CSV.
+    """
+    from arcrest2shp_utils import HttpTransport, AdaptiveLimiter, AoiCache, crawl_catalog, export_catalog
+    limiter = AdaptiveLimiter (args.max_host_concurrency or args.crawl_threads, args.max_requests_per_second)
+    transport = HttpTransport (args.crawl_threads, cache_dir=args.cache_dir, limiter=limiter)
+    # Pruning by extent is the only part of the crawl that needs the GIS stack
+    aoi = AoiCache (args.aoi) if args.aoi else None
+    # Keep the standard output for the catalog when it is printed
+    with contextlib.redirect_stdout(sys.stderr if args.output is None else sys.stdout):
+        catalog = crawl_catalog (args.url, transport, args.crawl_threads, aoi, crawl_filter_from_args (args))
+    count = export_catalog (catalog, args.output, args.metadata)
+    if args.output is not None:
+        print(f'Exported {len(catalog.services)} services and {count} layers to {args.output}')
+def run_extract (args):
+    """
+    Download, clip and export the layers intersecting one or more areas of interest.
+    """
+    # Save the arguments so that an interrupted run can be resumed with `resume`
+    export_path = os.path.join(args.out_path, 'extracted_data')
+    os.makedirs(export_path, exist_ok=True)
+    config = {key: value for key, value in vars(args).items() if key != 'func'}
+    # Absolute AOI paths so the run can be resumed from another working directory
+    config['aoi'] = [os.path.abspath(path) for path in args.aoi]
+    with open(os.path.join(export_path, RUN_CONFIG), 'w') as file:
+        json.dump(config, file, indent=2)
+
+    from arcrest2shp import arcrest2shp, arcrest2shp_batch
+    common = dict(num_threads=args.num_threads, crawl_threads=args.crawl_threads, page_threads=args.page_threads,
+                  cache_dir=args.cache_dir, max_memory_mb=args.max_memory_mb, spatial_filter=args.spatial_filter,
+                  summary_formats=tuple(args.summary_format or ()), max_host_concurrency=args.max_host_concurrency,
+                  max_requests_per_second=args.max_requests_per_second, crawl_filter=crawl_filter_from_args (args),
+                  prune_by_extent=not args.no_prune, count_layers=not args.no_count, output_format=args.format, transfer_format=args.transfer_format,
+                  geometry_precision=args.geometry_precision, max_allowable_offset=args.max_allowable_offset,
+                  quantization_parameters=json.loads(args.quantization) if args.quantization else None)
+    if len(args.aoi) > 1 or args.id_column:
+        # One download for many areas of interest
+        arcrest2shp_batch (args.url, args.aoi if len(args.aoi) > 1 else args.aoi[0], args.out_path,
+                           id_column=args.id_column, cluster_distance=args.cluster_distance, **common)
+    else:
+        arcrest2shp (args.url, args.aoi[0], args.out_path, stream=args.stream, cpu_workers=args.cpu_workers,
+                     cpu_queue_size=args.cpu_queue_size, raster=args.raster, raster_resolution=args.raster_resolution,
+                     raster_tile_size=args.raster_tile_size, **common)
+def run_resume (args):
+    """
+    Run an interrupted or outdated extraction again with its saved arguments.
+
+    Layers already written and not edited since are skipped through the run manifest.
+    """
+    config_path = os.path.join(args.out_path, 'extracted_data', RUN_CONFIG)
+    if not os.path.exists(config_path):
+        sys.exit(f'No extraction to resume in {args.out_path} ({config_path} not found)')
+    with open(config_path) as file:
+        config = json.load(file)
+    # Options added since the run was saved take their default value
+    defaults = vars(build_parser ().parse_args(['extract', config['url'], args.out_path, '--aoi', config['aoi'][0]]))
+    # Run from the same output folder even if it was moved
+    config['out_path'] = args.out_path
+    run_extract (argparse.Namespace(**{**defaults, **config}))
+def build_parser ():
+    """
+    Build the argument parser of the `catalog`, `extract` and `resume` commands.
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(prog='arcrest2shp', description='Extract data from ArcGIS REST Services Directories.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    catalog = commands.add_parser('catalog', help='list the services and layers of a directory')
+    catalog.add_argument('url', help='the URL of the services directory, a folder or a service')
+    catalog.add_argument('-o', '--output', help='a .json or .csv file (JSON on the standard output by default)')
+    catalog.add_argument('--aoi', help='a shapefile: skip services and layers outside it (requires geopandas)')
+    catalog.add_argument('--metadata', action='store_true', help='include the JSON description of every item')
+    add_crawl_arguments (catalog)
+    catalog.set_defaults(func=run_catalog)
+
+    extract = commands.add_parser('extract', help='download and clip the layers intersecting an area of interest')
+    extract.add_argument('url', help='the URL of the services directory, a folder or a service')
+    extract.add_argument('out_path', help='the output folder')
+    extract.add_argument('--aoi', action='append', required=True,
+                         help='the shapefile of the area of interest, repeat it to extract several AOIs at once')
+    extract.add_argument('--id-column', help='extract one AOI per value of this column of the shapefile')
+    extract.add_argument('--cluster-distance', type=float, help='AOIs closer than this distance are queried together')
+    extract.add_argument('--format', choices=('shp', 'gpkg', 'fgb', 'parquet'), default='shp', help='vector output format')
+    extract.add_argument('--transfer-format', choices=('auto', 'pbf', 'json'), default='auto',
+                         help='format of the query responses, PBF when supported by default')
+    extract.add_argument('--geometry-precision', type=int, help='decimals of the downloaded coordinates')
+    extract.add_argument('--max-allowable-offset', type=float, help='server-side generalisation tolerance in degrees')
+    extract.add_argument('--quantization', metavar='JSON', help='quantizationParameters of the queries, as JSON')
+    extract.add_argument('--num-threads', type=int, default=10, help='layers processed concurrently')
+    extract.add_argument('--page-threads', type=int, default=4, help='query pages fetched concurrently per layer')
+    extract.add_argument('--stream', action='store_true',
+                         help='stream features without intermediate GeoJSON files (always on with several AOIs)')
+    extract.add_argument('--max-memory-mb', type=int, default=512, help='memory ceiling per layer when streaming')
+    extract.add_argument('--spatial-filter', choices=('bbox', 'polygon'), default='bbox')
+    extract.add_argument('--summary-format', action='append', choices=('parquet', 'sqlite'),
+                         help='additional summary format, repeat it for several')
+    extract.add_argument('--cpu-workers', type=int, default=0, help='processes clipping and writing the layers')
+    extract.add_argument('--cpu-queue-size', type=int)
+    extract.add_argument('--no-prune', action='store_true', help='do not skip services and layers outside the AOI')
+    extract.add_argument('--no-count', action='store_true',
+                         help='do not count the features of the layers to skip the empty ones and start the largest first')
+    extract.add_argument('--raster', action='store_true', help='extract raster pixels into GeoTIFF files (requires rasterio)')
+    extract.add_argument('--raster-resolution', type=float, help='pixel size of the GeoTIFF files in AOI CRS units')
+    extract.add_argument('--raster-tile-size', type=int, default=1024)
+    add_crawl_arguments (extract)
+    extract.set_defaults(func=run_extract)
+
+    resume = commands.add_parser('resume', help='run an interrupted extraction again, skipping the layers up to date')
+    resume.add_argument('out_path', help='the output folder of the extraction')
+    resume.set_defaults(func=run_resume)
+    return parser
+def main (argv=None):
+    parser = build_parser ()
+    args = parser.parse_args(argv)
+    if args.func is run_extract and (len(args.aoi) > 1 or args.id_column):
+        # The batch mode always streams and has no CPU stage or raster extraction
+        unsupported = [option for option, value in (('--cpu-workers', args.cpu_workers), ('--cpu-queue-size', args.cpu_queue_size),
+                                                    ('--raster', args.raster), ('--raster-resolution', args.raster_resolution),
+                                                    ('--raster-tile-size', args.raster_tile_size != 1024)) if value]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} cannot be used with several --aoi or --id-column")
+    args.func(args)
+if __name__ == '__main__':
+    main()
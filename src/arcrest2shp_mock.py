@@ -0,0 +1,682 @@
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import random
+import re
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+@dataclass
+class MockLayer:
+    """
+    A synthetic vector layer served by `MockArcGISServer`.
+
+    Features are generated deterministically from the layer `seed`: points are spread uniformly over
+    the extent, polylines and polygons are small segments and squares around those points.
+
+    Attributes:
+        name (str): The layer name.
+        geometry_type (str): 'esriGeometryPoint', 'esriGeometryPolyline' or 'esriGeometryPolygon'.
+        feature_count (int): The number of features of the layer.
+        max_record_count (int): The maximum number of features returned by one query.
+        extent (tuple): The layer extent (xmin, ymin, xmax, ymax) in EPSG:4326.
+        seed (int): The seed of the feature generator.
+        supports_pbf (bool): Whether queries can return PBF (`f=pbf`).
+        wkid (int): The well-known id reported for the layer extent (its coordinates stay in EPSG:4326),
+            e.g. to serve a CRS unknown to pyproj.
+    """
+    name: str
+    geometry_type: str = 'esriGeometryPoint'
+    feature_count: int = 1000
+    max_record_count: int = 1000
+    extent: tuple = (115.0, -35.0, 129.0, -14.0)
+    seed: int = 0
+    supports_pbf: bool = True
+    wkid: int = 4326
+    _coords: np.ndarray = field(default=None, init=False, repr=False)
+
+    def coords (self):
+        """
+        Return the anchor point of every feature.
+
+        Returns:
+            numpy.ndarray: An array of shape (feature_count, 2), generated once.
+        """
+        if self._coords is None:
+            xmin, ymin, xmax, ymax = self.extent
+            rng = np.random.default_rng(self.seed)
+            self._coords = np.column_stack([rng.uniform(xmin, xmax, self.feature_count),
+                                            rng.uniform(ymin, ymax, self.feature_count)])
+        return self._coords
+
+    def feature (self, oid):
+        """
+        Build the Esri JSON feature of an object id (1 to `feature_count`).
+
+        Args:
+            oid (int): The object id.
+
+        Returns:
+            dict: The feature with its attributes and geometry.
+        """
+        x, y = (float(value) for value in self.coords()[oid - 1])
+        size = (self.extent[2] - self.extent[0]) / 1000
+        if self.geometry_type == 'esriGeometryPolyline':
+            geometry = {'paths': [[[x, y], [x + size, y + size], [x + 2 * size, y]]]}
+        elif self.geometry_type == 'esriGeometryPolygon':
+            # Esri outer rings are clockwise
+            geometry = {'rings': [[[x, y], [x, y + size], [x + size, y + size], [x + size, y], [x, y]]]}
+        else:
+            geometry = {'x': x, 'y': y}
+        attributes = {'OBJECTID': oid, 'NAME': f'{self.name} {oid}', 'VALUE': round(x * y, 3)}
+        return {'attributes': attributes, 'geometry': geometry}
+
+    def to_json (self, layer_id):
+        """
+        Return the JSON description of the layer.
+
+        Args:
+            layer_id (int): The id of the layer in its service.
+
+        Returns:
+            dict: The layer description, as returned by `<layer>?f=json`.
+        """
+        return {
+            'id': layer_id,
+            'name': self.name,
+            'type': 'Feature Layer',
+            'description': f'Synthetic {self.geometry_type[len("esriGeometry"):].lower()} layer',
+            'geometryType': self.geometry_type,
+            'objectIdField': 'OBJECTID',
+            'fields': [
+                {'name': 'OBJECTID', 'type': 'esriFieldTypeOID', 'alias': 'OBJECTID'},
+                {'name': 'NAME', 'type': 'esriFieldTypeString', 'alias': 'NAME', 'length': 100},
+                {'name': 'VALUE', 'type': 'esriFieldTypeDouble', 'alias': 'VALUE'},
+            ],
+            'maxRecordCount': self.max_record_count,
+            'extent': extent_json (self.extent, self.wkid),
+            'editingInfo': {'lastEditDate': 1690000000000 + self.seed},
+            'advancedQueryCapabilities': {'supportsPagination': True},
+            'supportedQueryFormats': 'JSON, geoJSON, PBF' if self.supports_pbf else 'JSON, geoJSON',
+            'capabilities': 'Map,Query,Data',
+        }
+@dataclass
+class MockService:
+    """
+    A synthetic service served by `MockArcGISServer`.
+
+    Attributes:
+        name (str): The service name relative to the services root ('Folder/Name').
+        type (str): 'MapServer', 'FeatureServer' or 'ImageServer'.
+        layers (list): The MockLayer list of a map or feature service (ignored for image services).
+        extent (tuple): The service extent (xmin, ymin, xmax, ymax) in EPSG:4326.
+        pixel_type (str): The `pixelType` declared by an image service. Its images are always 8-bit.
+        no_data_value (float): The `noDataValue` declared by an image service.
+    """
+    name: str
+    type: str = 'MapServer'
+    layers: list = field(default_factory=list)
+    extent: tuple = (115.0, -35.0, 129.0, -14.0)
+    pixel_type: str = 'U8'
+    no_data_value: float = None
+
+    def to_json (self):
+        """
+        Return the JSON description of the service.
+
+        Returns:
+            dict: The service description, as returned by `<service>?f=json`.
+        """
+        if self.type == 'ImageServer':
+            return {
+                'name': self.name.split('/')[-1],
+                'description': 'Synthetic image service',
+                'extent': extent_json (self.extent),
+                'fullExtent': extent_json (self.extent),
+                'pixelType': self.pixel_type,
+                'noDataValue': self.no_data_value,
+                'bandCount': 3,
+                'pixelSizeX': (self.extent[2] - self.extent[0]) / 4096,
+                'pixelSizeY': (self.extent[3] - self.extent[1]) / 4096,
+                'capabilities': 'Image,Metadata',
+            }
+        return {
+            'serviceDescription': 'Synthetic service',
+            'layers': [{'id': layer_id, 'name': layer.name, 'geometryType': layer.geometry_type}
+                       for layer_id, layer in enumerate(self.layers)],
+            'tables': [],
+            'spatialReference': {'wkid': 4326, 'latestWkid': 4326},
+            'fullExtent': extent_json (self.extent),
+            'initialExtent': extent_json (self.extent),
+            'capabilities': 'Map,Query,Data',
+        }
+def extent_json (extent, wkid=4326):
+    """
+    Convert an (xmin, ymin, xmax, ymax) tuple in EPSG:4326 to an Esri extent.
+
+    Args:
+        extent (tuple): The extent coordinates.
+        wkid (int): The well-known id of the spatial reference reported with the extent.
+
+    Returns:
+        dict: The Esri JSON extent.
+    """
+    xmin, ymin, xmax, ymax = extent
+    return {'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax, 'spatialReference': {'wkid': wkid, 'latestWkid': wkid}}
+def synthetic_services (folders=2, services_per_folder=2, layers_per_service=3, feature_count=1000,
+                        max_record_count=1000, image_services=1, extent=(115.0, -35.0, 129.0, -14.0), seed=0):
+    """
+    Build a synthetic services directory.
+
+    Vector layers cycle through point, polyline and polygon geometries. The layer names carry an
+    alphanumeric code in parentheses, like the layers of the DataWA services.
+
+    Args:
+        folders (int): The number of folders under the services root.
+        services_per_folder (int): The number of map and feature services per folder.
+        layers_per_service (int): The number of vector layers per service.
+        feature_count (int): The number of features per layer.
+        max_record_count (int): The maximum number of features returned by one query.
+        image_services (int): The number of image services per folder.
+        extent (tuple): The extent (xmin, ymin, xmax, ymax) in EPSG:4326 of every service.
+        seed (int): The seed of the feature generators.
+
+    Returns:
+        list: A list of MockService.
+    """
+    geometry_types = ['esriGeometryPoint', 'esriGeometryPolyline', 'esriGeometryPolygon']
+    services = []
+    for folder in range(folders):
+        for number in range(services_per_folder):
+            service_type = 'FeatureServer' if number % 2 else 'MapServer'
+            layers = []
+            for layer_id in range(layers_per_service):
+                layer_seed = seed + len(services) * layers_per_service + layer_id
+                layers.append(MockLayer(
+                    name=f'Layer {layer_id} (SYN-{layer_seed:03d})',
+                    geometry_type=geometry_types[layer_seed % len(geometry_types)],
+                    feature_count=feature_count,
+                    max_record_count=max_record_count,
+                    extent=extent,
+                    seed=layer_seed,
+                ))
+            services.append(MockService(f'Folder{folder}/Service{number}', service_type, layers, extent))
+        for number in range(image_services):
+            services.append(MockService(f'Folder{folder}/Image{number}', 'ImageServer', extent=extent))
+    return services
+def parse_where (where, feature_count):
+    """
+    Evaluate the object id ranges of a where clause.
+
+    Only the clauses sent by the client are understood: '1=1' and 'OBJECTID >= a', '<= b', '> c'
+    comparisons joined by AND.
+
+    Args:
+        where (str): The where clause.
+        feature_count (int): The number of features of the layer.
+
+    Returns:
+        tuple: The first and last object id selected (inclusive).
+    """
+    first, last = 1, feature_count
+    for operator, value in re.findall(r'OBJECTID\s*(>=|<=|>|<|=)\s*(\d+)', where or ''):
+        value = int(value)
+        if operator == '>=':
+            first = max(first, value)
+        elif operator == '>':
+            first = max(first, value + 1)
+        elif operator == '<=':
+            last = min(last, value)
+        elif operator == '<':
+            last = min(last, value - 1)
+        else:
+            first, last = max(first, value), min(last, value)
+    return first, last
+def parse_geometry_filter (params):
+    """
+    Read the bounding box of the spatial filter of a query.
+
+    Envelopes are used as they are, polygons are reduced to the bounding box of their rings.
+    Filters in a spatial reference other than EPSG:4326 are reprojected with pyproj.
+
+    Args:
+        params (dict): The query parameters.
+
+    Returns:
+        tuple: The filter bounding box (xmin, ymin, xmax, ymax) in EPSG:4326, or None for no filter.
+    """
+    geometry = params.get('geometry')
+    if not geometry:
+        return None
+    if geometry.lstrip().startswith('{'):
+        geometry = json.loads(geometry)
+        if 'rings' in geometry:
+            points = [point for ring in geometry['rings'] for point in ring]
+            xs, ys = [point[0] for point in points], [point[1] for point in points]
+            bbox = (min(xs), min(ys), max(xs), max(ys))
+        else:
+            bbox = (geometry['xmin'], geometry['ymin'], geometry['xmax'], geometry['ymax'])
+        in_sr = params.get('inSR') or (geometry.get('spatialReference') or {}).get('wkid')
+    else:
+        bbox = tuple(float(value) for value in geometry.split(','))
+        in_sr = params.get('inSR')
+    if in_sr and str(in_sr) not in ('4326', '{"wkid": 4326}'):
+        from pyproj import Transformer
+        bbox = Transformer.from_crs(int(in_sr), 4326, always_xy=True).transform_bounds(*bbox)
+    return bbox
+class MockArcGISServer:
+    """
+    A local stand-in for an ArcGIS REST Services Directory.
+
+    It serves the folders, services, layers and layer queries (`returnIdsOnly`, `returnCountOnly`,
+    object id ranges, `resultOffset` paging, envelope and polygon spatial filters, JSON or PBF output,
+    GET and POST) of a synthetic directory, with optional latency and injected 500, 429 and JSON
+    errors. Responses are gzip-compressed when accepted, carry an ETag and conditional requests are
+    answered with 304.
+
+    Args:
+        services (list): The MockService list. Defaults to `synthetic_services()`.
+        latency (float): The delay in seconds added to every response.
+        jitter (float): A random delay of up to `jitter` seconds added to every response.
+        error_rate (float): The fraction of requests answered with HTTP 500.
+        throttle_rate (float): The fraction of requests answered with HTTP 429 and a `Retry-After` header.
+        json_error_rate (float): The fraction of requests answered with HTTP 200 and an ArcGIS JSON error.
+        retry_after (float): The `Retry-After` value of throttled responses, in seconds.
+        seed (int): The seed of the error injection.
+        host (str): The interface the server listens on.
+        port (int): The port the server listens on, 0 for any free port.
+        gzip (bool): Compress JSON and PBF responses for clients accepting gzip.
+
+    Attributes:
+        stats (dict): The number of 'requests', the 'bytes' sent and the response count per 'status'.
+
+    Example:
+        with MockArcGISServer (synthetic_services(feature_count=5000)) as server:
+            arcrest2shp(server.url, 'aoi.shp', 'output_folder/')
+    """
+    def __init__ (self, services=None, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                  json_error_rate=0.0, retry_after=1, seed=0, host='127.0.0.1', port=0, gzip=True):
+        self.services = services if services is not None else synthetic_services()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.json_error_rate = json_error_rate
+        self.retry_after = retry_after
+        self.gzip = gzip
+        self.stats = {'requests': 0, 'bytes': 0, 'status': {}}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._routes = self.build_routes ()
+        self._httpd = http.server.ThreadingHTTPServer((host, port), make_handler (self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url (self):
+        """
+        str: The URL of the services root.
+        """
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/arcgis/rest/services'
+
+    def build_routes (self):
+        """
+        Map every path of the directory to its JSON document or layer.
+
+        Returns:
+            dict: The path (relative to the services root, without slashes at the ends) of every
+            folder, service, layer list and layer, mapped to a ('json', dict) or ('layer', MockLayer) tuple.
+        """
+        routes = {'': ('json', {'currentVersion': 10.91, 'folders': [], 'services': []})}
+        for service in self.services:
+            folder = service.name.rsplit('/', 1)[0] if '/' in service.name else ''
+            if folder and folder not in routes:
+                routes[''][1]['folders'].append(folder)
+                routes[folder] = ('json', {'currentVersion': 10.91, 'folders': [], 'services': []})
+            routes[folder][1]['services'].append({'name': service.name, 'type': service.type})
+            service_path = f'{service.name}/{service.type}'
+            routes[service_path] = ('json', service.to_json())
+            if service.type == 'ImageServer':
+                continue
+            routes[f'{service_path}/layers'] = ('json', {'layers': [layer.to_json(layer_id) for layer_id, layer in enumerate(service.layers)],
+                                                         'tables': []})
+            for layer_id, layer in enumerate(service.layers):
+                routes[f'{service_path}/{layer_id}'] = ('layer', layer)
+        return routes
+
+    def start (self):
+        """
+        Start serving in a background thread.
+
+        Returns:
+            MockArcGISServer: The server itself.
+        """
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever (self):
+        """
+        Serve in the calling thread until it is interrupted.
+        """
+        try:
+            self._httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._httpd.server_close()
+
+    def stop (self):
+        """
+        Stop the server and close its socket.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__ (self):
+        return self.start ()
+
+    def __exit__ (self, *exc_info):
+        self.stop ()
+
+    def record (self, status, size):
+        """
+        Count a response in the server statistics.
+
+        Args:
+            status (int): The HTTP status.
+            size (int): The size of the body in bytes.
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += size
+            self.stats['status'][status] = self.stats['status'].get(status, 0) + 1
+
+    def inject (self):
+        """
+        Draw the delay and the injected failure of a request.
+
+        Returns:
+            tuple: The delay in seconds and the failure ('error', 'throttle', 'json_error' or None).
+        """
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            draw = self._random.random()
+        failure = None
+        if draw < self.error_rate:
+            failure = 'error'
+        elif draw < self.error_rate + self.throttle_rate:
+            failure = 'throttle'
+        elif draw < self.error_rate + self.throttle_rate + self.json_error_rate:
+            failure = 'json_error'
+        return delay, failure
+
+    def respond (self, path, params):
+        """
+        Build the response to a request.
+
+        Args:
+            path (str): The URL path.
+            params (dict): The query string and form parameters.
+
+        Returns:
+            tuple: The HTTP status and the JSON body (None for 404 responses), or the encoded image of export requests.
+        """
+        match = re.search(r'/rest/services/?(.*)$', path.rstrip('/'))
+        if match is None:
+            return 404, None
+        path = match.group(1)
+        service_path, _, operation = path.rpartition('/')
+        if operation in ('exportImage', 'export') and service_path in self._routes:
+            return 200, render_image (params)
+        query = path.endswith('/query')
+        route = self._routes.get(path[:-len('/query')] if query else path)
+        if route is None:
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        kind, document = route
+        if kind == 'json':
+            return 200, document
+        if not query:
+            return 200, document.to_json(int(path.rsplit('/', 1)[-1]))
+        return 200, query_layer (document, params)
+def render_image (params):
+    """
+    Render the image of an `exportImage` or `export` request.
+
+    Pixel values are a function of the longitude and latitude of the pixel centres, so tiles of
+    the same service mosaic seamlessly. Requires rasterio.
+
+    Args:
+        params (dict): The request parameters ('bbox', 'size', 'bboxSR', 'imageSR' and 'format').
+
+    Returns:
+        bytes: A 3-band GeoTIFF ('tiff' format) or 4-band PNG (other formats), or an ArcGIS JSON error
+        if rasterio is not installed.
+    """
+    try:
+        from rasterio.io import MemoryFile
+        from rasterio.transform import from_bounds
+    except ImportError:
+        return {'error': {'code': 400, 'message': 'The mock server needs rasterio to render images', 'details': []}}
+    xmin, ymin, xmax, ymax = (float(value) for value in params['bbox'].split(','))
+    width, height = (int(value) for value in params.get('size', '400,400').split(','))
+    image_sr = params.get('imageSR') or params.get('bboxSR') or '4326'
+    columns, rows = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    x = xmin + columns * (xmax - xmin) / width
+    y = ymax - rows * (ymax - ymin) / height
+    if image_sr != '4326':
+        from pyproj import CRS, Transformer
+        crs = CRS.from_json_dict(json.loads(image_sr)) if image_sr.startswith('{') else CRS.from_user_input(int(image_sr))
+        x, y = Transformer.from_crs(crs, 4326, always_xy=True).transform(x, y)
+    bands = [(x * 10) % 256, (y * 10) % 256, (x + y) % 256]
+    tiff = params.get('format', 'png') == 'tiff'
+    if not tiff:
+        bands.append(np.full(x.shape, 255))
+    pixels = np.stack(bands).astype('uint8')
+    profile = {'driver': 'GTiff' if tiff else 'PNG', 'width': width, 'height': height, 'count': len(bands), 'dtype': 'uint8'}
+    if tiff:
+        profile.update(transform=from_bounds(xmin, ymin, xmax, ymax, width, height))
+    with MemoryFile() as memory_file:
+        with memory_file.open(**profile) as dataset:
+            dataset.write(pixels)
+        return memory_file.read()
+def query_layer (layer, params):
+    """
+    Answer a layer query.
+
+    Args:
+        layer (MockLayer): The layer.
+        params (dict): The query parameters.
+
+    Returns:
+        dict: The ids, the count or a page of features, as the ArcGIS REST API returns them
+        (bytes for `f=pbf`).
+    """
+    first, last = parse_where (params.get('where'), layer.feature_count)
+    oids = np.arange(max(first, 1), max(first, last + 1))
+    bbox = parse_geometry_filter (params)
+    if bbox is not None and len(oids):
+        coords = layer.coords()[oids - 1]
+        inside = ((coords[:, 0] >= bbox[0]) & (coords[:, 0] <= bbox[2]) &
+                  (coords[:, 1] >= bbox[1]) & (coords[:, 1] <= bbox[3]))
+        oids = oids[inside]
+    if str(params.get('returnIdsOnly')).lower() == 'true':
+        return {'objectIdFieldName': 'OBJECTID', 'objectIds': oids.tolist()}
+    if str(params.get('returnCountOnly')).lower() == 'true':
+        return {'count': int(len(oids))}
+    offset = int(params.get('resultOffset') or 0)
+    count = min(int(params.get('resultRecordCount') or layer.max_record_count), layer.max_record_count)
+    page = oids[offset:offset + count]
+    if params.get('f') == 'pbf':
+        if not layer.supports_pbf:
+            return {'error': {'code': 400, 'message': "Invalid or missing input parameters: 'f'", 'details': []}}
+        return encode_pbf_features (layer, [layer.feature(int(oid)) for oid in page], bool(len(oids) > offset + count))
+    return {
+        'objectIdFieldName': 'OBJECTID',
+        'geometryType': layer.geometry_type,
+        'spatialReference': {'wkid': 4326, 'latestWkid': 4326},
+        'features': [layer.feature(int(oid)) for oid in page],
+        'exceededTransferLimit': bool(len(oids) > offset + count),
+    }
+# Quantization step of the PBF coordinates, in degrees
+PBF_SCALE = 1e-9
+def protobuf_varint (value):
+    """
+    Encode an unsigned protobuf varint.
+    """
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+def protobuf_field (number, value):
+    """
+    Encode a protobuf field: an int as a varint, a float as a double, bytes or str as length-delimited.
+    """
+    if isinstance(value, bool) or isinstance(value, int):
+        return protobuf_varint (number << 3) + protobuf_varint (int(value))
+    if isinstance(value, float):
+        return protobuf_varint (number << 3 | 1) + struct.pack('<d', value)
+    if isinstance(value, str):
+        value = value.encode()
+    return protobuf_varint (number << 3 | 2) + protobuf_varint (len(value)) + value
+def protobuf_packed (number, values, signed=False):
+    """
+    Encode a packed repeated varint field (zigzag encoded when `signed`).
+    """
+    return protobuf_field (number, b''.join(protobuf_varint ((value << 1) ^ (value >> 63) if signed else value) for value in values))
+def encode_pbf_features (layer, features, exceeded):
+    """
+    Encode a page of features as an Esri PBF feature collection (`f=pbf`).
+
+    Coordinates are quantized with `PBF_SCALE` from the upper left corner of the layer extent, and
+    the vertices of each path or ring are delta-encoded.
+
+    Args:
+        layer (MockLayer): The layer.
+        features (list): The Esri JSON features of the page.
+        exceeded (bool): Whether more features match the query.
+
+    Returns:
+        bytes: The FeatureCollectionPBuffer message.
+    """
+    xmin, _, _, ymax = layer.extent
+    field_types = {'esriFieldTypeOID': 6, 'esriFieldTypeString': 4, 'esriFieldTypeDouble': 3}
+    fields = layer.to_json(0)['fields']
+    geometry_types = {'esriGeometryPoint': 0, 'esriGeometryPolyline': 2, 'esriGeometryPolygon': 3}
+    transform = (protobuf_field (1, 0) + protobuf_field (2, protobuf_field (1, PBF_SCALE) + protobuf_field (2, PBF_SCALE))
+                 + protobuf_field (3, protobuf_field (1, float(xmin)) + protobuf_field (2, float(ymax))))
+    result = [protobuf_field (1, 'OBJECTID'), protobuf_field (7, geometry_types[layer.geometry_type]),
+              protobuf_field (8, protobuf_field (1, 4326)), protobuf_field (9, exceeded), protobuf_field (12, transform)]
+    result += [protobuf_field (13, protobuf_field (1, item['name']) + protobuf_field (2, field_types[item['type']])) for item in fields]
+    for feature in features:
+        attributes = feature['attributes']
+        values = [protobuf_field (5, attributes['OBJECTID']), protobuf_field (1, attributes['NAME']), protobuf_field (3, float(attributes['VALUE']))]
+        geometry = feature['geometry']
+        parts = [[[geometry['x'], geometry['y']]]] if 'x' in geometry else geometry.get('paths') or geometry.get('rings')
+        coords = []
+        for part in parts:
+            previous = (0, 0)
+            for x, y in part:
+                point = (round((x - xmin) / PBF_SCALE), round((ymax - y) / PBF_SCALE))
+                coords += [point[0] - previous[0], point[1] - previous[1]]
+                previous = point
+        lengths = b'' if 'x' in geometry else protobuf_packed (2, [len(part) for part in parts])
+        body = b''.join(protobuf_field (1, value) for value in values) + protobuf_field (2, lengths + protobuf_packed (3, coords, signed=True))
+        result.append(protobuf_field (15, body))
+    query_result = protobuf_field (1, b''.join(result))
+    return protobuf_field (1, '') + protobuf_field (2, query_result)
+def make_handler (server):
+    """
+    Build the request handler class of a MockArcGISServer.
+
+    Args:
+        server (MockArcGISServer): The server answering the requests.
+
+    Returns:
+        type: A BaseHTTPRequestHandler subclass.
+    """
+    class Handler (http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET (self, form=None):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            params.update(form or {})
+            delay, failure = server.inject ()
+            if delay:
+                time.sleep(delay)
+            if failure == 'error':
+                return self.send_body (500, b'Internal Server Error', 'text/plain')
+            if failure == 'throttle':
+                return self.send_body (429, b'Too Many Requests', 'text/plain', {'Retry-After': str(server.retry_after)})
+            if failure == 'json_error':
+                status, document = 200, {'error': {'code': 503, 'message': 'Service unavailable', 'details': []}}
+            else:
+                status, document = server.respond (url.path, params)
+            if isinstance(document, bytes) and params.get('f') != 'pbf':
+                return self.send_body (status, document, 'image/tiff' if params.get('format') == 'tiff' else 'image/png')
+            body = document if isinstance(document, bytes) else json.dumps(document).encode() if document is not None else b''
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if status == 200 and self.headers.get('If-None-Match') == etag:
+                return self.send_body (304, b'', None, {'ETag': etag})
+            headers = {'ETag': etag}
+            if server.gzip and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                body = gzip.compress(body, compresslevel=5)
+                headers['Content-Encoding'] = 'gzip'
+            self.send_body (status, body, 'application/x-protobuf' if isinstance(document, bytes) else 'application/json', headers)
+
+        def do_POST (self):
+            length = int(self.headers.get('Content-Length') or 0)
+            self.do_GET (dict(parse_qsl(self.rfile.read(length).decode())))
+
+        def send_body (self, status, body, content_type, headers=None):
+            self.send_response(status)
+            if content_type:
+                self.send_header('Content-Type', content_type)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            server.record (status, len(body))
+
+        def log_message (self, *args):
+            pass
+    return Handler
+def main ():
+    """
+    Run a mock server from the command line until it is interrupted.
+    """
+    parser = argparse.ArgumentParser(description='Serve a synthetic ArcGIS REST Services Directory.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--folders', type=int, default=2)
+    parser.add_argument('--services', type=int, default=2, help='map and feature services per folder')
+    parser.add_argument('--layers', type=int, default=3, help='vector layers per service')
+    parser.add_argument('--features', type=int, default=1000, help='features per layer')
+    parser.add_argument('--max-record-count', type=int, default=1000)
+    parser.add_argument('--image-services', type=int, default=1, help='image services per folder')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    services = synthetic_services (args.folders, args.services, args.layers, args.features,
+                                   args.max_record_count, args.image_services)
+    server = MockArcGISServer (services, args.latency, args.jitter, args.error_rate, args.throttle_rate, port=args.port)
+    print(f'Serving {len(services)} services at {server.url}')
+    server.serve_forever ()
+if __name__ == '__main__':
+    main()
@@ -1,244 +1,2865 @@
 import os
-import geopandas as gpd
-from shapely.geometry import Polygon
-import subprocess
+import importlib
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+import requests.adapters
 import re
 import csv
 import datetime
+import fnmatch
 import concurrent.futures
+import collections
+import contextlib
+import itertools
+import json
+import math
+import multiprocessing
+import hashlib
+import io
+import sqlite3
+import struct
+import queue
+import threading
 import time
+import random
 import warnings
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode, urlsplit
+from dataclasses import dataclass, field
+
+class LazyModule:
+    """
+    A module imported on first attribute access.
+
+    The GIS stack (geopandas, pandas, numpy, shapely) takes seconds to import. Deferring it lets
+    discovery and catalog export start quickly and run on machines where it is not installed.
+
+    Args:
+        name (str): The name of the module.
+    """
+    def __init__ (self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__ (self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+gpd = LazyModule ('geopandas')
+pd = LazyModule ('pandas')
+np = LazyModule ('numpy')
+shapely = LazyModule ('shapely')
 
 def create_folder (out_path, folder_name='extracted_data'):
     """
-    Create a folder in the specified output path.
+    Create a folder in the specified output path.
+
+    Args:
+        out_path (str): Output path where the folder will be created.
+        folder_name (str): Name of the folder to be created.
+
+    Returns:
+        str: Export path of the created folder.
+
+    Raises:
+        OSError: If there is an error creating the folder.
+    """
+    export_path = os.path.join(out_path, folder_name)
+    try:
+        # Create the folder
+        os.makedirs(export_path, exist_ok=True)
+        print(f"Folder created: {export_path}")
+    except FileExistsError:
+        print('Folder already exists', export_path)
+    return export_path
+@dataclass
+class ServiceInfo:
+    """
+    A service discovered in an ArcGIS REST Services Directory.
+
+    Attributes:
+        name (str): The service name including its folder, e.g. 'Folder/Service'.
+        type (str): The service type, e.g. 'MapServer', 'FeatureServer' or 'ImageServer'.
+        url (str): The URL of the service.
+        metadata (dict): The JSON description of the service.
+    """
+    name: str
+    type: str
+    url: str
+    metadata: dict = field(default_factory=dict, repr=False)
+@dataclass
+class LayerInfo:
+    """
+    A vector or raster layer discovered in an ArcGIS REST Services Directory.
+
+    Attributes:
+        url (str): The URL of the layer.
+        service_url (str): The URL of the service that publishes the layer.
+        id (int): The layer id within the service (None for ImageServer services).
+        name (str): The layer name.
+        type (str): The layer type as 'Vector' or 'Raster'.
+        geometry_type (str): The esriGeometry type of vector layers.
+        crs (int): The well-known id of the layer spatial reference.
+        extent (dict): The extent of the layer with its spatial reference.
+        description (str): The layer description.
+        max_record_count (int): The maximum number of features returned by a query.
+        feature_count (int): The number of features, when counted (None otherwise).
+        metadata (dict): The JSON description of the layer.
+    """
+    url: str
+    service_url: str
+    id: int
+    name: str
+    type: str
+    geometry_type: str = None
+    crs: int = None
+    extent: dict = field(default=None, repr=False)
+    description: str = field(default='', repr=False)
+    max_record_count: int = None
+    feature_count: int = None
+    metadata: dict = field(default_factory=dict, repr=False)
+@dataclass
+class Catalog:
+    """
+    The services and layers found under a base URL.
+
+    Attributes:
+        services (list): A list of ServiceInfo.
+        layers (list): A list of LayerInfo.
+        skipped (collections.Counter): The number of items not visited, by reason ('name' or 'extent').
+    """
+    services: list = field(default_factory=list)
+    layers: list = field(default_factory=list)
+    skipped: collections.Counter = field(default_factory=collections.Counter)
+# HTTP status codes worth retrying: throttling and transient server errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# ArcGIS error codes of a JSON body worth retrying: a code 500 there usually reports a permanent
+# query error (invalid where clause, unsupported spatial filter...) rather than an overloaded server
+RETRY_JSON_ERRORS = (429, 502, 503, 504)
+# ArcGIS error bodies are objects whose first key is 'error'
+JSON_ERROR_PREFIX = re.compile(rb'\s*\{\s*"error"\s*:')
+class HostLimiter:
+    """
+    A token-bucket rate limiter with AIMD concurrency control for one host.
+
+    The concurrency limit grows additively (about one more request in flight per round of
+    successful requests) while responses are healthy, and is halved (multiplicative decrease)
+    on 429/5xx responses, connection errors or when the recent latency rises well above its
+    long-term average. The request rate, when capped, adapts the same way. Latencies are averaged
+    per kind of request (see `request_kind`), so a feature page slower than the metadata requests
+    before it is not mistaken for congestion.
+
+    Args:
+        max_concurrency (int): The ceiling of requests in flight.
+        max_rate (float): The ceiling of requests per second. No rate limit if None.
+        initial_concurrency (int): The starting concurrency limit. Defaults to a quarter of `max_concurrency` (at least 2).
+        min_concurrency (int): The floor of requests in flight.
+        latency_factor (float): A recent latency this many times the long-term average counts as congestion.
+        cooldown (float): The minimum time in seconds between two decreases.
+    """
+    def __init__ (self, max_concurrency, max_rate=None, initial_concurrency=None, min_concurrency=1,
+                  latency_factor=3.0, cooldown=2.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(min(max_concurrency, initial_concurrency or max(2, max_concurrency // 4)))
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        # The recent and long-term latency of each kind of request
+        self.latency = {}
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._condition = threading.Condition()
+
+    def acquire (self):
+        """
+        Wait for a free concurrency slot and a rate token.
+        """
+        with self._condition:
+            while self.in_flight >= max(self.min_concurrency, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+            delay = 0.0
+            if self.rate:
+                # Refill the bucket, then reserve a token (the balance may go negative)
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                self.tokens -= 1
+                delay = max(0.0, -self.tokens / self.rate)
+        if delay:
+            time.sleep(delay)
+
+    def release (self, latency, status, kind='metadata'):
+        """
+        Free a slot and adapt the limits to the outcome of the request.
+
+        Args:
+            latency (float): The duration of the request in seconds.
+            status (int): The HTTP status, None for connection errors and timeouts.
+            kind (str): The kind of request, compared with the latency of the same kind only (see `request_kind`).
+        """
+        with self._condition:
+            self.in_flight -= 1
+            congested = status is None or status in RETRY_STATUS
+            if not congested:
+                # Fast and slow moving averages of the latency of successful requests
+                averages = self.latency.setdefault(kind, [latency, latency])
+                averages[0] += 0.3 * (latency - averages[0])
+                averages[1] += 0.02 * (latency - averages[1])
+                congested = averages[0] > self.latency_factor * averages[1]
+            now = time.monotonic()
+            if congested:
+                # Multiplicative decrease, at most once per cooldown period
+                if now - self._decreased > self.cooldown:
+                    self._decreased = now
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    if self.rate:
+                        self.rate = max(self.max_rate / 100, self.rate / 2)
+                    # Restart the latency averages from the current level
+                    for averages in self.latency.values():
+                        averages[1] = averages[0]
+            else:
+                # Additive increase: about one more slot once `limit` requests succeeded
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+                if self.rate:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+            self._condition.notify_all()
+
+    def snapshot (self):
+        """
+        Return the current state of the limiter.
+
+        Returns:
+            dict: The concurrency 'limit', the request 'rate' and the requests 'in_flight'.
+        """
+        with self._condition:
+            return {'limit': round(self.limit, 2), 'rate': self.rate, 'in_flight': self.in_flight}
+class AdaptiveLimiter:
+    """
+    Per-host `HostLimiter`s shared by the crawler and the downloader.
+
+    Args:
+        max_concurrency (int): The ceiling of requests in flight per host.
+        max_rate (float): The ceiling of requests per second per host. No rate limit if None.
+        **kwargs: Additional keyword arguments passed to `HostLimiter`.
+    """
+    def __init__ (self, max_concurrency=16, max_rate=None, **kwargs):
+        self.max_concurrency = max_concurrency
+        self.max_rate = max_rate
+        self.kwargs = kwargs
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def host (self, url):
+        """
+        Return the limiter of the host of a URL, creating it on first use.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            HostLimiter: The limiter of the host.
+        """
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter (self.max_concurrency, self.max_rate, **self.kwargs)
+            return self.hosts[host]
+
+    def snapshot (self):
+        """
+        Return the current state of the limiter of every host.
+
+        Returns:
+            dict: The `HostLimiter.snapshot` of every host, keyed by host.
+        """
+        with self._lock:
+            hosts = dict(self.hosts)
+        return {host: limiter.snapshot () for host, limiter in hosts.items()}
+class HttpTransport:
+    """
+    A pooled keep-alive HTTP session shared by the crawler and the downloader.
+
+    Requests are retried on connection errors, timeouts, truncated or undecodable bodies and 429/5xx
+    responses (including transient ArcGIS errors reported inside a JSON body) with jittered exponential backoff. A `Retry-After` header
+    is honoured, and each request gives up once it has used `max_retries` retries or waited
+    `retry_budget` seconds in total. Every attempt goes through the per-host adaptive limiter,
+    which adjusts concurrency and request rate to how the server responds.
+
+    Args:
+        num_threads (int): The number of connections kept alive per host.
+        connect_timeout (float): The connect timeout in seconds.
+        read_timeout (float): The read timeout in seconds.
+        max_retries (int): The maximum number of retries per request.
+        backoff_base (float): The backoff in seconds before the first retry, doubled on each retry.
+        backoff_max (float): The maximum backoff in seconds between two attempts.
+        retry_budget (float): The maximum total time in seconds a request may spend waiting between retries.
+        cache_dir (str): A directory where JSON responses requested with `cache=True` are kept and
+            revalidated with ETag/Last-Modified conditional requests. Disabled if None.
+        max_url_length (int): JSON requests whose URL would be longer are sent as POST form data.
+        limiter (AdaptiveLimiter): The per-host rate and concurrency limiter. Defaults to an
+            AdaptiveLimiter with `num_threads` requests in flight per host at most.
+        metrics (RunMetrics): Records every request (status, bytes, time, retries). Disabled if None.
+
+    Attributes:
+        retry_stats (dict): For every URL that needed retries, a dict with the number of
+            'retries' and the total 'wait' time in seconds.
+        cache_stats (dict): The number of cached responses 'revalidated' (304) and 'fetched' (200).
+    """
+    def __init__ (self, num_threads=10, connect_timeout=10, read_timeout=120, max_retries=8,
+                  backoff_base=0.5, backoff_max=30, retry_budget=120, cache_dir=None, max_url_length=2000, limiter=None, metrics=None):
+        self.session = requests.Session()
+        # Keep one connection per worker alive instead of a new TCP/TLS handshake per request
+        adapter = requests.adapters.HTTPAdapter(pool_connections=num_threads, pool_maxsize=num_threads, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self.retry_stats = {}
+        self.cache_dir = cache_dir
+        self.max_url_length = max_url_length
+        self.limiter = limiter or AdaptiveLimiter (num_threads)
+        self.metrics = metrics
+        self.cache_stats = {'revalidated': 0, 'fetched': 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def backoff (self, attempt, retry_after=None):
+        """
+        Compute the wait before the next attempt.
+
+        Args:
+            attempt (int): The number of retries already made.
+            retry_after (str): The value of the `Retry-After` response header, if any.
+
+        Returns:
+            float: The wait time in seconds.
+        """
+        # Full jitter spreads the retries of concurrent workers
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after:
+            try:
+                # Retry-After is either a number of seconds or an HTTP date
+                server_delay = float(retry_after)
+            except ValueError:
+                try:
+                    server_delay = (parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    server_delay = 0
+            delay = max(delay, server_delay)
+        return delay
+
+    def request (self, method, url, params=None, data=None, retry_json_errors=False, layer_url=None, **kwargs):
+        """
+        Send a request, retrying transient failures.
+
+        Args:
+            method (str): The HTTP method ('GET' or 'POST').
+            url (str): The URL to request.
+            params (dict): The query string parameters.
+            data (dict): The form data of POST requests.
+            retry_json_errors (bool): Also retry ArcGIS errors with a transient code (`RETRY_JSON_ERRORS`) inside
+                a JSON body. They are not reported to the limiter as congestion.
+            layer_url (str): The layer the request is counted against in the metrics, when it cannot be
+                told from the URL (see `RunMetrics.request`).
+            **kwargs: Additional keyword arguments passed to `requests.Session.request`.
+
+        Returns:
+            requests.Response: The last response received, or None if no response could be obtained.
+        """
+        attempt = 0
+        waited = 0.0
+        request_started = time.perf_counter()
+        kind = request_kind (url, params if params is not None else data, layer_url)
+        while True:
+            response = None
+            retry_after = None
+            status = None
+            # Wait for the host limiter, then report the outcome so it can adapt
+            host_limiter = self.limiter.host (url)
+            host_limiter.acquire ()
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, params=params, data=data, timeout=self.timeout, **kwargs)
+                status = response.status_code
+                if status == 200 and retry_json_errors:
+                    # The request succeeded as far as the limiter is concerned, only transient ArcGIS errors are retried
+                    if json_error_code (response) not in RETRY_JSON_ERRORS:
+                        break
+                elif status not in RETRY_STATUS:
+                    break
+                retry_after = response.headers.get('Retry-After')
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError):
+                # Truncated or corrupted bodies are as transient as dropped connections
+                pass
+            finally:
+                host_limiter.release (time.monotonic() - started, status, kind)
+            delay = self.backoff (attempt, retry_after)
+            # Stop when the retry count or the wait budget of this request is exhausted
+            if attempt >= self.max_retries or waited + delay > self.retry_budget:
+                print('Max_retries achieved for the following url: ', url)
+                break
+            time.sleep(delay)
+            waited += delay
+            attempt += 1
+
+        if attempt:
+            with self._lock:
+                stats = self.retry_stats.setdefault(url, {'retries': 0, 'wait': 0.0})
+                stats['retries'] += attempt
+                stats['wait'] += waited
+        if self.metrics is not None:
+            self.metrics.request (url, response.status_code if response is not None else None,
+                                  response_size (response), time.perf_counter() - request_started, attempt, layer_url)
+        return response
+
+    def get (self, url, params=None, **kwargs):
+        """
+        Send a GET request, retrying transient failures. See `request`.
+        """
+        return self.request ('GET', url, params=params, **kwargs)
+
+    def post (self, url, data=None, **kwargs):
+        """
+        Send a POST request, retrying transient failures. See `request`.
+        """
+        return self.request ('POST', url, data=data, **kwargs)
+
+    def get_json (self, url, params=None, cache=False):
+        """
+        Request the JSON representation of an ArcGIS REST resource.
+
+        Requests whose URL would exceed `max_url_length` are sent as POST form data.
+
+        Args:
+            url (str): The URL of the resource.
+            params (dict): Additional query parameters. 'f=json' is always added.
+            cache (bool): Keep the response in `cache_dir` and revalidate it on later requests.
+
+        Returns:
+            dict: The decoded JSON response, or None if the request failed.
+        """
+        params = {**(params or {}), 'f': 'json'}
+        if len(url) + len(urlencode(params)) > self.max_url_length:
+            # Large parameters (e.g. an AOI polygon) do not fit in a URL
+            response = self.post (url, data=params, retry_json_errors=True)
+            return decode_json_response (url, response)
+        if cache and self.cache_dir:
+            return self.get_cached_json (url, params)
+        response = self.get (url, params=params, retry_json_errors=True)
+        return decode_json_response (url, response)
+
+    def get_binary (self, url, params=None):
+        """
+        Request a binary representation of an ArcGIS REST resource (e.g. `f=pbf`).
+
+        Requests whose URL would exceed `max_url_length` are sent as POST form data.
+
+        Args:
+            url (str): The URL of the resource.
+            params (dict): The query parameters, including the format 'f'.
+
+        Returns:
+            bytes: The response body, or None if the request failed.
+        """
+        if len(url) + len(urlencode(params or {})) > self.max_url_length:
+            response = self.post (url, data=params, retry_json_errors=True)
+        else:
+            response = self.get (url, params=params, retry_json_errors=True)
+        if response is None:
+            return None
+        if response.status_code != 200:
+            print(url, "\nRequest failed with status code:", response.status_code)
+            return None
+        return response.content
+
+    def get_cached_json (self, url, params):
+        """
+        Request a JSON resource through the on-disk cache with a conditional request.
+
+        Args:
+            url (str): The URL of the resource.
+            params (dict): The query parameters.
+
+        Returns:
+            dict: The decoded JSON response, or None if the request failed.
+        """
+        key = hashlib.sha256(json.dumps([url, sorted(params.items())], default=str).encode()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, f'{key}.json')
+        entry = None
+        headers = {}
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path) as cache_file:
+                    entry = json.load(cache_file)
+            except (OSError, ValueError):
+                entry = None
+        # Revalidate the cached copy instead of downloading it again
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.get (url, params=params, headers=headers, retry_json_errors=True)
+        if entry and response is not None and response.status_code == 304:
+            with self._lock:
+                self.cache_stats['revalidated'] += 1
+            return entry['data']
+
+        data = decode_json_response (url, response)
+        etag = response.headers.get('ETag') if data is not None else None
+        last_modified = response.headers.get('Last-Modified') if data is not None else None
+        if etag or last_modified:
+            # Write to a temporary file first so concurrent readers never see a partial entry
+            temp_path = f'{cache_path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'w') as cache_file:
+                json.dump({'url': url, 'etag': etag, 'last_modified': last_modified, 'data': data}, cache_file)
+            os.replace(temp_path, cache_path)
+        with self._lock:
+            self.cache_stats['fetched'] += 1
+        return data
+def response_size (response):
+    """
+    Return the number of bytes of a response body as transferred (compressed if the server gzipped it).
+
+    Args:
+        response (requests.Response): The response, or None if no response was obtained.
+
+    Returns:
+        int: The size in bytes.
+    """
+    if response is None:
+        return 0
+    content = response.content
+    try:
+        # Bytes read from the connection, before decompression
+        return int(response.raw.tell()) or len(content)
+    except (AttributeError, TypeError, ValueError):
+        return len(content)
+def decode_json_response (url, response):
+    """
+    Decode an ArcGIS REST JSON response, reporting failures.
+
+    Args:
+        url (str): The URL of the resource.
+        response (requests.Response): The response, or None if no response was obtained.
+
+    Returns:
+        dict: The decoded JSON response, or None if the request failed.
+    """
+    if response is None:
+        return None
+    # Check if the request was successful (HTTP status code 200)
+    if response.status_code != 200:
+        print(url, "\nRequest failed with status code:", response.status_code)
+        return None
+    try:
+        data = response.json()
+    except ValueError:
+        print(url, "\nRequest did not return JSON")
+        return None
+    # ArcGIS reports errors inside a successful response
+    if 'error' in data:
+        print(url, "\nRequest failed with error:", data['error'])
+        return None
+    return data
+def request_layer (url, layer_url=None):
+    """
+    Return the layer a request is made for: queries ('<layer>/query') and image exports ('<image service>/exportImage',
+    or '<map service>/export' with its `layer_url`).
+
+    Args:
+        url (str): The requested URL.
+        layer_url (str): The layer of the request, if it cannot be told from the URL.
+
+    Returns:
+        str: The URL of the layer, or None for crawl requests.
+    """
+    for suffix in ('/query', '/exportImage'):
+        if layer_url is None and url.endswith(suffix):
+            layer_url = url[:-len(suffix)]
+    return layer_url
+def request_kind (url, params=None, layer_url=None):
+    """
+    Classify a request by its expected cost, for the latency averages of the limiter.
+
+    Args:
+        url (str): The requested URL.
+        params (dict): The query string or form parameters.
+        layer_url (str): The layer of the request, if it cannot be told from the URL.
+
+    Returns:
+        str: 'features' (query pages and image tiles) or 'metadata' (descriptions, counts and object id lists).
+    """
+    params = params or {}
+    if request_layer (url, layer_url) is None or params.get('returnCountOnly') or params.get('returnIdsOnly'):
+        return 'metadata'
+    return 'features'
+def json_error_code (response):
+    """
+    Return the code of an ArcGIS error reported inside a JSON response body.
+
+    Args:
+        response (requests.Response): The response to inspect.
+
+    Returns:
+        int: The error code, or None if the body is not a JSON error.
+    """
+    # Only error bodies are decoded, not feature pages (decoded once by the caller) or binary bodies (PBF, images)
+    if not JSON_ERROR_PREFIX.match(response.content[:64]):
+        return None
+    try:
+        error = response.json().get('error')
+        return int(error.get('code')) if error else None
+    except (ValueError, AttributeError, TypeError):
+        return None
+def new_stats ():
+    """
+    Return an empty measurement of a task: the wall time per stage and the feature counts.
+
+    Returns:
+        dict: A dict with 'stages' (stage name mapped to seconds), 'features_in' and 'features_out'.
+    """
+    return {'stages': {}, 'features_in': 0, 'features_out': 0}
+@contextlib.contextmanager
+def timed (stats, stage):
+    """
+    Add the wall time of a block to a stage of a measurement.
+
+    Args:
+        stats (dict): The measurement (see `new_stats`).
+        stage (str): The stage name.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats['stages'][stage] = stats['stages'].get(stage, 0.0) + time.perf_counter() - started
+def merge_stats (total, stats):
+    """
+    Add a measurement to another one.
+
+    Args:
+        total (dict): The measurement updated in place.
+        stats (dict): The measurement to add.
+    """
+    for stage, seconds in stats['stages'].items():
+        total['stages'][stage] = total['stages'].get(stage, 0.0) + seconds
+    total['features_in'] += stats['features_in']
+    total['features_out'] += stats['features_out']
+class RunMetrics:
+    """
+    Per-layer and per-stage instrumentation of a run.
+
+    Records the wall time of every stage (crawl, query, read, decode, reproject, clip, write), the
+    HTTP requests, bytes and retries, and the features in and out of each layer. Measurements made
+    in the CPU stage are returned with the task results and added with `add`. The run report is
+    written as JSON (totals, stages, slowest layers) and NDJSON (one line per layer).
+
+    Args:
+        hooks (iterable): Callables receiving every event as a dict, e.g. to feed a metrics sink:
+            {'event': 'stage', 'stage', 'url', 'seconds'} and
+            {'event': 'request', 'url', 'status', 'bytes', 'seconds', 'retries'}.
+            Exceptions raised by hooks are turned into warnings.
+        profiler (callable): A function `profiler(stage, url)` returning a context manager wrapped around
+            every stage timed in the download threads (e.g. to run cProfile on selected stages).
+    """
+    def __init__ (self, hooks=(), profiler=None):
+        self.hooks = list(hooks)
+        self.profiler = profiler
+        self.started = time.time()
+        self.layers = {}
+        self.stages = {}
+        self.requests = {kind: {'requests': 0, 'bytes': 0, 'seconds': 0.0, 'retries': 0, 'errors': 0}
+                         for kind in ('crawl', 'query')}
+        self._lock = threading.Lock()
+
+    def layer (self, url, **fields):
+        """
+        Create or update the record of a layer.
+
+        Args:
+            url (str): The URL of the layer.
+            **fields: Fields of the record to set, e.g. 'name', 'type' or 'state'.
+
+        Returns:
+            dict: The record of the layer.
+        """
+        with self._lock:
+            record = self.layers.get(url)
+            if record is None:
+                record = self.layers[url] = {
+                    'url': url, 'name': None, 'type': None, 'state': None, 'seconds': 0.0, 'stages': {},
+                    'features_in': 0, 'features_out': 0, 'requests': 0, 'bytes': 0, 'retries': 0, 'errors': 0,
+                }
+            record.update(fields)
+            return record
+
+    @contextlib.contextmanager
+    def stage (self, stage, url=None):
+        """
+        Time a stage run in the calling thread.
+
+        Args:
+            stage (str): The stage name.
+            url (str): The URL of the layer, None for run-wide stages such as the crawl.
+        """
+        stats = new_stats ()
+        try:
+            with timed (stats, stage), (self.profiler (stage, url) if self.profiler else contextlib.nullcontext()):
+                yield
+        finally:
+            self.add (url, stats)
+
+    def add (self, url, stats):
+        """
+        Add a measurement (see `new_stats`) to a layer and to the stage totals.
+
+        Args:
+            url (str): The URL of the layer, None for run-wide stages.
+            stats (dict): The measurement.
+        """
+        record = self.layer (url) if url else None
+        with self._lock:
+            for stage, seconds in stats['stages'].items():
+                totals = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                totals['calls'] += 1
+                totals['seconds'] += seconds
+                totals['max_seconds'] = max(totals['max_seconds'], seconds)
+                if record is not None:
+                    record['stages'][stage] = record['stages'].get(stage, 0.0) + seconds
+                    record['seconds'] += seconds
+            if record is not None:
+                record['features_in'] += stats['features_in']
+                record['features_out'] += stats['features_out']
+        for stage, seconds in stats['stages'].items():
+            self.emit ({'event': 'stage', 'stage': stage, 'url': url, 'seconds': seconds})
+
+    def request (self, url, status, size, seconds, retries, layer_url=None):
+        """
+        Record an HTTP request. Queries ('<layer>/query') and image exports ('<image service>/exportImage',
+        or '<map service>/export' with its `layer_url`) are counted against their layer.
+
+        Args:
+            url (str): The requested URL.
+            status (int): The final HTTP status, None if no response was obtained.
+            size (int): The size of the response body in bytes.
+            seconds (float): The wall time of the request, retries included.
+            retries (int): The number of retries.
+            layer_url (str): The layer of the request, if it cannot be told from the URL.
+        """
+        layer_url = request_layer (url, layer_url)
+        record = self.layer (layer_url) if layer_url else None
+        failed = status is None or status >= 400
+        with self._lock:
+            totals = self.requests['query' if layer_url else 'crawl']
+            totals['seconds'] += seconds
+            for counts in (totals, record) if record is not None else (totals,):
+                counts['requests'] += 1
+                counts['bytes'] += size
+                counts['retries'] += retries
+                counts['errors'] += failed
+        self.emit ({'event': 'request', 'url': url, 'status': status, 'bytes': size, 'seconds': seconds, 'retries': retries})
+
+    def emit (self, event):
+        """
+        Pass an event to the hooks.
+        """
+        for hook in self.hooks:
+            try:
+                hook (event)
+            except Exception as e:
+                warnings.warn(f'Metrics hook {hook!r} failed: {e}')
+
+    def report (self, top=20, transport=None):
+        """
+        Summarise the run.
+
+        Args:
+            top (int): The number of slowest layers listed.
+            transport (HttpTransport): The transport of the run, its final per-host limits and the use of
+                its response cache are reported.
+
+        Returns:
+            dict: The run totals, the stage totals (slowest first), the layer count per state, the slowest
+            layers and, with a `transport`, the final concurrency limit and rate of every host and the number
+            of cached responses revalidated and fetched.
+        """
+        with self._lock:
+            layers = [dict(record, stages=dict(record['stages'])) for record in self.layers.values()]
+            stages = {stage: dict(totals) for stage, totals in self.stages.items()}
+            requests = {kind: dict(totals) for kind, totals in self.requests.items()}
+        states = collections.Counter(record['state'] for record in layers)
+        slowest = sorted(layers, key=lambda record: record['seconds'], reverse=True)[:top]
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'seconds': round(time.time() - self.started, 3),
+            'requests': requests,
+            'stages': dict(sorted(stages.items(), key=lambda item: item[1]['seconds'], reverse=True)),
+            'layers': {'count': len(layers), 'states': dict(states),
+                       'features_in': sum(record['features_in'] for record in layers),
+                       'features_out': sum(record['features_out'] for record in layers)},
+            'slowest_layers': [{'url': record['url'], 'name': record['name'], 'seconds': round(record['seconds'], 3),
+                                'stages': {stage: round(seconds, 3) for stage, seconds in record['stages'].items()}}
+                               for record in slowest],
+            **({'hosts': transport.limiter.snapshot (), 'cache': dict(transport.cache_stats)} if transport is not None else {}),
+        }
+
+    def write_report (self, export_path, transport=None):
+        """
+        Write the run report ('run_report.json') and the layer records ('run_report.ndjson').
+
+        Args:
+            export_path (str): The directory path where the report is saved.
+            transport (HttpTransport): The transport of the run (see `report`).
+
+        Returns:
+            str: The file path of the JSON report.
+        """
+        report_path = os.path.join(export_path, 'run_report.json')
+        with open(report_path, 'w') as report_file:
+            json.dump(self.report (transport=transport), report_file, indent=2, default=str)
+        with self._lock:
+            layers = list(self.layers.values())
+        with open(os.path.join(export_path, 'run_report.ndjson'), 'w') as ndjson_file:
+            for record in layers:
+                ndjson_file.write(json.dumps(record, default=str) + '\n')
+        return report_path
+def write_retry_log (export_path, transport):
+    """
+    Write the retries and total wait time of every URL that needed retries to 'retry_log.csv'.
+
+    Args:
+        export_path (str): The directory path where the CSV file will be saved.
+        transport (HttpTransport): The transport whose retry statistics are written.
+
+    Returns:
+        str: The path of the CSV file.
+    """
+    csv_path = os.path.join(export_path, 'retry_log.csv')
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['URL', 'Retries', 'Wait (s)', 'Extraction Date'])
+        for url, stats in sorted(transport.retry_stats.items()):
+            writer.writerow([url, stats['retries'], round(stats['wait'], 3), datetime.date.today()])
+    return csv_path
+def services_root (url):
+    """
+    Return the root of the services directory ('.../rest/services') that contains a URL.
+
+    Args:
+        url (str): Any URL inside an ArcGIS REST Services Directory.
+
+    Returns:
+        str: The services directory root URL.
+    """
+    # Service names returned by a folder are relative to the services root
+    match = re.search(r'/rest/services', url, flags=re.IGNORECASE)
+    if match is None:
+        return url.rstrip('/')
+    return url[:match.end()]
+def service_url_type (url):
+    """
+    Return the service type when a URL points at a service, or None otherwise.
+
+    Args:
+        url (str): The URL to check.
+
+    Returns:
+        str: The service type (e.g. 'MapServer'), or None if the URL is not a service.
+    """
+    match = re.search(r'/(MapServer|FeatureServer|ImageServer)/?$', url, flags=re.IGNORECASE)
+    return match.group(1) if match else None
+@dataclass
+class CrawlFilter:
+    """
+    Name patterns restricting the crawl, so that unwanted folders, services and layers are never requested.
+
+    Patterns are shell-style wildcards (fnmatch), matched case-insensitively against:
+        - folders: the folder path relative to the services root, e.g. 'Boundaries' or 'Boundaries/Admin';
+        - services: the service name with its folder and type, e.g. 'Boundaries/LGA_FS/MapServer';
+        - layers: the layer name, e.g. 'Local Government Areas (LGATE-233)'.
+    An item is kept when it matches one of the `include` patterns of its level (or none are given)
+    and none of the `exclude` patterns. Skipped folders and services are not descended into.
+
+    Attributes:
+        include_folders (tuple): The folders to visit.
+        exclude_folders (tuple): The folders to skip.
+        include_services (tuple): The services to visit.
+        exclude_services (tuple): The services to skip. By default the '..._FS/MapServer' services,
+            which duplicate the feature services of the DataWA (SLIP) servers.
+        include_layers (tuple): The layers to keep.
+        exclude_layers (tuple): The layers to skip.
+    """
+    include_folders: tuple = ()
+    exclude_folders: tuple = ()
+    include_services: tuple = ()
+    exclude_services: tuple = ('*FS/MapServer',)
+    include_layers: tuple = ()
+    exclude_layers: tuple = ()
+
+    def accepts (self, level, name):
+        """
+        Check a folder, service or layer name against the patterns of its level.
+
+        Args:
+            level (str): 'folders', 'services' or 'layers'.
+            name (str): The name to check.
+
+        Returns:
+            bool: True if the item should be crawled.
+        """
+        name = (name or '').lower()
+        include = getattr(self, f'include_{level}')
+        if include and not any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in include):
+            return False
+        return not any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in getattr(self, f'exclude_{level}'))
+def extent_intersects_aoi (extent, aoi):
+    """
+    Check whether an Esri extent intersects the envelope of the area of interest.
+
+    The AOI is reprojected to the spatial reference of the extent (once per CRS, see `AoiCache`).
+    Missing or invalid extents and unknown spatial references are treated as intersecting, so
+    that nothing is pruned by mistake.
+
+    Args:
+        extent (dict): The Esri JSON extent ('xmin', 'ymin', 'xmax', 'ymax' and 'spatialReference').
+        aoi (AoiCache): The area of interest. Nothing is pruned if None.
+
+    Returns:
+        bool: False only if the extent is known not to intersect the AOI.
+    """
+    if not extent or aoi is None:
+        return True
+    spatial_reference = extent.get('spatialReference') or {}
+    crs = spatial_reference.get('latestWkid') or spatial_reference.get('wkid') or spatial_reference.get('wkt')
+    try:
+        values = [float(extent[name]) for name in ('xmin', 'ymin', 'xmax', 'ymax')]
+    except (KeyError, TypeError, ValueError):
+        return True
+    if crs is None or not all(math.isfinite(value) for value in values):
+        return True
+    try:
+        projection = aoi.get(crs)
+    except Exception:
+        # The CRS is unknown to PROJ (e.g. a custom WKT)
+        return True
+    if not all(math.isfinite(value) for value in projection.bounds):
+        return True
+    return shapely.box(*values).intersects(projection.envelope)
+def service_extent (service_json):
+    """
+    Return the extent of a service from its JSON description.
+
+    Args:
+        service_json (dict): The JSON description of the service.
+
+    Returns:
+        dict: The 'fullExtent', 'extent' or 'initialExtent' of the service, or None.
+    """
+    return service_json.get('fullExtent') or service_json.get('extent') or service_json.get('initialExtent')
+def layer_from_json (layer_json, layer_url, service_url):
+    """
+    Build a LayerInfo from the JSON description of a layer.
+
+    Args:
+        layer_json (dict): The JSON description of the layer.
+        layer_url (str): The URL of the layer.
+        service_url (str): The URL of the service that publishes the layer.
+
+    Returns:
+        LayerInfo: The layer, or None if it is neither a vector nor a raster layer (e.g. group layers or tables).
+    """
+    layer_type = check_layer_type (layer_json)
+    if layer_type is None:
+        return None
+    return LayerInfo(
+        url=layer_url,
+        service_url=service_url,
+        id=layer_json.get('id'),
+        name=layer_json.get('name', ''),
+        type=layer_type,
+        geometry_type=layer_json.get('geometryType'),
+        crs=layer_crs (layer_json),
+        extent=layer_json.get('extent'),
+        description=(layer_json.get('description') or '').strip(),
+        max_record_count=layer_json.get('maxRecordCount'),
+        metadata=layer_json,
+    )
+def crawl_task (transport, kind, url, root, aoi=None, crawl_filter=None):
+    """
+    Fetch one node of the services directory and return its children.
+
+    Folders, services and layers rejected by `crawl_filter`, and services and layers whose extent does
+    not intersect the AOI, are left out, so their subtrees are never requested. The layers of a map or
+    feature service are all described by one request to its `layers` resource (one request per layer
+    if it is not available). An image service is a single raster layer described by the service
+    itself, so it is not requested twice.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        kind (str): The node kind: 'folder', 'service' or 'layer'.
+        url (str): The URL of the node.
+        root (str): The services directory root URL.
+        aoi (AoiCache): The area of interest used to prune services and layers by extent. No pruning if None.
+        crawl_filter (CrawlFilter): The name patterns of the items to visit. Everything is visited if None.
+
+    Returns:
+        tuple: A tuple containing three elements:
+            - list: The discovered ServiceInfo and LayerInfo items.
+            - list: A list of (kind, url) children to visit.
+            - collections.Counter: The number of items skipped, by reason ('name' or 'extent').
+    """
+    crawl_filter = crawl_filter or CrawlFilter(exclude_services=())
+    skipped = collections.Counter()
+    data = transport.get_json (url, cache=True)
+    if data is None:
+        return [], [], skipped
+
+    if kind == 'folder':
+        # Folders list sub-folders by name and services by 'Folder/Name' relative to the root
+        children = []
+        for folder in data.get('folders', []):
+            folder_url = f"{url.rstrip('/')}/{folder.split('/')[-1]}"
+            if crawl_filter.accepts ('folders', folder_url[len(root):].strip('/')):
+                children.append(('folder', folder_url))
+            else:
+                skipped['name'] += 1
+        for service in data.get('services', []):
+            if service.get('type') not in ('MapServer', 'FeatureServer', 'ImageServer'):
+                continue
+            if crawl_filter.accepts ('services', f"{service['name']}/{service['type']}"):
+                children.append(('service', f"{root}/{service['name']}/{service['type']}"))
+            else:
+                skipped['name'] += 1
+        return [], children, skipped
+
+    if kind == 'service':
+        # Do not descend into services outside the area of interest
+        if not extent_intersects_aoi (service_extent (data), aoi):
+            skipped['extent'] += 1
+            return [], [], skipped
+        service_type = service_url_type (url)
+        service = ServiceInfo(name=url[len(root):].strip('/').rsplit('/', 1)[0], type=service_type, url=url, metadata=data)
+        # An image service is a single raster layer
+        if service_type == 'ImageServer':
+            layer = layer_from_json ({**data, 'type': 'Raster Layer'}, url, url)
+            return [service] + ([layer] if layer else []), [], skipped
+        # One request describes every layer of the service
+        layers_json = transport.get_json (f"{url.rstrip('/')}/layers", cache=True)
+        if layers_json is not None and 'layers' in layers_json:
+            items = [service]
+            for layer_json in layers_json['layers']:
+                # Group layers have no features, their sub-layers are listed separately
+                if layer_json.get('subLayerIds'):
+                    continue
+                if not crawl_filter.accepts ('layers', layer_json.get('name')):
+                    skipped['name'] += 1
+                elif not extent_intersects_aoi (layer_json.get('extent'), aoi):
+                    skipped['extent'] += 1
+                else:
+                    layer = layer_from_json (layer_json, f"{url.rstrip('/')}/{layer_json['id']}", url)
+                    items += [layer] if layer else []
+            return items, [], skipped
+        # Servers without the layers resource are described one layer at a time
+        children = []
+        for layer in data.get('layers', []):
+            # Group layers have no features, their sub-layers are listed separately
+            if layer.get('subLayerIds'):
+                continue
+            if crawl_filter.accepts ('layers', layer.get('name')):
+                children.append(('layer', f"{url.rstrip('/')}/{layer['id']}"))
+            else:
+                skipped['name'] += 1
+        return [service], children, skipped
+
+    # Layers: the service URL is the parent of the layer id
+    if not extent_intersects_aoi (data.get('extent'), aoi):
+        skipped['extent'] += 1
+        return [], [], skipped
+    layer = layer_from_json (data, url, url.rstrip('/').rsplit('/', 1)[0])
+    return [layer] if layer else [], [], skipped
+def crawl_catalog (url_base, transport, crawl_threads=8, aoi=None, crawl_filter=None):
+    """
+    Discover every service and layer under a base URL using the ArcGIS REST JSON API.
+
+    The directory is walked iteratively (no recursion) with at most `crawl_threads`
+    requests in flight at once. Services and layers that do not intersect the AOI, or are
+    rejected by the name patterns of `crawl_filter`, are pruned before being descended into.
+
+    Args:
+        url_base (str): The URL of the services directory, a folder or a single service.
+        transport (HttpTransport): The transport used to send requests.
+        crawl_threads (int): The maximum number of concurrent requests.
+        aoi (AoiCache): The area of interest used to prune services and layers by extent. No pruning if None.
+        crawl_filter (CrawlFilter): The name patterns of the items to visit. Everything is visited if None.
+
+    Returns:
+        Catalog: The services and layers found under `url_base`.
+    """
+    url_base = url_base.rstrip('/')
+    root = services_root (url_base)
+    catalog = Catalog()
+    # The base URL may point at the directory, a folder or a service
+    first_kind = 'service' if service_url_type (url_base) else 'folder'
+    visited = {(first_kind, url_base)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=crawl_threads) as executor:
+        pending = {executor.submit(crawl_task, transport, first_kind, url_base, root, aoi, crawl_filter)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                items, children, skipped = future.result()
+                for item in items:
+                    if isinstance(item, ServiceInfo):
+                        catalog.services.append(item)
+                    else:
+                        catalog.layers.append(item)
+                catalog.skipped.update(skipped)
+                # Queue the children that were not visited yet
+                for kind, url in children:
+                    if (kind, url) not in visited:
+                        visited.add((kind, url))
+                        pending.add(executor.submit(crawl_task, transport, kind, url, root, aoi, crawl_filter))
+    print(f'Discovered {len(catalog.services)} services and {len(catalog.layers)} layers under {url_base}'
+          f" (skipped {catalog.skipped['extent']} outside the AOI and {catalog.skipped['name']} by name)")
+    return catalog
+def export_catalog (catalog, path=None, include_metadata=False):
+    """
+    Export the services and layers of a catalog to JSON or CSV.
+
+    Args:
+        catalog (Catalog): The catalog returned by `crawl_catalog`.
+        path (str): The output file. A '.csv' file lists the layers, one per row, any other file (or
+            standard output if None) gets the services and layers as JSON.
+        include_metadata (bool): Include the JSON description of every service and layer (JSON only).
+
+    Returns:
+        int: The number of layers exported.
+    """
+    layer_columns = ['url', 'service_url', 'id', 'name', 'type', 'geometry_type', 'crs', 'max_record_count', 'feature_count']
+    if path is not None and path.lower().endswith('.csv'):
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(layer_columns)
+            writer.writerows([getattr(layer, column) for column in layer_columns] for layer in catalog.layers)
+        return len(catalog.layers)
+
+    def record (item, columns):
+        row = {column: getattr(item, column) for column in columns}
+        if include_metadata:
+            row['metadata'] = item.metadata
+        return row
+    document = {'services': [record (service, ['name', 'type', 'url']) for service in catalog.services],
+                'layers': [record (layer, layer_columns) for layer in catalog.layers],
+                'skipped': dict(catalog.skipped)}
+    if path is None:
+        print(json.dumps(document, indent=2))
+    else:
+        with open(path, 'w') as file:
+            json.dump(document, file, indent=2)
+    return len(catalog.layers)
+def shp_info (shp):
+    """
+    Read a shapefile and its coordinate reference system (CRS).
+
+    Args:
+        shp (str): The path to the shapefile.
+
+    Returns:
+        tuple: A tuple containing the GeoDataFrame and its CRS.
+    """
+    # Read the shapefile using geopandas
+    shp_gdf = gpd.read_file(shp)
+    # # Read the shapefile Coordinate reference system (CRS) code
+    shp_crs = shp_gdf.crs
+    return shp_gdf, shp_crs 
+@dataclass
+class AoiProjection:
+    """
+    The area of interest (AOI) reprojected to one CRS.
+
+    Attributes:
+        gdf (geopandas.GeoDataFrame): The AOI features in the CRS.
+        geometry (shapely.geometry.base.BaseGeometry): The union of the AOI features.
+        bounds (list): The total bounds of the AOI as [minx, miny, maxx, maxy].
+        envelope (shapely.geometry.base.BaseGeometry): The union of the envelopes of the AOI features.
+    """
+    gdf: object
+    geometry: object
+    bounds: list
+    envelope: object
+    _local: threading.local = field(default_factory=threading.local, repr=False)
+
+    def prepared_geometry (self):
+        """
+        Return a prepared copy of the AOI geometry for the calling thread.
+
+        GEOS builds the indexes of a prepared geometry lazily, so each thread prepares its own copy once.
+
+        Returns:
+            shapely.geometry.base.BaseGeometry: The prepared AOI geometry.
+        """
+        prepared = getattr(self._local, 'geometry', None)
+        if prepared is None:
+            prepared = shapely.from_wkb(shapely.to_wkb(self.geometry))
+            shapely.prepare(prepared)
+            self._local.geometry = prepared
+        return prepared
+class AoiCache:
+    """
+    The area of interest (AOI) shapefile, read once and reprojected once per CRS.
+
+    Projections are memoized and shared by all worker threads, so layers that share a
+    spatial reference never read the shapefile or reproject the AOI again.
+
+    Args:
+        shp (str or geopandas.GeoDataFrame): The path to the shapefile, or the AOI features. A ValueError is
+            raised if they have no CRS.
+
+    Attributes:
+        path (str): The path to the shapefile (None if built from a GeoDataFrame).
+        gdf (geopandas.GeoDataFrame): The AOI features in their own CRS.
+        crs (pyproj.CRS): The CRS of the shapefile.
+        signature (str): A hash of the AOI geometries and CRS.
+    """
+    def __init__ (self, shp):
+        self.path = shp if isinstance(shp, str) else None
+        self.gdf, self.crs = shp_info (shp) if isinstance(shp, str) else (shp, shp.crs)
+        if self.crs is None:
+            # Without a CRS the AOI cannot be reprojected to the layers nor sent as a spatial filter
+            raise ValueError(f'The area of interest {self.path or ""} has no CRS, define its projection (.prj) first')
+        self.signature = hashlib.sha256(b''.join(self.gdf.geometry.to_wkb()) + str(self.crs).encode()).hexdigest()
+        self._projections = {}
+        self._polygons = {}
+        self._lock = threading.Lock()
+
+    def get (self, crs=None):
+        """
+        Return the AOI reprojected to a CRS, computing it on first use.
+
+        Args:
+            crs (int or str): The target CRS. Defaults to the CRS of the shapefile.
+
+        Returns:
+            AoiProjection: The AOI geometry, total bounds and envelope in the CRS.
+        """
+        key = self.crs if crs is None else crs
+        # Fast path without locking once the projection is cached
+        projection = self._projections.get(key)
+        if projection is None:
+            with self._lock:
+                projection = self._projections.get(key)
+                if projection is None:
+                    gdf = self.gdf if crs is None else self.gdf.to_crs(crs)
+                    projection = AoiProjection(
+                        gdf=gdf,
+                        geometry=shapely.union_all(list(gdf.geometry)),
+                        bounds=[float(value) for value in gdf.total_bounds],
+                        envelope=shapely.union_all(list(gdf.envelope)),
+                    )
+                    self._projections[key] = projection
+        return projection
+
+    def polygon_json (self, crs, max_chars=20000):
+        """
+        Return the AOI as esriGeometryPolygon JSON in a CRS, simplified to fit in `max_chars`.
+
+        Args:
+            crs (int): The target CRS.
+            max_chars (int): The maximum size of the JSON in characters.
+
+        Returns:
+            str: The JSON of the AOI polygon.
+        """
+        key = (crs, max_chars)
+        polygon_json = self._polygons.get(key)
+        if polygon_json is None:
+            polygon_json = simplify_polygon_json (self.get(crs).geometry, crs, max_chars)
+            with self._lock:
+                self._polygons[key] = polygon_json
+        return polygon_json
+class RunManifest:
+    """
+    A SQLite manifest of the layers processed in `export_path`, used to resume and refresh runs.
+
+    Each layer URL records its state ('discovered', 'downloaded', 'clipped', 'written', 'error'), the
+    `editingInfo.lastEditDate` of the layer, the content hash of the downloaded features, the signature
+    of the settings its outputs were written with, its output name and paths. A new run skips layers
+    whose outputs are up to date (same edit date and settings, outputs still on disk) and resumes the others.
+
+    Args:
+        export_path (str): The directory path where the manifest ('manifest.sqlite') is stored.
+        aoi_signature (str): A signature of the area of interest. All layers are processed
+            again when it differs from the signature of the previous run.
+        settings_signature (str): A signature of the run settings shaping the outputs (see
+            `DownloadOptions.signature`). Layers written with other settings are processed again.
+    """
+    def __init__ (self, export_path, aoi_signature='', settings_signature=''):
+        self.path = os.path.join(export_path, 'manifest.sqlite')
+        self.settings_signature = settings_signature
+        # One connection shared by all threads, every statement is committed immediately
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS layers (
+                url TEXT PRIMARY KEY, layer_name TEXT UNIQUE, state TEXT, last_edit_date INTEGER,
+                content_hash TEXT, written_hash TEXT, output_paths TEXT, updated_at TEXT, settings_hash TEXT)''')
+            columns = {row[1] for row in self._connection.execute('PRAGMA table_info(layers)')}
+            if 'settings_hash' not in columns:
+                # Manifests of earlier versions, their layers are processed again once
+                self._connection.execute('ALTER TABLE layers ADD COLUMN settings_hash TEXT')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            row = self._connection.execute("SELECT value FROM meta WHERE key = 'aoi'").fetchone()
+            if row is not None and row[0] != aoi_signature:
+                # A different area of interest invalidates every output
+                print('The area of interest changed, all layers will be processed again')
+                self._connection.execute("UPDATE layers SET state = 'discovered', last_edit_date = NULL, written_hash = NULL")
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('aoi', ?)", (aoi_signature,))
+
+    def _row (self, url):
+        return self._connection.execute(
+            'SELECT layer_name, state, last_edit_date, written_hash, settings_hash, output_paths FROM layers WHERE url = ?',
+            (url,)).fetchone()
+
+    def _outputs_current (self, row):
+        # The outputs were written with the settings of this run and are still on disk
+        if row[4] != self.settings_signature:
+            return False
+        # GeoPackage tables are referenced as '<container>|layername=<table>'
+        return all(os.path.exists(path.split('|')[0]) for path in json.loads(row[5] or '[]'))
+
+    def is_up_to_date (self, layer):
+        """
+        Check whether a layer was written by a previous run and not edited since, without registering it.
+
+        Args:
+            layer (LayerInfo): The layer discovered by the crawler.
+
+        Returns:
+            bool: True if `discover` would skip the layer.
+        """
+        last_edit_date = (layer.metadata.get('editingInfo') or {}).get('lastEditDate')
+        with self._lock:
+            row = self._row (layer.url)
+        return (row is not None and row[1] == 'written' and last_edit_date is not None
+                and last_edit_date == row[2] and self._outputs_current (row))
+
+    def discover (self, layer):
+        """
+        Register a layer for this run and check whether it needs processing.
+
+        Args:
+            layer (LayerInfo): The layer discovered by the crawler.
+
+        Returns:
+            bool: False if the layer was written by a previous run with the same settings, its outputs
+            still exist and its `lastEditDate` has not changed since, True otherwise.
+        """
+        last_edit_date = (layer.metadata.get('editingInfo') or {}).get('lastEditDate')
+        with self._lock:
+            row = self._row (layer.url)
+            if row is None:
+                self._connection.execute(
+                    "INSERT INTO layers (url, state, last_edit_date, updated_at) VALUES (?, 'discovered', ?, ?)",
+                    (layer.url, last_edit_date, datetime.datetime.now().isoformat()))
+                return True
+            state, previous_edit_date = row[1], row[2]
+            if (state == 'written' and last_edit_date is not None and last_edit_date == previous_edit_date
+                    and self._outputs_current (row)):
+                return False
+            self._connection.execute(
+                "UPDATE layers SET state = 'discovered', last_edit_date = ?, updated_at = ? WHERE url = ?",
+                (last_edit_date, datetime.datetime.now().isoformat(), layer.url))
+            return True
+
+    def layer_name (self, url, layer_name):
+        """
+        Return the output name of a layer, keeping the name assigned by previous runs.
+
+        Names already used by another layer get an incremental count suffix.
+
+        Args:
+            url (str): The URL of the layer.
+            layer_name (str): The preferred name of the layer.
+
+        Returns:
+            str: The unique output name of the layer.
+        """
+        with self._lock:
+            row = self._row (url)
+            if row is not None and row[0]:
+                return row[0]
+            name = layer_name
+            count = 0
+            while self._connection.execute('SELECT 1 FROM layers WHERE layer_name = ?', (name,)).fetchone():
+                count += 1
+                name = f'{layer_name}_{count}'
+            self._connection.execute('UPDATE layers SET layer_name = ? WHERE url = ?', (name, url))
+            return name
+
+    def is_unchanged (self, url, content_hash):
+        """
+        Check whether the outputs of a layer were written from the same downloaded content, with the same
+        settings, and are still on disk.
+
+        Args:
+            url (str): The URL of the layer.
+            content_hash (str): The hash of the downloaded features.
+
+        Returns:
+            bool: True if the written outputs match the content hash, False otherwise.
+        """
+        with self._lock:
+            row = self._row (url)
+        return row is not None and row[3] == content_hash and self._outputs_current (row)
+
+    def update (self, url, state, content_hash=None, output_paths=None):
+        """
+        Record the progress of a layer.
+
+        Args:
+            url (str): The URL of the layer.
+            state (str): The new state ('downloaded', 'clipped', 'written' or 'error').
+            content_hash (str): The hash of the downloaded features, if known.
+            output_paths (list): The output file paths of the layer, if any.
+        """
+        assignments = ['state = ?', 'updated_at = ?']
+        values = [state, datetime.datetime.now().isoformat()]
+        if content_hash is not None:
+            assignments.append('content_hash = ?')
+            values.append(content_hash)
+        if output_paths is not None:
+            assignments.append('output_paths = ?')
+            values.append(json.dumps(output_paths))
+        if state == 'written':
+            # The outputs now reflect the downloaded content and the settings of this run
+            assignments.append('written_hash = content_hash')
+            assignments.append('settings_hash = ?')
+            values.append(self.settings_signature)
+        with self._lock:
+            self._connection.execute(f"UPDATE layers SET {', '.join(assignments)} WHERE url = ?", (*values, url))
+
+    def close (self):
+        """
+        Close the manifest database.
+        """
+        with self._lock:
+            self._connection.close()
+@dataclass
+class FeaturePage:
+    """
+    A page of query results decoded into columns, without per-feature Python objects.
+
+    Geometries are kept as Esri parts (points, paths or rings) in flat coordinate arrays. They are
+    assembled into shapely geometries in bulk by `geometries`, in the CPU stage.
+
+    Attributes:
+        columns (dict): The values of each attribute field, one list per field name, in feature order.
+        geometry_type (str): The esriGeometry type of the geometries.
+        coords (numpy.ndarray): The vertices of all parts, shape (n, 2), or (n, 3) with Z values.
+        part_lengths (numpy.ndarray): The number of vertices of each part.
+        part_counts (numpy.ndarray): The number of parts of each feature, 0 for features without geometry.
+        oid_field (str): The name of the object id field, if any.
+    """
+    columns: dict
+    geometry_type: str
+    coords: object
+    part_lengths: object
+    part_counts: object
+    oid_field: str = None
+
+    def __len__ (self):
+        return len(self.part_counts)
+
+    def ids (self):
+        """
+        Return the object ids of the features.
+
+        Returns:
+            numpy.ndarray: The object ids, or None if the page has no object id field.
+        """
+        if self.oid_field not in self.columns:
+            return None
+        return np.asarray(self.columns[self.oid_field])
+
+    def take (self, mask):
+        """
+        Select features.
+
+        Args:
+            mask (numpy.ndarray): A boolean array with one value per feature.
+
+        Returns:
+            FeaturePage: The selected features, in their original order.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        part_mask = np.repeat(mask, self.part_counts)
+        vertex_mask = np.repeat(part_mask, self.part_lengths)
+        columns = {name: list(itertools.compress(values, mask)) for name, values in self.columns.items()}
+        return FeaturePage(columns, self.geometry_type, self.coords[vertex_mask], self.part_lengths[part_mask],
+                           self.part_counts[mask], self.oid_field)
+
+    def split (self, count):
+        """
+        Split the page after its first `count` features.
+
+        Returns:
+            tuple: The first `count` features and the rest, as two FeaturePage.
+        """
+        head = np.arange(len(self)) < count
+        return self.take (head), self.take (~head)
+
+    @classmethod
+    def concat (cls, pages, geometry_type=None, oid_field=None):
+        """
+        Concatenate pages of the same layer.
+
+        Args:
+            pages (list): The FeaturePage to concatenate.
+            geometry_type (str): The esriGeometry type, used when `pages` is empty.
+            oid_field (str): The object id field, used when `pages` is empty.
+
+        Returns:
+            FeaturePage: The features of all pages.
+        """
+        if not pages:
+            return cls({}, geometry_type, np.empty((0, 2)), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), oid_field)
+        names = list(dict.fromkeys(name for page in pages for name in page.columns))
+        columns = {name: [value for page in pages for value in page.columns.get(name, [None] * len(page))] for name in names}
+        dimensions = max(page.coords.shape[1] for page in pages)
+        coords = [page.coords if page.coords.shape[1] == dimensions else
+                  np.column_stack([page.coords, np.zeros((len(page.coords), dimensions - page.coords.shape[1]))]) for page in pages]
+        return cls(columns, pages[0].geometry_type, np.concatenate(coords),
+                   np.concatenate([page.part_lengths for page in pages]),
+                   np.concatenate([page.part_counts for page in pages]), pages[0].oid_field)
+
+    def update_hash (self, content_hash):
+        """
+        Add the attributes and coordinates of the features to a hash.
+
+        Args:
+            content_hash (hashlib._Hash): The hash to update.
+        """
+        content_hash.update(json.dumps(self.columns, sort_keys=True, default=str).encode())
+        for array in (self.coords, self.part_lengths, self.part_counts):
+            content_hash.update(np.ascontiguousarray(array).tobytes())
+
+    def memory_size (self):
+        """
+        Estimate the memory used by the page, in bytes.
+        """
+        attributes = sum(len(value) if isinstance(value, str) else 8 for values in self.columns.values() for value in values)
+        return self.coords.nbytes + self.part_lengths.nbytes + self.part_counts.nbytes + attributes + 64 * len(self) * len(self.columns)
+
+    def geometries (self):
+        """
+        Assemble the shapely geometries of the features in bulk.
+
+        Paths with fewer than 2 vertices and rings with fewer than 4 are dropped. Polyline features
+        with one path become LineStrings, others MultiLineStrings. Esri polygon rings are grouped
+        into polygons by orientation (outer rings are clockwise) and containment.
+
+        Returns:
+            numpy.ndarray: One shapely geometry (or None) per feature.
+        """
+        count = len(self)
+        result = np.full(count, None, dtype=object)
+        coords, part_lengths, part_counts = self.coords, self.part_lengths, self.part_counts
+        if not len(coords):
+            return result
+        part_feature = np.repeat(np.arange(count), part_counts)
+        minimum = {'esriGeometryPolyline': 2, 'esriGeometryPolygon': 4}.get(self.geometry_type, 1)
+        valid = part_lengths >= minimum
+        if not valid.all():
+            # Drop the degenerate parts
+            coords = coords[np.repeat(valid, part_lengths)]
+            part_lengths, part_feature = part_lengths[valid], part_feature[valid]
+            part_counts = np.bincount(part_feature, minlength=count)
+        vertex_part = np.repeat(np.arange(len(part_lengths)), part_lengths)
+
+        if self.geometry_type == 'esriGeometryPoint':
+            result[part_counts > 0] = shapely.points(coords[np.cumsum(part_lengths) - part_lengths])
+        elif self.geometry_type == 'esriGeometryMultipoint':
+            shapely.multipoints(shapely.points(coords), indices=part_feature[vertex_part], out=result)
+        elif self.geometry_type == 'esriGeometryPolyline':
+            parts = shapely.linestrings(coords, indices=vertex_part)
+            single = part_counts[part_feature] == 1
+            result[part_feature[single]] = parts[single]
+            if not single.all():
+                shapely.multilinestrings(parts[~single], indices=part_feature[~single], out=result)
+        elif self.geometry_type == 'esriGeometryPolygon':
+            rings = shapely.linearrings(coords, indices=vertex_part)
+            # Esri outer rings are clockwise, holes are counter-clockwise
+            outer = ~shapely.is_ccw(rings)
+            single = part_counts[part_feature] == 1
+            result[part_feature[single]] = shapely.polygons(rings[single])
+            starts = np.cumsum(part_counts) - part_counts
+            for feature in np.flatnonzero(part_counts > 1):
+                parts = slice(starts[feature], starts[feature] + part_counts[feature])
+                result[feature] = assemble_polygon (rings[parts], outer[parts])
+        return result
+def assemble_polygon (rings, outer):
+    """
+    Group the rings of an Esri polygon into a Polygon or MultiPolygon.
+
+    Args:
+        rings (numpy.ndarray): The shapely LinearRings of the polygon.
+        outer (numpy.ndarray): Whether each ring is an outer ring (clockwise).
+
+    Returns:
+        shapely.geometry.base.BaseGeometry: The polygon, or None if it has no ring.
+    """
+    shells = [[ring] for ring, is_outer in zip(rings, outer) if is_outer]
+    for hole in rings[~outer]:
+        # Attach each hole to the first outer ring that contains it
+        first_point = shapely.get_point(hole, 0)
+        owner = next((shell for shell in shells if shapely.polygons(shell[0]).contains(first_point)), None)
+        if owner is None:
+            # An orphan counter-clockwise ring is treated as an outer ring
+            shells.append([hole])
+        else:
+            owner.append(hole)
+    polygons = [shapely.polygons(shell[0], shell[1:]) for shell in shells]
+    if not polygons:
+        return None
+    return polygons[0] if len(polygons) == 1 else shapely.multipolygons(polygons)
+def geometry_parts (geometry):
+    """
+    Return the parts of an Esri JSON geometry as lists of vertices.
+
+    Args:
+        geometry (dict): The Esri JSON geometry (point, multipoint, polyline or polygon).
+
+    Returns:
+        list: The vertices of each part (a point is one part of one vertex).
+    """
+    if not geometry:
+        return []
+    if 'x' in geometry:
+        if geometry['x'] is None or geometry['x'] != geometry['x']:
+            return []
+        return [[[geometry['x'], geometry['y'], *([geometry['z']] if 'z' in geometry else [])]]]
+    if geometry.get('points'):
+        return [geometry['points']]
+    return geometry.get('paths') or geometry.get('rings') or []
+def dequantize (values, transform, dimension, origin_upper_left):
+    """
+    Convert quantized (integer) coordinates to real coordinates.
+
+    Args:
+        values (numpy.ndarray): The integer coordinates of one dimension.
+        transform (dict): The 'scale' and 'translate' lists of the quantization transform.
+        dimension (int): 0 for x, 1 for y and 2 for z.
+        origin_upper_left (bool): Whether y grows downwards from the origin.
+
+    Returns:
+        numpy.ndarray: The coordinates.
+    """
+    scale, translate = transform['scale'][dimension], transform['translate'][dimension]
+    if dimension == 1 and origin_upper_left:
+        return translate - values * scale
+    return translate + values * scale
+def undelta (values, part_lengths):
+    """
+    Turn delta-encoded coordinates (each relative to the previous vertex of its part) into absolute ones.
+
+    Args:
+        values (numpy.ndarray): The deltas of one dimension, the first vertex of each part is absolute.
+        part_lengths (numpy.ndarray): The number of vertices of each part.
+
+    Returns:
+        numpy.ndarray: The absolute coordinates.
+    """
+    totals = np.cumsum(values)
+    starts = np.cumsum(part_lengths) - part_lengths
+    # Restart the running sum at the first vertex of each part
+    offsets = np.repeat(totals[starts] - values[starts], part_lengths)
+    return totals - offsets
+def decode_json_page (data, geometry_type=None, oid_field=None):
+    """
+    Decode an Esri JSON query response into a FeaturePage.
+
+    Quantized responses (with a 'transform', see the `quantizationParameters` query parameter) are
+    converted back to real coordinates.
+
+    Args:
+        data (dict): The decoded JSON response.
+        geometry_type (str): The esriGeometry type of the layer, used if the response does not report it.
+        oid_field (str): The object id field of the layer, used if the response does not report it.
+
+    Returns:
+        FeaturePage: The features of the response.
+    """
+    features = data.get('features') or []
+    geometry_type = data.get('geometryType') or geometry_type
+    columns = collections.defaultdict(lambda: [None] * len(features))
+    part_counts = np.zeros(len(features), dtype=np.int64)
+    part_lengths = []
+    vertices = []
+    for index, feature in enumerate(features):
+        for name, value in (feature.get('attributes') or {}).items():
+            columns[name][index] = value
+        parts = geometry_parts (feature.get('geometry'))
+        part_counts[index] = len(parts)
+        for part in parts:
+            part_lengths.append(len(part))
+            vertices.extend(part)
+    dimensions = 3 if data.get('hasZ') else 2
+    coords = np.array([vertex[:dimensions] for vertex in vertices], dtype=float).reshape(-1, dimensions)
+    part_lengths = np.array(part_lengths, dtype=np.int64)
+    transform = data.get('transform')
+    if transform and len(coords):
+        origin_upper_left = transform.get('originPosition', 'upperLeft') == 'upperLeft'
+        for dimension in range(dimensions):
+            values = coords[:, dimension]
+            if geometry_type != 'esriGeometryPoint':
+                values = undelta (values, part_lengths)
+            coords[:, dimension] = dequantize (values, transform, dimension, origin_upper_left)
+    return FeaturePage(dict(columns), geometry_type, coords, part_lengths, part_counts, data.get('objectIdFieldName') or oid_field)
+# Esri PBF (esriPBuffer.FeatureCollectionPBuffer) enums
+PBF_GEOMETRY_TYPES = {0: 'esriGeometryPoint', 1: 'esriGeometryMultipoint', 2: 'esriGeometryPolyline', 3: 'esriGeometryPolygon'}
+def read_varint (buffer, position):
+    """
+    Read a protobuf varint.
+
+    Args:
+        buffer (bytes): The protobuf message.
+        position (int): The offset of the varint.
+
+    Returns:
+        tuple: The value and the offset after it.
+    """
+    result = shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+def iter_protobuf_fields (buffer, start=0, end=None):
+    """
+    Iterate over the fields of a protobuf message.
+
+    Args:
+        buffer (bytes): The buffer holding the message.
+        start (int): The offset of the message.
+        end (int): The offset after the message. Defaults to the end of the buffer.
+
+    Yields:
+        tuple: The field number, the wire type and the value: an int for varints, the (start, end)
+        offsets for length-delimited fields, and the raw bytes for 64-bit and 32-bit fields.
+    """
+    end = len(buffer) if end is None else end
+    position = start
+    while position < end:
+        key, position = read_varint (buffer, position)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, position = read_varint (buffer, position)
+        elif wire_type == 2:
+            length, position = read_varint (buffer, position)
+            value = (position, position + length)
+            position += length
+        elif wire_type == 1:
+            value = buffer[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = buffer[position:position + 4]
+            position += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+        yield key >> 3, wire_type, value
+def decode_packed_varints (data):
+    """
+    Decode a run of protobuf varints in bulk.
+
+    Args:
+        data (bytes): Concatenated varints (e.g. the content of packed repeated fields).
+
+    Returns:
+        numpy.ndarray: The unsigned values (uint64).
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if not len(raw):
+        return np.empty(0, dtype=np.uint64)
+    # The last byte of each varint has its high bit clear
+    ends = np.flatnonzero(raw < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 7 * (np.arange(len(raw)) - np.repeat(starts, ends - starts + 1))
+    payload = (raw & 0x7f).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.bitwise_or.reduceat(payload, starts)
+def zigzag_decode (values):
+    """
+    Decode protobuf sint64 (zigzag) values.
+
+    Args:
+        values (numpy.ndarray): The unsigned varint values.
+
+    Returns:
+        numpy.ndarray: The signed values (int64).
+    """
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+def decode_pbf_value (buffer, start, end):
+    """
+    Decode an esriPBuffer Value message (an attribute value).
+
+    Returns:
+        The string, number or bool value, or None for a null value.
+    """
+    for number, _, value in iter_protobuf_fields (buffer, start, end):
+        if number == 1:
+            return bytes(buffer[value[0]:value[1]]).decode('utf-8')
+        if number == 2:
+            return struct.unpack('<f', value)[0]
+        if number == 3:
+            return struct.unpack('<d', value)[0]
+        if number in (4, 8):
+            return (value >> 1) ^ -(value & 1)
+        if number == 6:
+            return value - (1 << 64) if value >= 1 << 63 else value
+        if number == 9:
+            return bool(value)
+        return value
+    return None
+def decode_pbf_transform (buffer, start, end):
+    """
+    Decode an esriPBuffer Transform message into a dict like the JSON 'transform'.
+    """
+    transform = {'originPosition': 'upperLeft', 'scale': [1.0, 1.0, 1.0, 1.0], 'translate': [0.0, 0.0, 0.0, 0.0]}
+    for number, _, value in iter_protobuf_fields (buffer, start, end):
+        if number == 1:
+            transform['originPosition'] = 'lowerLeft' if value == 1 else 'upperLeft'
+        elif number in (2, 3):
+            key = 'scale' if number == 2 else 'translate'
+            for dimension, _, raw in iter_protobuf_fields (buffer, *value):
+                # x, y, m, z in the message, kept as x, y, z, m
+                transform[key][{1: 0, 2: 1, 3: 3, 4: 2}[dimension]] = struct.unpack('<d', raw)[0]
+    return transform
+def decode_pbf_page (content, oid_field=None):
+    """
+    Decode an Esri PBF query response (`f=pbf`) into a FeaturePage.
+
+    Feature and attribute messages are walked in Python, while the packed coordinates of all
+    features are decoded, un-delta-encoded and dequantized in bulk with numpy.
+
+    Args:
+        content (bytes): The response body.
+        oid_field (str): The object id field of the layer, used if the response does not report it.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - FeaturePage: The features of the response.
+            - bool: Whether the server reported that more features match the query (`exceededTransferLimit`).
+
+    Raises:
+        ValueError: If the content is not a feature collection.
+    """
+    buffer = memoryview(content)
+    # FeatureCollectionPBuffer.queryResult (2) -> QueryResult.featureResult (1)
+    query_result = next((value for number, wire_type, value in iter_protobuf_fields (buffer) if number == 2 and wire_type == 2), None)
+    feature_result = query_result and next((value for number, wire_type, value in iter_protobuf_fields (buffer, *query_result)
+                                            if number == 1 and wire_type == 2), None)
+    if feature_result is None:
+        raise ValueError('The response is not a PBF feature collection')
+
+    geometry_type, has_z, has_m, exceeded = 'esriGeometryPoint', False, False, False
+    transform = None
+    names, features = [], []
+    for number, _, value in iter_protobuf_fields (buffer, *feature_result):
+        if number == 1:
+            oid_field = bytes(buffer[value[0]:value[1]]).decode('utf-8') or oid_field
+        elif number == 7:
+            geometry_type = PBF_GEOMETRY_TYPES.get(value, geometry_type)
+        elif number == 9:
+            exceeded = bool(value)
+        elif number == 10:
+            has_z = bool(value)
+        elif number == 11:
+            has_m = bool(value)
+        elif number == 12:
+            transform = decode_pbf_transform (buffer, *value)
+        elif number == 13:
+            name = next((field_value for field_number, _, field_value in iter_protobuf_fields (buffer, *value) if field_number == 1), None)
+            names.append(bytes(buffer[name[0]:name[1]]).decode('utf-8') if name else '')
+        elif number == 15:
+            features.append(value)
+
+    columns = {name: [None] * len(features) for name in names}
+    lists = list(columns.values())
+    part_counts = np.zeros(len(features), dtype=np.int64)
+    lengths, coords = [], []
+    point_features = []
+    for index, (start, end) in enumerate(features):
+        attribute = 0
+        for number, _, value in iter_protobuf_fields (buffer, start, end):
+            if number == 1:
+                if attribute < len(lists):
+                    lists[attribute][index] = decode_pbf_value (buffer, *value)
+                attribute += 1
+            elif number == 2:
+                # Geometry: packed part lengths (2) and packed delta-encoded coordinates (3)
+                feature_lengths = feature_coords = b''
+                for geometry_number, _, geometry_value in iter_protobuf_fields (buffer, *value):
+                    if geometry_number == 2:
+                        feature_lengths = buffer[geometry_value[0]:geometry_value[1]]
+                    elif geometry_number == 3:
+                        feature_coords = buffer[geometry_value[0]:geometry_value[1]]
+                if not feature_coords:
+                    continue
+                coords.append(feature_coords)
+                if feature_lengths:
+                    lengths.append(feature_lengths)
+                    part_counts[index] = len(decode_packed_varints (feature_lengths))
+                else:
+                    point_features.append(index)
+                    part_counts[index] = 1
+
+    stride = 2 + has_z + has_m
+    values = zigzag_decode (decode_packed_varints (b''.join(coords))).reshape(-1, stride)
+    if point_features:
+        # Points have no part lengths: one vertex each
+        part_lengths = np.ones(len(point_features), dtype=np.int64)
+    else:
+        part_lengths = decode_packed_varints (b''.join(lengths)).astype(np.int64)
+    transform = transform or {'originPosition': 'upperLeft', 'scale': [1.0] * 4, 'translate': [0.0] * 4}
+    origin_upper_left = transform['originPosition'] == 'upperLeft'
+    dimensions = 3 if has_z else 2
+    page_coords = np.empty((len(values), dimensions))
+    for dimension in range(dimensions):
+        # Z values follow x and y, M values are dropped
+        column = values[:, dimension].astype(float)
+        if geometry_type != 'esriGeometryPoint':
+            column = undelta (column, part_lengths)
+        page_coords[:, dimension] = dequantize (column, transform, dimension, origin_upper_left)
+    return FeaturePage(columns, geometry_type, page_coords, part_lengths, part_counts, oid_field), exceeded
+def layer_query_info (layer_json):
+    """
+    Read the query capabilities of a layer from its JSON description.
+
+    Args:
+        layer_json (dict): The JSON description of the layer.
+
+    Returns:
+        dict: A dict with the 'max_record_count', the 'oid_field' name, whether the layer
+        'supports_pagination', whether it 'supports_pbf' output and its 'geometry_type'.
+    """
+    # The object id field is flagged in the fields list of older servers
+    oid_field = layer_json.get('objectIdField') or next(
+        (field['name'] for field in layer_json.get('fields') or [] if field.get('type') == 'esriFieldTypeOID'), None)
+    advanced = layer_json.get('advancedQueryCapabilities') or {}
+    formats = (layer_json.get('supportedQueryFormats') or '').lower()
+    return {
+        'max_record_count': int(layer_json.get('maxRecordCount') or 1000),
+        'oid_field': oid_field,
+        'supports_pagination': bool(advanced.get('supportsPagination')),
+        'supports_pbf': 'pbf' in formats,
+        'geometry_type': layer_json.get('geometryType'),
+    }
+def plan_query_pages (transport, layer_url, query_params, query_info):
+    """
+    Split a layer query into pages of at most `maxRecordCount` features.
+
+    Object ids matching the query are requested first and split into contiguous id ranges.
+    Layers without object ids fall back to `resultOffset` paging when the server supports it,
+    otherwise the query is sent as a single page.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        layer_url (str): The URL of the layer.
+        query_params (dict): The query parameters (where clause, spatial filter, output fields...).
+        query_info (dict): The query capabilities of the layer as returned by `layer_query_info`.
+
+    Returns:
+        list: A list of query parameter dicts, one per page. None if the query failed.
+    """
+    query_url = f"{layer_url.rstrip('/')}/query"
+    page_size = query_info['max_record_count']
+    oid_field = query_info['oid_field']
+
+    if oid_field:
+        ids = transport.get_json (query_url, {**query_params, 'returnIdsOnly': 'true'})
+        if ids is not None:
+            object_ids = sorted(ids.get('objectIds') or [])
+            pages = []
+            for start in range(0, len(object_ids), page_size):
+                # A contiguous id range keeps the URL short whatever the page size
+                chunk = object_ids[start:start + page_size]
+                where = f"({query_params.get('where', '1=1')}) AND {oid_field} >= {chunk[0]} AND {oid_field} <= {chunk[-1]}"
+                pages.append({**query_params, 'where': where})
+            return pages
+
+    if query_info['supports_pagination']:
+        count = transport.get_json (query_url, {**query_params, 'returnCountOnly': 'true'})
+        if count is None:
+            return None
+        order_by = {'orderByFields': oid_field} if oid_field else {}
+        return [{**query_params, **order_by, 'resultOffset': offset, 'resultRecordCount': page_size}
+                for offset in range(0, count.get('count', 0), page_size)]
+
+    return [query_params]
+def fetch_query_page (transport, layer_url, page_params, query_info, transfer_format='auto'):
+    """
+    Fetch one page of a layer query, decoded into columns.
+
+    Layers advertising PBF output are queried with `f=pbf` (unless `transfer_format` is 'json'),
+    other layers with JSON, which the transport requests gzip-compressed. A PBF response that cannot
+    be decoded falls back to JSON. If the server returns fewer features than requested (its transfer
+    limit is lower than the advertised `maxRecordCount`), the rest of an id range is fetched with
+    follow-up requests.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        layer_url (str): The URL of the layer.
+        page_params (dict): The query parameters of the page.
+        query_info (dict): The query capabilities of the layer as returned by `layer_query_info`.
+        transfer_format (str): 'auto' (PBF when the layer supports it), 'pbf' or 'json'.
+
+    Returns:
+        FeaturePage: The features of the page, or None if the request failed.
+    """
+    query_url = f"{layer_url.rstrip('/')}/query"
+    oid_field = query_info['oid_field']
+    use_pbf = transfer_format == 'pbf' or (transfer_format == 'auto' and query_info['supports_pbf'])
+    pages = []
+    params = dict(page_params)
+    while True:
+        page = None
+        if use_pbf:
+            content = transport.get_binary (query_url, {**params, 'f': 'pbf'})
+            if content is None:
+                return None
+            try:
+                page, exceeded = decode_pbf_page (content, oid_field)
+            except (ValueError, IndexError, struct.error):
+                # Not a feature collection (e.g. a JSON error or an unsupported output format)
+                use_pbf = False
+        if page is None:
+            data = transport.get_json (query_url, params)
+            if data is None:
+                return None
+            page, exceeded = decode_json_page (data, query_info.get('geometry_type'), oid_field), data.get('exceededTransferLimit')
+        pages.append(page)
+        # Continue after the last object id while the server reports truncated results
+        page_oids = page.ids ()
+        if not (exceeded and page_oids is not None and len(page_oids) and 'resultOffset' not in params):
+            return pages[0] if len(pages) == 1 else FeaturePage.concat (pages)
+        last_oid = page_oids.max()
+        params['where'] = f"({page_params['where']}) AND {oid_field} > {last_oid}"
+def iter_layer_features (transport, layer_url, query_params, layer_json=None, page_threads=4, max_in_flight=None,
+                         transfer_format='auto'):
+    """
+    Stream the features of a layer query, fetching its pages concurrently.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        layer_url (str): The URL of the layer.
+        query_params (dict): The query parameters (where clause, spatial filter, output fields...).
+        layer_json (dict): The JSON description of the layer. Requested from the server if None.
+        page_threads (int): The maximum number of pages fetched concurrently.
+        max_in_flight (int): The maximum number of pages requested but not yet consumed. Defaults to twice `page_threads`.
+        transfer_format (str): 'auto' (PBF when the layer supports it), 'pbf' or 'json' (see `fetch_query_page`).
+
+    Yields:
+        FeaturePage: The features of each page, in page order.
+
+    Raises:
+        RuntimeError: If the layer description or a page could not be retrieved.
+    """
+    if layer_json is None:
+        layer_json = transport.get_json (layer_url)
+        if layer_json is None:
+            raise RuntimeError(f'Could not read the layer description of {layer_url}')
+    query_info = layer_query_info (layer_json)
+    params = {'where': '1=1', 'outFields': '*', 'returnGeometry': 'true', 'outSR': 4326, **query_params}
+    pages = plan_query_pages (transport, layer_url, params, query_info)
+    if pages is None:
+        raise RuntimeError(f'Could not plan the query of {layer_url}')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(page_threads, max_in_flight or page_threads)) as executor:
+        # Keep a bounded window of pages in flight and yield them in order
+        in_flight = collections.deque()
+        pages = iter(pages)
+        for page_params in itertools.islice(pages, max_in_flight or page_threads * 2):
+            in_flight.append(executor.submit(fetch_query_page, transport, layer_url, page_params, query_info, transfer_format))
+        while in_flight:
+            features = in_flight.popleft().result()
+            for page_params in itertools.islice(pages, 1):
+                in_flight.append(executor.submit(fetch_query_page, transport, layer_url, page_params, query_info, transfer_format))
+            if features is None:
+                for future in in_flight:
+                    future.cancel()
+                raise RuntimeError(f'Could not retrieve a page of {layer_url}')
+            yield features
+def bbox_query_params (shp_bbox, crs):
+    """
+    Build the query parameters of a bounding box spatial filter.
+
+    Args:
+        shp_bbox (list): A list of four float values representing the bounding box coordinates in the order [minx, miny, maxx, maxy].
+        crs (int): The coordinate reference system (CRS) identifier of the bounding box.
+
+    Returns:
+        dict: The query parameters.
+    """
+    return {
+        'geometry': ','.join([str(num) for num in shp_bbox]),
+        'geometryType': 'esriGeometryEnvelope',
+        'inSR': crs,
+        'spatialRel': 'esriSpatialRelIntersects',
+    }
+def polygon_query_params (polygon_json, crs):
+    """
+    Build the query parameters of a polygon intersection spatial filter.
+
+    Args:
+        polygon_json (str): The esriGeometryPolygon JSON of the area of interest.
+        crs (int): The coordinate reference system (CRS) identifier of the polygon.
+
+    Returns:
+        dict: The query parameters.
+    """
+    return {
+        'geometry': polygon_json,
+        'geometryType': 'esriGeometryPolygon',
+        'inSR': crs,
+        'spatialRel': 'esriSpatialRelIntersects',
+    }
+def esri_polygon_json (geometry, crs, digits=None):
+    """
+    Convert a shapely (multi)polygon to esriGeometryPolygon JSON.
+
+    Args:
+        geometry (shapely.geometry.base.BaseGeometry): The polygon or multipolygon.
+        crs (int): The coordinate reference system (CRS) identifier of the geometry.
+        digits (int): The number of decimals kept in the coordinates. Full precision if None.
+
+    Returns:
+        str: The compact JSON of the polygon.
+    """
+    rings = []
+    for polygon in getattr(geometry, 'geoms', [geometry]):
+        if polygon.geom_type != 'Polygon' or polygon.is_empty:
+            continue
+        # Esri outer rings are clockwise and holes counter-clockwise
+        polygon = shapely.geometry.polygon.orient(polygon, sign=-1.0)
+        for ring in [polygon.exterior, *polygon.interiors]:
+            coords = ring.coords if digits is None else [(round(x, digits), round(y, digits)) for x, y, *_ in ring.coords]
+            rings.append([[x, y] for x, y, *_ in coords])
+    return json.dumps({'rings': rings, 'spatialReference': {'wkid': crs}}, separators=(',', ':'))
+def simplify_polygon_json (geometry, crs, max_chars):
+    """
+    Simplify a polygon until its esriGeometryPolygon JSON fits in `max_chars` characters.
+
+    The polygon is buffered by the simplification tolerance before being simplified,
+    so the simplified polygon always covers the original one and no intersecting feature is lost.
+
+    Args:
+        geometry (shapely.geometry.base.BaseGeometry): The polygon or multipolygon.
+        crs (int): The coordinate reference system (CRS) identifier of the geometry.
+        max_chars (int): The maximum size of the JSON in characters.
+
+    Returns:
+        str: The JSON of the (simplified) polygon.
+    """
+    minx, miny, maxx, maxy = geometry.bounds
+    size = max(maxx - minx, maxy - miny) or 1.0
+    # Keep a precision well below the tolerance scale
+    digits = max(0, 6 - int(math.floor(math.log10(size))))
+    polygon_json = esri_polygon_json (geometry, crs, digits)
+    tolerance = size / 10000
+    while len(polygon_json) > max_chars and tolerance < size:
+        simplified = geometry.buffer(tolerance).simplify(tolerance)
+        polygon_json = esri_polygon_json (simplified, crs, digits)
+        tolerance *= 2
+    if len(polygon_json) > max_chars:
+        # Fall back to the bounding box as a polygon
+        polygon_json = esri_polygon_json (shapely.box(minx, miny, maxx, maxy), crs, digits)
+    return polygon_json
+def geometry_query_params (geometry_precision=None, max_allowable_offset=None, quantization_parameters=None):
+    """
+    Build the query parameters trading geometry precision for smaller responses.
+
+    Args:
+        geometry_precision (int): The number of decimals of the returned coordinates (`geometryPrecision`).
+        max_allowable_offset (float): The generalisation tolerance of the returned geometries in degrees
+            (`maxAllowableOffset`, the queries return EPSG:4326).
+        quantization_parameters (dict): The `quantizationParameters` of the query, e.g.
+            {'mode': 'view', 'originPosition': 'upperLeft', 'tolerance': 1e-6, 'extent': {...}}.
+
+    Returns:
+        dict: The query parameters (empty for full precision).
+    """
+    params = {}
+    if geometry_precision is not None:
+        params['geometryPrecision'] = int(geometry_precision)
+    if max_allowable_offset is not None:
+        params['maxAllowableOffset'] = max_allowable_offset
+    if quantization_parameters:
+        params['quantizationParameters'] = json.dumps(quantization_parameters, separators=(',', ':'))
+    return params
+def export_layer_geojson (transport, url, layer_json, query_params, layer_name, export_path, page_threads=4, transfer_format='auto'):
+    """
+    Query the features of a layer inside the area of interest and save them as a GeoJSON file.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        url (str): The URL of the layer.
+        layer_json (dict): The JSON description of the layer.
+        query_params (dict): The spatial filter of the query (see `bbox_query_params` and `polygon_query_params`).
+        layer_name (str): The name of the layer to be extracted.
+        export_path (str): The directory path where the exported GeoJSON file will be saved.
+        page_threads (int): The maximum number of pages fetched concurrently.
+        transfer_format (str): 'auto' (PBF when the layer supports it), 'pbf' or 'json' (see `fetch_query_page`).
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - str: The file path of the generated GeoJSON file, or None if the query failed.
+            - str: The SHA-256 hash of the downloaded features, or None if the query failed.
+    """
+    # The layer name is unique per URL (see RunManifest.layer_name), reruns overwrite the file
+    geojson_out_path = os.path.join(export_path, 'geojson', f'{layer_name}.geojson')
+    try:
+        with open(geojson_out_path, 'w') as geojson_file:
+            # Write the features page by page as they arrive
+            geojson_file.write('{"type": "FeatureCollection", "features": [')
+            separator = ''
+            content_hash = hashlib.sha256()
+            for page in iter_layer_features (transport, url, query_params, layer_json, page_threads, transfer_format=transfer_format):
+                page.update_hash (content_hash)
+                # Geometries are serialised in bulk, attributes row by row
+                geometries = shapely.to_geojson(page.geometries ())
+                for properties, geometry in zip(zip(*page.columns.values()) if page.columns else itertools.repeat(()), geometries):
+                    properties = json.dumps(dict(zip(page.columns, properties)))
+                    geojson_file.write(f'{separator}{{"type": "Feature", "properties": {properties}, "geometry": {geometry or "null"}}}')
+                    separator = ','
+            geojson_file.write(']}')
+    except (RuntimeError, OSError) as e:
+        print(f'{url} An error occurred while querying the layer: {e}')
+        if os.path.exists(geojson_out_path):
+            os.remove(geojson_out_path)
+        return None, None
+    return geojson_out_path, content_hash.hexdigest()
+# Esri field types mapped to the pandas dtypes used when building feature chunks
+ESRI_FIELD_DTYPES = {
+    'esriFieldTypeOID': 'Int64',
+    'esriFieldTypeSmallInteger': 'Int64',
+    'esriFieldTypeInteger': 'Int64',
+    'esriFieldTypeBigInteger': 'Int64',
+    'esriFieldTypeDate': 'Int64',
+    'esriFieldTypeSingle': 'float64',
+    'esriFieldTypeDouble': 'float64',
+    'esriFieldTypeString': 'object',
+    'esriFieldTypeGUID': 'object',
+    'esriFieldTypeGlobalID': 'object',
+}
+# Rough in-memory cost of a decoded feature, used before the first page is measured
+FEATURE_BYTES_ESTIMATE = 4096
+def features_to_gdf (features, layer_json):
+    """
+    Build a GeoDataFrame from a page of features with the column types of the layer fields.
+
+    Casting every chunk to the field types keeps the schema identical across chunks appended to the same file.
+
+    Args:
+        features (FeaturePage): The features in EPSG:4326.
+        layer_json (dict): The JSON description of the layer.
+
+    Returns:
+        geopandas.GeoDataFrame: The features.
+    """
+    gdf = gpd.GeoDataFrame(pd.DataFrame(features.columns, index=pd.RangeIndex(len(features))),
+                           geometry=features.geometries (), crs=4326)
+    for layer_field in layer_json.get('fields') or []:
+        dtype = ESRI_FIELD_DTYPES.get(layer_field.get('type'))
+        if dtype and layer_field['name'] in gdf.columns:
+            gdf[layer_field['name']] = gdf[layer_field['name']].astype(dtype)
+    return gdf
+def stream_layer (transport, url, layer_json, query_params, cpu_stage, layer_name, out_dir, page_threads=4, max_memory_mb=512,
+                  stats=None, output_format='shp', transfer_format='auto'):
+    """
+    Stream the features of a layer through reprojection and clipping, appending them to the layer output.
+
+    Feature pages are grouped into chunks sized from the memory ceiling, so peak memory does not
+    depend on the size of the layer and no intermediate GeoJSON file is written. Chunks are clipped in
+    the CPU stage while the next pages download, and appended in order through a `LayerWriter`, so the
+    output only appears once the layer is complete.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        url (str): The URL of the layer.
+        layer_json (dict): The JSON description of the layer.
+        query_params (dict): The query parameters (spatial filter...).
+        cpu_stage (CpuStage): The stage where chunks are decoded, reprojected and clipped.
+        layer_name (str): The name of the layer, used as the file or table name.
+        out_dir (str): The folder of the output (see `output_folder`).
+        page_threads (int): The maximum number of pages fetched concurrently.
+        max_memory_mb (int): The approximate memory ceiling in megabytes for pages in flight and buffered chunks.
+        stats (dict): A measurement (see `new_stats`) updated with the time spent waiting for pages ('query'),
+            the decode, reproject, clip and write times and the feature counts.
+        output_format (str): The output format (see `OUTPUT_FORMATS`).
+        transfer_format (str): 'auto' (PBF when the layer supports it), 'pbf' or 'json' (see `fetch_query_page`).
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - str: The path of the output, or None if no feature intersects the AOI.
+            - str: The SHA-256 hash of the downloaded features.
+
+    Raises:
+        RuntimeError: If the layer description or a page could not be retrieved.
+    """
+    budget = max_memory_mb * 2 ** 20
+    page_size = layer_query_info (layer_json)['max_record_count']
+    # Half of the budget for pages in flight, half for the chunk being clipped
+    max_in_flight = max(1, min(page_threads * 2, int(budget / 2 // (page_size * FEATURE_BYTES_ESTIMATE))))
+    chunk_features = None
+    stats = stats if stats is not None else new_stats ()
+
+    writer = LayerWriter (out_dir, layer_name, output_format)
+    content_hash = hashlib.sha256()
+    buffer = []
+    buffered = 0
+    pending = collections.deque()
+
+    def append (future):
+        # Append a clipped chunk to the layer output
+        clipped_gdf, chunk_stats = future.result()
+        merge_stats (stats, chunk_stats)
+        with timed (stats, 'write'):
+            writer.write (clipped_gdf)
+
+    def flush (features):
+        # Reproject and clip the chunk in the CPU stage while the next pages download
+        pending.append(cpu_stage.submit (clip_features, features, layer_json))
+        while len(pending) > 1:
+            append (pending.popleft())
+
+    pages = iter_layer_features (transport, url, query_params, layer_json, page_threads, max_in_flight, transfer_format)
+    try:
+        while True:
+            # Time spent waiting for the next page
+            with timed (stats, 'query'):
+                page = next(pages, None)
+            if page is None:
+                break
+            page.update_hash (content_hash)
+            if chunk_features is None and len(page):
+                # Size the chunks from the measured cost of the first page, two chunks can be in memory at once
+                feature_bytes = max(FEATURE_BYTES_ESTIMATE / 4, 4 * page.memory_size () / len(page))
+                chunk_features = max(1, int(budget / 4 // feature_bytes))
+            buffer.append(page)
+            buffered += len(page)
+            while chunk_features and buffered >= chunk_features:
+                chunk, rest = FeaturePage.concat (buffer).split (chunk_features)
+                flush (chunk)
+                buffer, buffered = [rest], len(rest)
+        if buffered:
+            flush (FeaturePage.concat (buffer))
+        while pending:
+            append (pending.popleft())
+    except Exception:
+        writer.abort ()
+        raise
+
+    with timed (stats, 'write'):
+        out_path = writer.close ()
+    return out_path, content_hash.hexdigest()
+def move_shapefile (partial_path, shp_out_path, layer_name):
+    """
+    Move a complete shapefile (all its sidecar files) from its temporary folder in place.
+
+    Args:
+        partial_path (str): The folder where the shapefile was written.
+        shp_out_path (str): The destination folder.
+        layer_name (str): The name of the shapefile, without extension.
+
+    Returns:
+        str: The file path of the moved shapefile.
+    """
+    for filename in os.listdir(partial_path):
+        if os.path.splitext(filename)[0] == layer_name:
+            os.replace(os.path.join(partial_path, filename), os.path.join(shp_out_path, filename))
+    try:
+        # Remove the temporary folder
+        os.rmdir(partial_path)
+    except OSError:
+        pass
+    return os.path.join(shp_out_path, f'{layer_name}.shp')
+def clip_to_aoi (gdf, aoi_geometry, prepared_geometry=None):
+    """
+    Clip features to the area of interest, computing intersections only where needed.
+
+    A bulk STRtree query finds the features intersecting the AOI. Those fully inside the AOI
+    are kept as they are, disjoint features are dropped, and the exact intersection is computed
+    only for the features crossing the AOI boundary. Geometry work therefore scales with the AOI
+    boundary rather than with the number of features.
 
     Args:
-        out_path (str): Output path where the folder will be created.
-        folder_name (str): Name of the folder to be created.
+        gdf (geopandas.GeoDataFrame): The features, in the CRS of the AOI.
+        aoi_geometry (shapely.geometry.base.BaseGeometry): The AOI geometry.
+        prepared_geometry (shapely.geometry.base.BaseGeometry): A prepared copy of the AOI geometry
+            (see `AoiProjection.prepared_geometry`). Prepared on the fly if None.
 
     Returns:
-        str: Export path of the created folder.
+        geopandas.GeoDataFrame: The clipped features, in their original order (may be empty).
+    """
+    if gdf.empty:
+        return gdf
+    if prepared_geometry is None:
+        prepared_geometry = shapely.from_wkb(shapely.to_wkb(aoi_geometry))
+        shapely.prepare(prepared_geometry)
+    geometries = gdf.geometry.values
+    # Features intersecting the AOI, found through the bounding box index
+    tree = shapely.STRtree(geometries)
+    intersecting = np.sort(tree.query(aoi_geometry, predicate='intersects'))
+    # Features strictly inside the AOI are kept unchanged
+    inside = shapely.contains_properly(prepared_geometry, geometries[intersecting])
+    boundary = intersecting[~inside]
 
-    Raises:
-        OSError: If there is an error creating the folder.
+    clipped_gdf = gdf.iloc[intersecting].copy()
+    if len(boundary):
+        # Exact intersections only for the features crossing the AOI boundary
+        clipped = keep_geometry_family (shapely.intersection(geometries[boundary], aoi_geometry), geometries[boundary])
+        clipped_geometries = np.asarray(clipped_gdf.geometry.values, dtype=object)
+        clipped_geometries[~inside] = clipped
+        clipped_gdf = clipped_gdf.set_geometry(gpd.GeoSeries(clipped_geometries, index=clipped_gdf.index, crs=gdf.crs))
+    # Drop the features whose intersection is empty (e.g. touching the boundary only)
+    return clipped_gdf[~clipped_gdf.geometry.is_empty]
+def keep_geometry_family (clipped, originals):
     """
-    export_path = os.path.join(out_path, folder_name)
-    try:
-        # Create the folder
-        os.makedirs(export_path, exist_ok=True)
-        print(f"Folder created: {export_path}")
-    except FileExistsError:
-        print('Folder already exists', export_path)
-    return export_path
-def retrieve_links (url, cache):
+    Remove the parts of lower dimension that an intersection may add to a geometry (e.g. points
+    where a polygon touches the AOI boundary), so each output keeps the geometry type of its input.
+    Intersections made only of such parts (e.g. a polygon sharing an edge with the AOI) become empty.
+
+    Args:
+        clipped (numpy.ndarray): The intersection geometries.
+        originals (numpy.ndarray): The input geometries.
+
+    Returns:
+        numpy.ndarray: The intersection geometries without mixed geometry collections.
+    """
+    collection_rows = np.flatnonzero((shapely.get_type_id(clipped) == 7)
+                                     | (shapely.get_dimensions(clipped) < shapely.get_dimensions(originals)))
+    for index in collection_rows:
+        dimension = shapely.get_dimensions(originals[index])
+        parts = [part for part in shapely.get_parts(clipped[index]) if shapely.get_dimensions(part) == dimension]
+        # Rebuild a multi-part geometry of the input family
+        clipped[index] = shapely.union_all(parts) if parts else shapely.from_wkt('GEOMETRYCOLLECTION EMPTY')
+    return clipped
+def clip_geojson (aoi, geojson_out_path, stats=None):
+    """
+    Clips a GeoJSON file to the area of interest.
+
+    Args:
+        aoi (AoiCache): The area of interest.
+        geojson_out_path (str): The file path of the input GeoJSON file to be clipped.
+        stats (dict): A measurement (see `new_stats`) updated with the read, reproject and clip times and the feature counts.
+
+    Returns:
+        geopandas.GeoDataFrame: The clipped features in the shapefile CRS (may be empty).
+    """
+    stats = stats if stats is not None else new_stats ()
+    # Read the GeoJSON into a GeoDataFrame
+    with timed (stats, 'read'):
+        geojson_gdf = gpd.read_file(geojson_out_path)
+    stats['features_in'] += len(geojson_gdf)
+    if geojson_gdf.empty:
+        return geojson_gdf
+    # Convert the GeoJSON GeoDataFrame to the shapefile coordinate reference system (CRS) and clip it
+    projection = aoi.get()
+    with timed (stats, 'reproject'):
+        geojson_gdf = geojson_gdf.to_crs(aoi.crs)
+    with timed (stats, 'clip'):
+        clipped_gdf = clip_to_aoi (geojson_gdf, projection.geometry, projection.prepared_geometry ())
+    stats['features_out'] += len(clipped_gdf)
+    return clipped_gdf
+# The file extension and OGR driver of each output format ('parquet' is written with pyarrow)
+OUTPUT_FORMATS = {
+    'shp': ('.shp', 'ESRI Shapefile'),
+    'gpkg': ('.gpkg', 'GPKG'),
+    'fgb': ('.fgb', 'FlatGeobuf'),
+    'parquet': ('.parquet', None),
+}
+# The name of the GeoPackage holding every layer of a run
+GPKG_CONTAINER = 'extracted_data.gpkg'
+# GeoPackages are SQLite databases: a single thread writes to them at a time
+_CONTAINER_LOCK = threading.Lock()
+def output_folder (export_path, output_format='shp'):
     """
-    Retrieve all links from a webpage.
+    Create the folder of the layer outputs of a run.
 
     Args:
-        url (str): The URL of the webpage.
-        cache (dict): A dictionary to cache previously retrieved links.
+        export_path (str): The directory path of the run outputs.
+        output_format (str): The output format (see `OUTPUT_FORMATS`).
 
     Returns:
-        list: A list of links found on the webpage.
+        str: The folder of the layer files, or `export_path` for the GeoPackage container.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {', '.join(OUTPUT_FORMATS)}")
+    if output_format == 'gpkg':
+        return export_path
+    if output_format == 'parquet':
+        # Fail early rather than after hours of downloads
+        import pyarrow  # noqa: F401
+    return create_folder (export_path, output_format)
+class LayerWriter:
+    """
+    Write the clipped features of a layer, chunk after chunk, in the selected output format.
+
+    - 'shp': one ESRI Shapefile per layer.
+    - 'gpkg': one table per layer in a single GeoPackage ('extracted_data.gpkg').
+    - 'fgb': one FlatGeobuf file per layer.
+    - 'parquet': one GeoParquet file per layer (requires pyarrow).
+
+    A layer that fits in one chunk is written straight from the clipped frame in a single call. Larger
+    layers are appended to a temporary file next to the output (a GeoPackage without spatial index for
+    'gpkg' and 'fgb'), then copied in one transaction into the GeoPackage container or the FlatGeobuf file,
+    so their spatial index is built once, in bulk, when the layer is complete. The geometries of these layers
+    are promoted to their multi part type. Outputs only appear once complete.
+
+    Args:
+        out_dir (str): The folder of the output (see `output_folder`).
+        layer_name (str): The name of the layer, used as the file or table name.
+        output_format (str): The output format (see `OUTPUT_FORMATS`).
     """
-    if url in cache:
-            return cache[url]
+    def __init__ (self, out_dir, layer_name, output_format='shp'):
+        self.out_dir = out_dir
+        self.layer_name = layer_name
+        self.output_format = output_format
+        # A temporary folder per layer, removed once the layer is complete
+        self.partial_path = os.path.join(out_dir, f'.{layer_name}.partial')
+        self._first = None
+        self._chunks = 0
+        self._appended = 0
+        self._parquet = None
+
+    @property
+    def path (self):
+        """
+        str: The path of the output. GeoPackage tables are referenced as '<container>|layername=<table>'.
+        """
+        if self.output_format == 'gpkg':
+            return f'{os.path.join(self.out_dir, GPKG_CONTAINER)}|layername={self.layer_name}'
+        return os.path.join(self.out_dir, self.layer_name + OUTPUT_FORMATS[self.output_format][0])
+
+    def _partial_file (self, extension):
+        os.makedirs(self.partial_path, exist_ok=True)
+        return os.path.join(self.partial_path, self.layer_name + extension)
+
+    def write (self, clipped_gdf):
+        """
+        Append a chunk of clipped features.
+
+        Args:
+            clipped_gdf (geopandas.GeoDataFrame): The clipped features (empty chunks are ignored).
+        """
+        if clipped_gdf.empty:
+            return
+        self._chunks += 1
+        if self.output_format == 'shp':
+            # Suppress the UserWarning
+            warnings.filterwarnings("ignore", message="Column names longer than 10 characters will be truncated when saved to ESRI Shapefile.")
+            clipped_gdf.to_file(self._partial_file ('.shp'), mode='a' if self._chunks > 1 else 'w')
+            return
+        if self._chunks == 1:
+            # Keep the first chunk in memory, it is written directly if it is the only one
+            self._first = clipped_gdf
+            return
+        if self._first is not None:
+            self._append (self._first)
+            self._first = None
+        self._append (clipped_gdf)
+
+    def _append (self, clipped_gdf):
+        if self.output_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.table(clipped_gdf.to_arrow(geometry_encoding='WKB', index=False))
+            if self._parquet is None:
+                # The GeoParquet schema ('geo' metadata) of the layer, with untyped (all null) columns stored as text
+                buffer = io.BytesIO()
+                clipped_gdf.iloc[:0].to_parquet(buffer, index=False)
+                schema = pq.read_schema(pa.BufferReader(buffer.getvalue()))
+                for position, schema_field in enumerate(schema):
+                    if pa.types.is_null(schema_field.type):
+                        schema = schema.set(position, schema_field.with_type(pa.string()))
+                self._parquet = pq.ParquetWriter(self._partial_file ('.parquet'), schema, compression='zstd')
+            self._parquet.write_table(table.cast(self._parquet.schema))
+            return
+        # Spatial index built once the layer is complete. Chunks mix single and multi part geometries once
+        # clipped, all are promoted to the multi part type so the table keeps one geometry type
+        clipped_gdf.to_file(self._partial_file ('.gpkg'), layer=self.layer_name, driver='GPKG',
+                            mode='a' if self._appended else 'w', promote_to_multi=True, SPATIAL_INDEX='NO')
+        self._appended += 1
+
+    def close (self):
+        """
+        Finish the layer and move its output in place.
 
-    max_retries = 20
-    retry_count = 0
-    # Send a GET request to the URL
-    while retry_count <= max_retries:
+        Returns:
+            str: The path of the output (see `path`), or None if no feature was written.
+        """
+        if not self._chunks:
+            return None
+        if self.output_format == 'shp':
+            return move_shapefile (self.partial_path, self.out_dir, self.layer_name)
         try:
-            response = requests.get(url)
-            # Check if the request was successful (HTTP status code 200)
-            if response.status_code != 200:
-                print(url, "\nRequest failed with status code:", response.status_code)
-                return []
-            # Parse the HTML content using BeautifulSoup
-            soup = BeautifulSoup(response.content, 'html.parser')
-            # Find all <li> elements
-            li_tags = soup.find_all('li')
-            links = []
-            for li in li_tags:
-                if li.find_all('a'):
-                    # Find all <a> elements within the <li>
-                    a_tags = li.find_all('a')
-                    for a in a_tags:
-                        # Extract the link URL from the <a> element
-                        link = urljoin(url, a.get('href'))
-                        links.append(link)
-            return links
-        
-        except requests.exceptions.RequestException as e:
-            # print(f"An error occurred: {str(e)}")
-            # print("Retrying in 5 seconds...")
-            time.sleep(5)  # Wait for 5 seconds before retrying
-            retry_count += 1
-    print('Max_retries achieved for the following url: ', url)
-    return None
-def process_links(url, cache, visited):
+            if self._first is not None:
+                self._write_frame (self._first)
+                self._first = None
+            elif self.output_format == 'parquet':
+                self._parquet.close()
+                os.replace(self._partial_file ('.parquet'), self.path)
+            else:
+                self._copy_partial ()
+        except Exception:
+            self.abort ()
+            raise
+        if os.path.isdir(self.partial_path):
+            os.rmdir(self.partial_path)
+        return self.path
+
+    def _write_frame (self, clipped_gdf):
+        if self.output_format == 'gpkg':
+            with _CONTAINER_LOCK:
+                clipped_gdf.to_file(os.path.join(self.out_dir, GPKG_CONTAINER), layer=self.layer_name, driver='GPKG',
+                                    layer_options={'OVERWRITE': 'YES'})
+            return
+        partial_file = self._partial_file (OUTPUT_FORMATS[self.output_format][0])
+        if self.output_format == 'parquet':
+            clipped_gdf.to_parquet(partial_file, index=False, compression='zstd')
+        else:
+            clipped_gdf.to_file(partial_file, driver=OUTPUT_FORMATS[self.output_format][1])
+        os.replace(partial_file, self.path)
+
+    def _copy_partial (self):
+        import pyogrio.raw
+        partial_gpkg = self._partial_file ('.gpkg')
+        target = self._partial_file ('.fgb') if self.output_format == 'fgb' else os.path.join(self.out_dir, GPKG_CONTAINER)
+        lock = _CONTAINER_LOCK if self.output_format == 'gpkg' else contextlib.nullcontext()
+        # Stream the features in record batches, written in one transaction
+        with pyogrio.raw.open_arrow(partial_gpkg) as (meta, reader), lock:
+            pyogrio.raw.write_arrow(reader, target, layer=self.layer_name, driver=OUTPUT_FORMATS[self.output_format][1],
+                                    geometry_name=meta['geometry_name'], geometry_type=meta['geometry_type'],
+                                    crs=meta['crs'], layer_options={'OVERWRITE': 'YES'} if self.output_format == 'gpkg' else None)
+        os.remove(partial_gpkg)
+        if self.output_format == 'fgb':
+            os.replace(target, self.path)
+
+    def abort (self):
+        """
+        Remove the temporary files of the layer.
+        """
+        self._first = None
+        if self._parquet is not None:
+            self._parquet.close()
+        if os.path.isdir(self.partial_path):
+            for filename in os.listdir(self.partial_path):
+                os.remove(os.path.join(self.partial_path, filename))
+            os.rmdir(self.partial_path)
+def export_layer (clipped_gdf, layer_name, out_dir, output_format='shp'):
     """
-    Recursively process links from a starting URL.
+    Exports clipped features in the selected output format.
 
     Args:
-        url (str): The starting URL to process.
-        cache (dict): A dictionary to cache previously retrieved links.
-        visited (set): A set to keep track of visited URLs.
+        clipped_gdf (geopandas.GeoDataFrame): The clipped features.
+        layer_name (str): The name of the layer, used as the file or table name.
+        out_dir (str): The folder of the output (see `output_folder`).
+        output_format (str): The output format (see `OUTPUT_FORMATS`).
 
     Returns:
-        list: A list of processed links.
+        str: The path of the output (see `LayerWriter.path`).
     """
-    if url in visited:
-        return []
-    visited.add(url)  # Mark the current URL as visited
-    links = retrieve_links(url, cache)
-    processed_links = []
-  
-    for link in links:
-        if link not in visited:
-            # Process the link recursively
-            processed_links.append(link)
-            processed_links.extend(process_links(link, cache, visited))
-    return processed_links
-## Not used (API protection against attack)
-def process_links_mthread (url, cache, visited, num_threads):
+    writer = LayerWriter (out_dir, layer_name, output_format)
+    writer.write (clipped_gdf)
+    return writer.close ()
+# The area of interest of a CPU stage worker process, loaded once by `init_cpu_worker`
+_CPU_WORKER_AOI = None
+def init_cpu_worker (aoi):
+    """
+    Initialise a CPU stage worker process with the area of interest.
+
+    Args:
+        aoi (str): The path of the shapefile of the area of interest (read once per process).
+    """
+    global _CPU_WORKER_AOI
+    _CPU_WORKER_AOI = AoiCache (aoi)
+def clip_features (features, layer_json, aoi=None):
     """
-    Recursively process links from a starting URL.
+    Assemble, reproject and clip a chunk of features in the CPU stage.
 
     Args:
-        url (str): The starting URL to process.
-        cache (dict): A dictionary to cache previously retrieved links.
-        visited (set): A set to keep track of visited URLs.
+        features (FeaturePage): The features in EPSG:4326.
+        layer_json (dict): The JSON description of the layer.
+        aoi (AoiCache): The area of interest. Defaults to the one of the worker process (see `init_cpu_worker`).
 
     Returns:
-        list: A list of processed links.
+        tuple: A tuple containing two elements:
+            - geopandas.GeoDataFrame: The clipped features in the shapefile CRS (may be empty).
+            - dict: The decode, reproject and clip times and the feature counts (see `new_stats`).
     """
-    if url in visited:
-        return []
-    visited.add(url)  # Mark the current URL as visited
-    links = retrieve_links(url, cache)
-    processed_links = []
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-        futures = []
-        for link in links:
-            if link not in visited:
-                # Process the link asynchronously
-                future = executor.submit(process_links, link, cache, visited, num_threads)
-                futures.append(future)
-
-        for future in concurrent.futures.as_completed(futures):
-            processed_links.extend(future.result())
-
-    return processed_links
-def shp_info (shp):
-    # Read the shapefile using geopandas
-    shp_gdf = gpd.read_file(shp)
-    # # Read the shapefile Coordinate reference system (CRS) code
-    shp_crs = shp_gdf.crs
-    return shp_gdf, shp_crs 
-def run_esri2geojson (url, shp_bbox, crs, layer_name, export_path):
+    aoi = aoi or _CPU_WORKER_AOI
+    projection = aoi.get()
+    stats = new_stats ()
+    with timed (stats, 'decode'):
+        gdf = features_to_gdf (features, layer_json)
+    with timed (stats, 'reproject'):
+        gdf = gdf.to_crs(aoi.crs)
+    with timed (stats, 'clip'):
+        clipped_gdf = clip_to_aoi (gdf, projection.geometry, projection.prepared_geometry ())
+    stats['features_in'] += len(features)
+    stats['features_out'] += len(clipped_gdf)
+    return clipped_gdf, stats
+def clip_export_geojson (geojson_out_path, layer_name, out_dir, output_format='shp', write=True, aoi=None):
     """
-    Converts data from an Esri service to GeoJSON format using the 'esri2geojson' command-line tool.
+    Read, reproject and clip a GeoJSON file and export the result in the CPU stage.
 
     Args:
-        url (str): The URL of the Esri service.
-        shp_bbox (list): A list of four float values representing the bounding box coordinates in the order [minx, miny, maxx, maxy].
-        crs (str): The coordinate reference system (CRS) identifier.
-        layer_name (str): The name of the layer to be extracted.
-        export_path (str): The directory path where the exported GeoJSON file will be saved.
+        geojson_out_path (str): The file path of the GeoJSON file.
+        layer_name (str): The name of the layer, used as the file or table name.
+        out_dir (str): The folder of the output (see `output_folder`).
+        output_format (str): The output format (see `OUTPUT_FORMATS`).
+        write (bool): Export the clipped features. When False they are returned to be written by the
+            caller, e.g. to the GeoPackage container of the parent process.
+        aoi (AoiCache): The area of interest. Defaults to the one of the worker process (see `init_cpu_worker`).
 
     Returns:
-        str: The file path of the generated GeoJSON file.
+        tuple: A tuple containing two elements:
+            - str: The path of the output (or the clipped GeoDataFrame when `write` is False), or None
+              if no feature intersects the AOI.
+            - dict: The read, reproject, clip and write times and the feature counts (see `new_stats`).
+    """
+    stats = new_stats ()
+    clipped_gdf = clip_geojson (aoi or _CPU_WORKER_AOI, geojson_out_path, stats)
+    if clipped_gdf.empty:
+        return None, stats
+    if not write:
+        return clipped_gdf, stats
+    with timed (stats, 'write'):
+        out_path = export_layer (clipped_gdf, layer_name, out_dir, output_format)
+    return out_path, stats
+class CpuStage:
+    """
+    The CPU-bound stage of the pipeline (decoding, reprojection, clipping and writing).
 
-    Raises:
-        subprocess.CalledProcessError: If the 'esri2geojson' command fails to execute.
+    With `workers` > 0 the tasks run in a ProcessPoolExecutor, so they do not compete for the GIL
+    with the download threads. The workers are started by a fork server (spawned where it is not
+    available) rather than forked from a process whose threads may hold locks. At most `max_pending`
+    tasks are queued: download threads submitting more wait for a slot, which bounds memory. With
+    `workers` = 0 tasks run in the calling thread.
+
+    The callbacks of the tasks (writing to the GeoPackage container of this process, summaries and
+    manifest updates) run one at a time in a thread of this process, fed by a queue, rather than
+    in the thread collecting the results of the worker processes.
+
+    The worker processes import the main module of the program, so a script creating the stage must run
+    under `if __name__ == '__main__':`. The workers are started when the stage is created and a
+    RuntimeError is raised if they fail to start. Tasks submitted after a worker died fail with
+    `concurrent.futures.process.BrokenProcessPool` rather than waiting for a slot.
+
+    Args:
+        aoi (AoiCache): The area of interest. Worker processes read it once from `aoi.path`.
+        workers (int): The number of worker processes, 0 to run the tasks in the calling thread.
+        max_pending (int): The maximum number of tasks queued or running. Defaults to twice `workers`.
     """
-    geojson_out_path = os.path.join(export_path, 'geojson', f'{layer_name}.geojson')
-    # Check if a file with the same name exists, generate a unique name with incremental count if needed
-    count = 0
-    while os.path.exists(geojson_out_path):
-        count += 1
-        geojson_out_path = os.path.join(
-            export_path, 'geojson', f'{layer_name}_{str(count)}.geojson'
-        )
-    # Edit geometry for input
-    geometry_str = ''.join(['geometry=', ','.join([str(num) for num in shp_bbox])])
-    # Edit crs for input 
-    crs_str = ''.join(['inSR=', str(crs)]) 
-    # Concatenate the variables with spaces
-    command = ' '.join(['esri2geojson',url, '-p', geometry_str, '-p', crs_str, geojson_out_path])
-    # Execute the command
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
-    # Check the result
-    if result.returncode == 0:
-        pass
-    else:
-        # Log the error in 'error_log.csv' in the export_path
-        data = [layer_name, url, datetime.date.today()]
-        write_csv (os.path.join(export_path, 'error_log.csv'), data)
-        print(f'{url} An error occurred while executing the run_esri2geojson.')
-    return geojson_out_path
-def clip_geojson_export_shp (shp_crs, shp_gdf, geojson_out_path, shp_out_path):
+    def __init__ (self, aoi, workers=0, max_pending=None):
+        self.aoi = aoi
+        self.executor = None
+        if workers:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_cpu_worker,
+                                                                   initargs=(aoi.path,),
+                                                                   mp_context=multiprocessing.get_context(method))
+            try:
+                # Start the workers now, a worker failing to import the main module breaks the pool
+                self.executor.submit(os.getpid).result()
+            except (RuntimeError, concurrent.futures.BrokenExecutor) as e:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                raise RuntimeError(f'The CPU stage worker processes failed to start ({e}). Scripts using worker '
+                                   "processes must run under \"if __name__ == '__main__':\"") from e
+        self._slots = threading.BoundedSemaphore(max_pending or max(1, 2 * workers))
+        self._callbacks = queue.Queue()
+        self._callback_thread = threading.Thread(target=self._run_callbacks, name='cpu-stage-callbacks', daemon=True)
+        self._callback_thread.start()
+
+    def submit (self, fn, *args, callback=None):
+        """
+        Submit a task, waiting for a free slot when the stage is full.
+
+        Args:
+            fn (callable): A module-level function (it must be picklable) taking the area of interest
+                as an `aoi` keyword argument when it runs in this process.
+            *args: The arguments of the function.
+            callback (callable): Called with the future of the task once it is done, in the callback thread.
+
+        Returns:
+            concurrent.futures.Future: The future of the task.
+        """
+        if self.executor is None:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(fn(*args, aoi=self.aoi))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            # Backpressure: wait until the stage has room for another task
+            self._slots.acquire()
+            try:
+                future = self.executor.submit(fn, *args)
+            except Exception:
+                # A broken pool (a worker died) rejects new tasks, their slot is free again
+                self._slots.release()
+                raise
+            future.add_done_callback(lambda _: self._slots.release())
+        if callback is not None:
+            future.add_done_callback(lambda done: self._callbacks.put((callback, done)))
+        return future
+
+    def _run_callbacks (self):
+        while True:
+            item = self._callbacks.get()
+            if item is None:
+                return
+            callback, future = item
+            try:
+                callback (future)
+            except Exception as e:
+                print(f'An error occurred in a CPU stage callback: {e!r}')
+
+    def close (self):
+        """
+        Wait for the submitted tasks and their callbacks, and stop the worker processes.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        self._callbacks.put(None)
+        self._callback_thread.join()
+def check_layer_type (layer_json):
     """
-    Clips a GeoJSON file using a polygon GeoDataFrame and exports the clipped data to a shapefile.
+    Checks the type of layer in its JSON description and returns 'Vector' or 'Raster'.
 
     Args:
-        shp_crs (str): The Coordinate Reference System (CRS) of the shapefile.
-        shp_gdf (geopandas.GeoDataFrame): The polygon GeoDataFrame representing the area of interest for clipping.
-        geojson_out_path (str): The file path of the input GeoJSON file to be clipped.
-        shp_out_path (str): The directory path where the exported shapefile will be saved.
+        layer_json (dict): The JSON description of the layer.
 
     Returns:
-        tuple: A tuple containing two elements:
-            - bool: True if the clipped GeoDataFrame is empty, False otherwise.
-            - str: The file path of the exported shapefile.
-    """
-    # Suppress the UserWarning
-    warnings.filterwarnings("ignore", message="Column names longer than 10 characters will be truncated when saved to ESRI Shapefile.")
-    # Read the GeoJSON and shapefile into GeoDataFrames   
-    geojson_gdf = gpd.read_file(geojson_out_path)
-
-    # Check if the GeoJSON GeoDataFrame is not empty
-    if not geojson_gdf.empty:       
-        # Convert the GeoJSON GeoDataFrame to the shapefile coordinate reference system (CRS)
-        geojson_gdf = geojson_gdf.to_crs(shp_crs)
-        # Clip the GeoJSON with the shapefile
-        clipped_gdf = gpd.clip(geojson_gdf, shp_gdf)
-
-        # Check if the clipped GeoDataFrame is not empty
-        if not clipped_gdf.empty:
-            # Extract the file name without extension
-            output_shapefile = f'{os.path.splitext(os.path.basename(geojson_out_path))[0]}.shp'
-            # Create the full output shapefile path
-            out_path_shp = os.path.join(shp_out_path, output_shapefile)
-            # Export the clipped GeoDataFrame to a shapefile
-            clipped_gdf.to_file(out_path_shp)
-    # Return True if the clipped GeoDataFrame is empty, otherwise False
-    return clipped_gdf.empty, out_path_shp
-def check_layer_type (soup):
-    """
-    Checks the type of layer in the HTML content and returns 'Vector' or 'Raster'.
-
-    Args:
-        soup (BeautifulSoup): The BeautifulSoup object representing the HTML content.
-
-    Returns:
-        str: The layer type as 'Vector' if the content indicates a vector layer,
-        'Raster' if the content indicates a raster layer, or None if the layer type is not recognized.
-    """
-    # Find all tags that contain the text "esriGeometry"
-    cells = soup.find_all(lambda tag: tag.name == 'b' and 'Geometry Type:' in tag.text)
-    # Check if any cell contains the desired text
-    contains_esriGeometry = any('esriGeometry' in cell.next_sibling.strip() for cell in cells)
-    # Find all tags that contain the text "esriGeometry"
-    cells = soup.find_all(lambda tag: tag.name == 'b' and 'Type:' in tag.text)
-    # Check if any cell contains the desired text
-    contains_raster = any('Raster' in cell.next_sibling.strip() for cell in cells)
+        str: The layer type as 'Vector' if the description indicates a vector layer,
+        'Raster' if the description indicates a raster layer, or None if the layer type is not recognized.
+    """
+    # Vector layers have an esriGeometry type
+    contains_esriGeometry = 'esriGeometry' in (layer_json.get('geometryType') or '')
+    # Raster layers are 'Raster Layer' (image services are described as such by the crawler)
+    contains_raster = 'Raster' in (layer_json.get('type') or '')
 
     if contains_esriGeometry:
         return 'Vector'
@@ -246,13 +2867,13 @@ def check_layer_type (soup):
         return 'Raster'
     else:
         pass
-def info_to_sheets (export_path, soup, layer_name, url, out_path_shp, data_type):
+def info_to_sheets (sink, layer_json, layer_name, url, out_path_shp, data_type):
     """
-    Write extracted information to a CSV file.
+    Send extracted information to the summary of its data type.
 
    Args:
-        export_path (str): The directory path where the CSV file will be saved.
-        soup (BeautifulSoup): The BeautifulSoup object representing the parsed HTML content.
+        sink (ResultSink): The writer of the summaries.
+        layer_json (dict): The JSON description of the layer.
         layer_name (str): The name of the layer.
         url (str): The URL of the layer.
         out_path_shp (str): The file path of the exported shapefile (only applicable for 'vector' data_type).
@@ -261,20 +2882,18 @@ def info_to_sheets (export_path, soup, layer_name, url, out_path_shp, data_type)
     Returns:
         None
     """
-    # Define the file path
-    file_path = os.path.join(export_path, f'extracted_data_{data_type}.csv')
-    # Extract the geometry type from the soup object
-    geometry_type = soup.find('b', string='Geometry Type:').next_sibling.strip()
-    # Extract the description text from the soup object
-    description_text = soup.find('b', string='Description: ').next_sibling.strip()
+    # Extract the geometry type from the layer description
+    geometry_type = layer_json.get('geometryType') or ''
+    # Extract the description text from the layer description
+    description_text = (layer_json.get('description') or '').strip()
     # Extract the source from the layer_name by splitting it at underscores and taking the first part
     source = layer_name.split('_')[0]
     # Get the current date
     extraction_date = datetime.date.today()
     # Create a list containing the extracted data
     data = [source, layer_name, geometry_type, description_text, url, extraction_date, out_path_shp]
-    # Write the extracted data to the CSV file
-    write_csv (file_path, data)
+    # Send the extracted data to the summary
+    sink.put (data_type, data)
 def create_csv (export_path, data_type):
     # Define the file path
     csv_path = os.path.join(export_path, f'extracted_data_{data_type}.csv')
@@ -303,30 +2922,142 @@ def create_csv_error_log (export_path):
         if not file_exists:
             writer.writerow(columns)
     return csv_path
-def write_csv (file_path, data):
-    # Check if the file exists
-    file_exists = os.path.isfile(file_path)
-    # Write the extracted information to the CSV file
-    with open(file_path, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        # Write the new row of data
-        writer.writerow(data)
-def filter_layer_name_and_crs (soup):
+# Columns of the summaries written by ResultSink
+SUMMARY_COLUMNS = {
+    'vector': ['Source', 'Name', 'Geometry Type', 'Description', 'URL', 'Extraction Date', 'Out Path'],
+    'raster': ['Source', 'Name', 'Geometry Type', 'Description', 'URL', 'Extraction Date', 'Out Path'],
+    'error': ['Name', 'URL', 'Extraction Date'],
+}
+class ResultSink:
+    """
+    A single writer for the vector, raster and error summaries, fed by the workers through a queue.
+
+    Workers call `put` from any thread. One writer thread appends the rows to the CSV files
+    in batches, and each layer URL is recorded exactly once per summary: a row for a URL
+    already present in the CSV (from a previous run) replaces it when the sink is closed.
+
+    Args:
+        export_path (str): The directory path where the summaries are saved.
+        formats (tuple): Additional summary formats written on close: 'parquet' (requires pyarrow)
+            and/or 'sqlite' ('extracted_data.sqlite').
+        batch_size (int): The number of rows buffered before they are written.
+        flush_interval (float): The maximum time in seconds a row stays buffered.
+    """
+    def __init__ (self, export_path, formats=(), batch_size=100, flush_interval=5.0):
+        self.export_path = export_path
+        self.formats = tuple(formats)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if 'parquet' in self.formats:
+            # Fail early rather than after hours of downloads
+            import pyarrow  # noqa: F401
+        self.paths = {kind: self.csv_path (kind) for kind in SUMMARY_COLUMNS}
+        # Rows of previous runs keyed by URL, so rows are never duplicated
+        self.rows = {kind: self.read_rows (kind) for kind in SUMMARY_COLUMNS}
+        self._replaced = set()
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._run, name='result-sink', daemon=True)
+        self._writer.start()
+
+    def csv_path (self, kind):
+        """
+        Return the path of a CSV summary, creating it with its header if needed.
+        """
+        if kind == 'error':
+            return create_csv_error_log (self.export_path)
+        return create_csv (self.export_path, kind)
+
+    def read_rows (self, kind):
+        """
+        Read the rows already present in a CSV summary, keyed by URL.
+        """
+        url_index = SUMMARY_COLUMNS[kind].index('URL')
+        with open(self.paths[kind], newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)  # Skip the header
+            return {row[url_index]: row for row in reader if len(row) > url_index}
+
+    def put (self, kind, row):
+        """
+        Queue a row for a summary. Safe to call from any thread.
+
+        Args:
+            kind (str): The summary: 'vector', 'raster' or 'error'.
+            row (list): The row, in the order of `SUMMARY_COLUMNS[kind]`.
+        """
+        self._queue.put((kind, [str(value) for value in row]))
+
+    def _run (self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = False
+            if item:
+                batch.append(item)
+            if batch and (item is None or item is False or len(batch) >= self.batch_size):
+                self._flush (batch)
+                batch = []
+            if item is False or not batch:
+                deadline = time.monotonic() + self.flush_interval
+            if item is None:
+                return
+
+    def _flush (self, batch):
+        appended = {kind: [] for kind in SUMMARY_COLUMNS}
+        for kind, row in batch:
+            url = row[SUMMARY_COLUMNS[kind].index('URL')]
+            if url in self.rows[kind]:
+                if self.rows[kind][url] == row:
+                    continue
+                # A row of a previous run (or of this run) is replaced when the sink is closed
+                self._replaced.add(kind)
+            else:
+                appended[kind].append(row)
+            self.rows[kind][url] = row
+        for kind, rows in appended.items():
+            if rows:
+                with open(self.paths[kind], 'a', newline='') as csvfile:
+                    csv.writer(csvfile).writerows(rows)
+
+    def close (self):
+        """
+        Write the remaining rows, rewrite the CSV files with replaced rows and write the additional formats.
+        """
+        self._queue.put(None)
+        self._writer.join()
+        for kind in self._replaced:
+            with open(self.paths[kind], 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(SUMMARY_COLUMNS[kind])
+                writer.writerows(self.rows[kind].values())
+        if 'sqlite' in self.formats:
+            with sqlite3.connect(os.path.join(self.export_path, 'extracted_data.sqlite')) as connection:
+                for kind, columns in SUMMARY_COLUMNS.items():
+                    table = f'extracted_data_{kind}'
+                    connection.execute(f'DROP TABLE IF EXISTS {table}')
+                    connection.execute(f"CREATE TABLE {table} ({', '.join(f'[{column}] TEXT' for column in columns)})")
+                    connection.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})", self.rows[kind].values())
+        if 'parquet' in self.formats:
+            for kind, columns in SUMMARY_COLUMNS.items():
+                frame = pd.DataFrame(list(self.rows[kind].values()), columns=columns)
+                frame.to_parquet(os.path.join(self.export_path, f'extracted_data_{kind}.parquet'), index=False)
+def filter_layer_name_and_crs (layer_json):
     """
-    Filter and format the layer name extracted from the HTML soup and extract the coordinate reference system (CRS).
+    Filter and format the layer name extracted from the layer description and extract the coordinate reference system (CRS).
 
     Args:
-        soup (BeautifulSoup): The BeautifulSoup object representing the parsed HTML content.
+        layer_json (dict): The JSON description of the layer.
 
     Returns:
         tuple: A tuple containing two elements:
             - str: The filtered and formatted layer name.
             - int: The extracted coordinate reference system (CRS) identifier.
     """
-    # Check if the page has a 'Name' section
-    name_tag = soup.find('b', string='Name:')
-    # Get the text of the next sibling of the 'Name' section
-    layer_name = name_tag.next_sibling.strip()
+    # Get the layer name
+    layer_name = (layer_json.get('name') or '').strip()
     # Extract content within brackets
     # The pattern '\((.*?)\)' matches anything within parentheses and captures the content inside the parentheses
     values_in_parentheses = re.findall(r'\((.*?)\)', layer_name)
@@ -343,132 +3074,872 @@ def filter_layer_name_and_crs (soup):
         # Remove the matched values within parentheses from the layer_name
         layer_name = layer_name.replace(f"({valid_values})", '').strip()
     else:
-        # The layer name does not have values within parentheses, check for 'Parent Layer' section
-        parent_layer_tag = soup.find('b', string='Parent Layer:')
-
-        if parent_layer_tag:
-            # Get the text of the next sibling of the 'Parent Layer' section
-            parent_layer = parent_layer_tag.next_sibling.strip()
-            # Check if there is a link inside 'Parent Layer'
-            parent_layer_link = parent_layer_tag.find_next_sibling('a')
-
-            if parent_layer_link:
-                # Extract content within parentheses from the link
-                values_in_parentheses = re.findall(r'\((.*?)\)', ''.join(parent_layer_link))
-                # Find the values within parentheses that contain both letters and numbers
-                valid_values = [value for value in values_in_parentheses if re.match(r'^(?=.*[A-Za-z])(?=.*\d)[A-Za-z0-9]+', value)]
-                # If multiple valid values were found, select the last one
-                if len(valid_values) > 1:
-                    valid_values = valid_values[-1]
-                else:
-                    valid_values = ''.join(valid_values)
+        # The layer name does not have values within parentheses, check the parent layer
+        parent_layer = layer_json.get('parentLayer') or {}
+
+        if parent_layer.get('name'):
+            # Extract content within parentheses from the parent layer name
+            values_in_parentheses = re.findall(r'\((.*?)\)', parent_layer['name'])
+            # Find the values within parentheses that contain both letters and numbers
+            valid_values = [value for value in values_in_parentheses if re.match(r'^(?=.*[A-Za-z])(?=.*\d)[A-Za-z0-9]+', value)]
+            # If multiple valid values were found, select the last one
+            if len(valid_values) > 1:
+                valid_values = valid_values[-1]
+            else:
+                valid_values = ''.join(valid_values)
 
     # Concatenate the values within parentheses (if any) and the layer_name
     layer_name = f"{valid_values}_{layer_name}"
     # Replace non-alphanumeric characters with underscores
     layer_name = re.sub(r'\W+', '_', layer_name) 
 
-    pattern = re.compile(r'Spatial Reference:\s*(\d+)')
-    match = soup.find(string=pattern)
-    crs = int(pattern.search(match).group(1))
+    return layer_name, layer_crs (layer_json)
+def layer_crs (layer_json):
+    """
+    Extract the coordinate reference system of a layer from its JSON description.
+
+    Args:
+        layer_json (dict): The JSON description of the layer.
 
-    return layer_name, crs
-def retrieve_raster_coords (soup, coord_name):
+    Returns:
+        int: The well-known id of the spatial reference of the layer extent, preferring the latest one.
+    """
+    spatial_reference = (layer_json.get('extent') or {}).get('spatialReference') or layer_json.get('spatialReference') or {}
+    return spatial_reference.get('latestWkid') or spatial_reference.get('wkid')
+def retrieve_raster_coords (layer_json, coord_name):
     """
-    Retrieve a specific coordinate value from the HTML content using a regular expression.
+    Retrieve a specific coordinate value of the layer extent.
 
     Args:
-        soup (BeautifulSoup): The BeautifulSoup object representing the parsed HTML content.
-        coord_name (str): The name of the coordinate value to be retrieved.
+        layer_json (dict): The JSON description of the layer.
+        coord_name (str): The name of the coordinate value to be retrieved ('xmin', 'ymin', 'xmax' or 'ymax').
 
     Returns:
-        str: The extracted coordinate value as a string.
-    """ 
-    # Define a regular expression pattern to find the coordinate values
-    pattern = re.compile(fr'{coord_name}:\s*(-?\d+\.\d+)')
-    # Find the first matching string in the HTML using the provided pattern
-    match = soup.find(string=pattern)
-    # Use the regular expression pattern to extract the coordinate value and return it as a string
-    return pattern.search(match).group(1)
-def raster_bbox (soup, crs, shp_bbox):
+        float: The extracted coordinate value.
+    """
+    return float(layer_json['extent'][coord_name])
+def raster_bbox (layer_json, crs, aoi_envelope):
     """
     Check if the raster bounding box intersects with the shapefile bounding box.
 
     Args:
-        soup (BeautifulSoup): The BeautifulSoup object representing the parsed HTML content.
+        layer_json (dict): The JSON description of the layer.
         crs (str): The coordinate reference system (CRS) identifier of the raster.
-        shp_bbox (geopandas.GeoSeries): The bounding box of the shapefile as a GeoSeries.
+        aoi_envelope (shapely.geometry.base.BaseGeometry): The envelope of the shapefile in the raster CRS.
 
     Returns:
         bool: True if the raster bounding box intersects with the shapefile bounding box, False otherwise.
     """
-    # Retrieve the raster bounding box coordinates from the soup HTML content
-    xmin = retrieve_raster_coords (soup, 'XMin')
-    ymin = retrieve_raster_coords (soup, 'YMin')
-    xmax = retrieve_raster_coords (soup, 'XMax')
-    ymax = retrieve_raster_coords (soup, 'YMax')
-    # Create a polygon representing the raster bounding box
-    polygon = Polygon([(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)])
-    # Create a GeoDataFrame to store the raster bounding box with the specified CRS
-    data = {'Spatial_Reference': [crs], 'geometry': [polygon]}
-    raster_gdf = gpd.GeoDataFrame(data, crs=crs)
-    # Check if the raster bounding box intersects with the shapefile bounding box
-    return raster_gdf.intersects(shp_bbox.unary_union)
+    # Retrieve the raster bounding box coordinates from the layer extent
+    xmin = retrieve_raster_coords (layer_json, 'xmin')
+    ymin = retrieve_raster_coords (layer_json, 'ymin')
+    xmax = retrieve_raster_coords (layer_json, 'xmax')
+    ymax = retrieve_raster_coords (layer_json, 'ymax')
+    # Check if the raster bounding box intersects with the shapefile bounding box (both in the raster CRS)
+    return shapely.box(xmin, ymin, xmax, ymax).intersects(aoi_envelope)
+def spatial_reference_param (crs):
+    """
+    Format a CRS as an ArcGIS REST spatial reference parameter (`bboxSR`, `imageSR`...).
+
+    Args:
+        crs (pyproj.CRS): The CRS.
+
+    Returns:
+        str: The EPSG code, or a JSON spatial reference with the ESRI WKT if the CRS has no EPSG code.
+    """
+    epsg = crs.to_epsg()
+    if epsg:
+        return str(epsg)
+    from pyproj.enums import WktVersion
+    return json.dumps({'wkt': crs.to_wkt(WktVersion.WKT1_ESRI)})
+# The numpy data types of the Esri pixel types (sub-byte types are exported as bytes)
+ESRI_PIXEL_TYPES = {'U1': 'uint8', 'U2': 'uint8', 'U4': 'uint8', 'U8': 'uint8', 'S8': 'int8', 'U16': 'uint16', 'S16': 'int16',
+                    'U32': 'uint32', 'S32': 'int32', 'F32': 'float32', 'F64': 'float64'}
+def raster_pixel_format (layer):
+    """
+    Return the data type and nodata value of the exported pixels of a raster layer.
+
+    Image services declare them with `pixelType` and `noDataValue`. Map services are exported as
+    8-bit RGBA PNG, where transparent pixels are 0.
+
+    Args:
+        layer (LayerInfo): The raster layer.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - str: The numpy data type, or None if the service does not declare a supported pixel type.
+            - float: The nodata value, or None if the service does not declare one.
+    """
+    if service_url_type (layer.url) != 'ImageServer':
+        return 'uint8', 0
+    return ESRI_PIXEL_TYPES.get(layer.metadata.get('pixelType')), layer.metadata.get('noDataValue')
+def raster_export_request (layer, max_size):
+    """
+    Return the export endpoint of a raster layer and its fixed request parameters.
+
+    Image services are exported with `exportImage` as GeoTIFF, raster layers of map services with the
+    `export` operation of the map service restricted to the layer (PNG with transparency).
+
+    Args:
+        layer (LayerInfo): The raster layer.
+        max_size (int): The maximum tile size in pixels requested.
+
+    Returns:
+        tuple: A tuple containing three elements:
+            - str: The URL of the export endpoint.
+            - dict: The fixed query parameters.
+            - int: The tile size in pixels, within the maximum image size of the service.
+    """
+    metadata = layer.metadata
+    tile_size = min(max_size, int(metadata.get('maxImageWidth') or max_size), int(metadata.get('maxImageHeight') or max_size))
+    if service_url_type (layer.url) == 'ImageServer':
+        params = {'format': 'tiff', 'f': 'image', 'interpolation': 'RSP_BilinearInterpolation'}
+        if metadata.get('pixelType') in ESRI_PIXEL_TYPES:
+            # Every tile in the pixel type of the service
+            params['pixelType'] = metadata['pixelType']
+        return f"{layer.url.rstrip('/')}/exportImage", params, tile_size
+    return f"{layer.service_url.rstrip('/')}/export", {'format': 'png32', 'transparent': 'true', 'f': 'image',
+                                                        'layers': f'show:{layer.id}'}, tile_size
+def raster_tile_grid (bounds, resolution, tile_size):
+    """
+    Cover a bounding box with a grid of tiles.
+
+    Args:
+        bounds (list): The bounding box as [minx, miny, maxx, maxy].
+        resolution (float): The pixel size in the units of the bounding box CRS.
+        tile_size (int): The tile width and height in pixels.
+
+    Returns:
+        tuple: A tuple containing three elements:
+            - int: The width of the grid in pixels.
+            - int: The height of the grid in pixels.
+            - list: A list of (column offset, row offset, width, height, tile bounds) tuples, row by row.
+    """
+    minx, miny, maxx, maxy = bounds
+    width = max(1, math.ceil((maxx - minx) / resolution))
+    height = max(1, math.ceil((maxy - miny) / resolution))
+    tiles = []
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            tile_width, tile_height = min(tile_size, width - col_off), min(tile_size, height - row_off)
+            # Pixel edges from the top left corner of the grid
+            left, top = minx + col_off * resolution, maxy - row_off * resolution
+            tiles.append((col_off, row_off, tile_width, tile_height,
+                          (left, top - tile_height * resolution, left + tile_width * resolution, top)))
+    return width, height, tiles
+def fetch_raster_tile (transport, export_url, params, tile_bounds, tile_width, tile_height, layer_url=None):
+    """
+    Fetch one tile of a raster export.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        export_url (str): The URL of the `exportImage` or `export` endpoint.
+        params (dict): The fixed query parameters (format, spatial references...).
+        tile_bounds (tuple): The tile bounds (minx, miny, maxx, maxy) in the output CRS.
+        tile_width (int): The tile width in pixels.
+        tile_height (int): The tile height in pixels.
+        layer_url (str): The URL of the raster layer, the request is counted against it in the metrics.
+
+    Returns:
+        bytes: The encoded image.
+
+    Raises:
+        RuntimeError: If the tile could not be retrieved or the server returned an error instead of an image.
+    """
+    tile_params = {**params, 'bbox': ','.join(str(value) for value in tile_bounds), 'size': f'{tile_width},{tile_height}'}
+    response = transport.get (export_url, params=tile_params, retry_json_errors=True, layer_url=layer_url)
+    if response is None or response.status_code != 200:
+        raise RuntimeError(f'Could not retrieve a tile of {export_url}')
+    # Errors of image requests are reported as JSON with a 200 status
+    if 'json' in response.headers.get('Content-Type', '') or response.content[:1] == b'{':
+        raise RuntimeError(f'{export_url} returned an error instead of an image: {response.text[:200]}')
+    return response.content
+def export_raster_tiff (transport, layer, aoi, tif_out_path, resolution=None, tile_size=1024, tile_threads=4, max_in_flight=None):
+    """
+    Extract the pixels of a raster layer over the area of interest into a tiled, compressed GeoTIFF.
+
+    The AOI envelope, in the shapefile CRS, is covered with a grid of tiles at `resolution` that are
+    fetched concurrently through `exportImage` (image services) or `export` (map services). Tiles
+    outside the AOI are not requested. Tiles are written into the GeoTIFF as they arrive, with the
+    pixels outside the AOI set to nodata, so at most `max_in_flight` tiles are held in memory whatever
+    the size of the output. The GeoTIFF is written next to its final path and moved in place once complete.
+
+    The data type and nodata value of the GeoTIFF are those declared by the service (see `raster_pixel_format`),
+    or those of the first tile if it declares none. Tiles in another data type are converted when the
+    conversion is lossless, their own nodata pixels are set to the nodata value of the GeoTIFF.
+
+    Requires rasterio.
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        layer (LayerInfo): The raster layer.
+        aoi (AoiCache): The area of interest.
+        tif_out_path (str): The file path of the GeoTIFF.
+        resolution (float): The pixel size in the units of the shapefile CRS. Defaults to 1/4096 of the longer
+            side of the AOI envelope.
+        tile_size (int): The tile width and height in pixels (within the maximum image size of the service).
+        tile_threads (int): The maximum number of tiles fetched concurrently.
+        max_in_flight (int): The maximum number of tiles requested but not yet written. Defaults to twice `tile_threads`.
+
+    Returns:
+        str: The file path of the GeoTIFF, or None if no tile intersects the AOI.
+
+    Raises:
+        ImportError: If rasterio is not installed.
+        RuntimeError: If a tile could not be retrieved, or its band count or data type does not match the GeoTIFF.
+    """
+    try:
+        import rasterio
+        import rasterio.features
+        from rasterio.io import MemoryFile
+        from rasterio.transform import from_origin
+        from rasterio.windows import Window
+    except ImportError as e:
+        raise ImportError('Raster extraction requires rasterio (pip install rasterio)') from e
+
+    projection = aoi.get()
+    minx, miny, maxx, maxy = projection.bounds
+    resolution = resolution or max(maxx - minx, maxy - miny) / 4096
+    export_url, params, tile_size = raster_export_request (layer, tile_size)
+    dtype, nodata = raster_pixel_format (layer)
+    spatial_reference = spatial_reference_param (aoi.crs)
+    params = {**params, 'bboxSR': spatial_reference, 'imageSR': spatial_reference}
+    width, height, tiles = raster_tile_grid (projection.bounds, resolution, tile_size)
+    # Only request the tiles that intersect the AOI
+    prepared_geometry = projection.prepared_geometry ()
+    tiles = [tile for tile in tiles if prepared_geometry.intersects(shapely.box(*tile[4]))]
+    if not tiles:
+        return None
+    transform = from_origin(minx, maxy, resolution, resolution)
+    aoi_shapes = [geometry for geometry in projection.gdf.geometry if geometry is not None and not geometry.is_empty]
+
+    partial_path = f'{tif_out_path}.partial'
+    dataset = None
+    max_in_flight = max_in_flight or tile_threads * 2
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(tile_threads, max_in_flight)) as executor:
+            # Keep a bounded window of tiles in flight and write them in order
+            in_flight = collections.deque()
+            pending = iter(tiles)
+
+            def submit (tile):
+                col_off, row_off, tile_width, tile_height, tile_bounds = tile
+                in_flight.append((tile, executor.submit(fetch_raster_tile, transport, export_url, params,
+                                                        tile_bounds, tile_width, tile_height, layer.url)))
+
+            for tile in itertools.islice(pending, max_in_flight):
+                submit (tile)
+            while in_flight:
+                tile, future = in_flight.popleft()
+                for next_tile in itertools.islice(pending, 1):
+                    submit (next_tile)
+                col_off, row_off, tile_width, tile_height, tile_bounds = tile
+                try:
+                    content = future.result()
+                except Exception:
+                    for _, other in in_flight:
+                        other.cancel()
+                    raise
+                with MemoryFile(content) as memory_file, memory_file.open() as tile_dataset:
+                    pixels = tile_dataset.read(out_shape=(tile_dataset.count, tile_height, tile_width))
+                    tile_nodata = tile_dataset.nodata
+                if dataset is None:
+                    # The band count of the output is that of the first tile, its data type and nodata those
+                    # of the service if it declares them
+                    dtype = np.dtype(dtype or pixels.dtype)
+                    nodata = nodata if nodata is not None else tile_nodata
+                    nodata = nodata if nodata is not None else (0 if dtype.kind in 'ui' else float('nan'))
+                    dataset = rasterio.open(partial_path, 'w', driver='GTiff', width=width, height=height,
+                                            count=pixels.shape[0], dtype=dtype, crs=aoi.crs, transform=transform,
+                                            nodata=nodata, tiled=True, blockxsize=256, blockysize=256,
+                                            compress='deflate', predictor=2, BIGTIFF='IF_SAFER')
+                if pixels.shape[0] != dataset.count:
+                    raise RuntimeError(f'{export_url} returned a tile with {pixels.shape[0]} bands instead of {dataset.count}')
+                if pixels.dtype != dtype:
+                    if not np.can_cast(pixels.dtype, dtype):
+                        raise RuntimeError(f'{export_url} returned a {pixels.dtype} tile, the raster is {dtype}')
+                    pixels = pixels.astype(dtype)
+                if tile_nodata is not None and not (tile_nodata == nodata or np.isnan(tile_nodata) and np.isnan(nodata)):
+                    # The nodata pixels of the tile in the nodata value of the output
+                    pixels[np.isnan(pixels) if np.isnan(tile_nodata) else pixels == tile_nodata] = nodata
+                # Pixels outside the AOI are nodata
+                outside = rasterio.features.geometry_mask(aoi_shapes, out_shape=(tile_height, tile_width),
+                                                          transform=rasterio.transform.from_bounds(*tile_bounds, tile_width, tile_height))
+                pixels[:, outside] = nodata
+                dataset.write(pixels, window=Window(col_off, row_off, tile_width, tile_height))
+    except Exception:
+        if dataset is not None:
+            dataset.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    dataset.close()
+    os.replace(partial_path, tif_out_path)
+    return tif_out_path
+@dataclass
+class DownloadOptions:
+    """
+    The output folders and settings shared by every `download_data` call of a run.
+
+    Attributes:
+        export_path (str): The directory path where the exported data will be saved.
+        shp_out_path (str): The folder of the layer outputs (see `output_folder`).
+        page_threads (int): The maximum number of query pages fetched concurrently per layer.
+        stream (bool): Stream features through the clip into the output instead of writing intermediate GeoJSON files.
+        max_memory_mb (int): The approximate memory ceiling per layer in streaming mode, in megabytes.
+        spatial_filter (str): The server-side spatial filter: 'bbox' (AOI bounding box) or 'polygon' (AOI polygon).
+        max_geometry_chars (int): The maximum size of the AOI polygon JSON sent to the server, in characters.
+        raster (bool): Extract the pixels of the raster layers over the AOI into GeoTIFF files (requires rasterio).
+        raster_resolution (float): The pixel size of the GeoTIFF files in the units of the shapefile CRS.
+            Defaults to 1/4096 of the longer side of the AOI envelope.
+        raster_tile_size (int): The width and height in pixels of the tiles requested from the server.
+        output_format (str): The format of the vector outputs (see `OUTPUT_FORMATS`).
+        transfer_format (str): The format of the query responses: 'auto' (PBF when the layer supports it), 'pbf' or 'json'.
+        geometry_params (dict): Server-side geometry options added to every query (see `geometry_query_params`).
+        layer_page_threads (dict): The query pages fetched concurrently for the layers split across more threads
+            than `page_threads`, by layer URL (see `schedule_layers`).
+    """
+    export_path: str
+    shp_out_path: str
+    page_threads: int = 4
+    stream: bool = False
+    max_memory_mb: int = 512
+    spatial_filter: str = 'bbox'
+    max_geometry_chars: int = 20000
+    raster: bool = False
+    raster_resolution: float = None
+    raster_tile_size: int = 1024
+    output_format: str = 'shp'
+    transfer_format: str = 'auto'
+    geometry_params: dict = field(default_factory=dict)
+    layer_page_threads: dict = field(default_factory=dict)
+
+    @property
+    def signature (self):
+        """
+        str: A hash of the settings shaping the outputs, recorded in the manifest with every written layer.
+        """
+        settings = [self.output_format, self.spatial_filter, self.transfer_format, self.geometry_params,
+                    self.raster, self.raster_resolution, self.raster_tile_size]
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+def aoi_query_params (aoi, crs, options):
+    """
+    Build the spatial filter of a layer query on the AOI bounding box or polygon in the layer CRS.
+
+    Args:
+        aoi (AoiCache): The area of interest (or group of AOIs).
+        crs (int): The CRS of the layer.
+        options (DownloadOptions): The spatial filter settings.
+
+    Returns:
+        dict: The query parameters.
+
+    Raises:
+        ValueError: If the layer or the AOI has no CRS, the server would read the filter in its default one.
+    """
+    if crs is None or aoi.crs is None:
+        raise ValueError('Cannot build a spatial filter without a CRS: '
+                         + ('the layer has no spatial reference' if crs is None else 'the area of interest has no CRS'))
+    if options.spatial_filter == 'polygon':
+        return polygon_query_params (aoi.polygon_json (crs, options.max_geometry_chars), crs)
+    return bbox_query_params (aoi.get(crs).bounds, crs)
+def count_layer_features (transport, layer, query_params):
+    """
+    Count the features of a layer matching a query (`returnCountOnly`).
+
+    Args:
+        transport (HttpTransport): The transport used to send requests.
+        layer (LayerInfo): The layer.
+        query_params (dict): The query parameters (spatial filter...).
+
+    Returns:
+        int: The number of matching features, or None if the count failed.
+    """
+    response = transport.get_json (f"{layer.url.rstrip('/')}/query", {**query_params, 'returnCountOnly': 'true'})
+    if response is None or 'count' not in response:
+        return None
+    return int(response['count'])
+def schedule_layers (layers, transport, aoi, options, num_threads, count_threads=8, manifest=None):
+    """
+    Count the features of the vector layers inside the AOI and order the layers largest first.
+
+    Layers without features in the AOI are dropped. A layer holding more than the share of one worker
+    (the total feature count divided by `num_threads`) gets its pages fetched by proportionally more
+    threads, so it does not finish long after the others. Layers that could not be counted come first,
+    as they may be large, then the counted ones and raster layers. Layers that the manifest will
+    skip as up to date are not counted and come last.
+
+    Args:
+        layers (list): The LayerInfo of the catalog. Their `feature_count` is set.
+        transport (HttpTransport): The transport used to send requests.
+        aoi (AoiCache): The area of interest.
+        options (DownloadOptions): The download settings. Its `layer_page_threads` is set.
+        num_threads (int): The number of layers processed concurrently.
+        count_threads (int): The maximum number of concurrent count requests.
+        manifest (RunManifest): The run manifest, used to leave out the layers up to date. Defaults to None.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - list: The layers to download, largest first.
+            - list: The vector layers without features in the AOI.
+    """
+    up_to_date = {layer.url for layer in layers if manifest is not None and manifest.is_up_to_date (layer)}
+    vectors = [layer for layer in layers if layer.type == 'Vector' and layer.url not in up_to_date]
+
+    def count (layer):
+        try:
+            return count_layer_features (transport, layer, aoi_query_params (aoi, layer_crs (layer.metadata), options))
+        except Exception as e:
+            # e.g. a CRS unknown to pyproj, the layer is scheduled as not counted and fails on its own
+            print(f'{layer.url} An error occurred while counting the layer features: {e}')
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=count_threads) as executor:
+        for layer, feature_count in zip(vectors, executor.map(count, vectors)):
+            layer.feature_count = feature_count
+    empty = [layer for layer in vectors if layer.feature_count == 0]
+    scheduled = [layer for layer in layers if layer.type != 'Vector' or layer.feature_count != 0]
+    scheduled.sort(key=lambda layer: (layer.url in up_to_date, layer.type != 'Vector', layer.feature_count is not None,
+                                      -(layer.feature_count or 0)))
+
+    # Split the layers larger than the share of one worker across more page threads
+    share = sum(layer.feature_count or 0 for layer in scheduled) / num_threads
+    for layer in scheduled:
+        if share and (layer.feature_count or 0) > share:
+            pages = math.ceil(layer.feature_count / (layer.max_record_count or 1000))
+            options.layer_page_threads[layer.url] = min(options.page_threads * math.ceil(layer.feature_count / share),
+                                                        options.page_threads * num_threads, max(pages, options.page_threads))
+    return scheduled, empty
+def record_layer_error (layer, error, manifest, metrics, sinks):
+    """
+    Record a layer whose processing failed with an error not handled by `download_data`.
+
+    Args:
+        layer (LayerInfo): The layer.
+        error (Exception): The error raised while processing the layer.
+        manifest (RunManifest): The run manifest, the layer state is set to 'error'.
+        metrics (RunMetrics): The instrumentation, the layer state is set to 'error'.
+        sinks (list): The ResultSink receiving the error, one per AOI.
+
+    Returns:
+        None
+    """
+    print(f'{layer.url} An error occurred while processing the layer: {error!r}')
+    layer_name = manifest.layer_name (layer.url, filter_layer_name_and_crs (layer.metadata)[0])
+    for sink in sinks:
+        # Log the error in 'error_log.csv' in the export_path
+        sink.put ('error', [layer_name, layer.url, datetime.date.today()])
+    manifest.update (layer.url, 'error')
+    metrics.layer (layer.url, name=layer.name, type=layer.type, state='error')
 def download_data (args):
     """
-    Downloads data from the given URL, processes it, exports the extracted information to a GeoJSON file,
+    Downloads data from the given layer, processes it, exports the extracted information to a GeoJSON file,
     clips the GeoJSON to the shapefile, and summarises the results in two spreadsheets for vectors and rasters.
 
+    The layer description captured during the crawl is reused, so the layer page is not requested again.
+
+    Downloads run in the calling thread, while decoding, reprojection, clipping and writing run in the CPU stage.
+    In streaming mode, vector features flow page by page through reprojection and clipping
+    straight into the layer output, without the intermediate GeoJSON file.
+
     Args:
         args (tuple): A tuple containing the following elements:
-            url (str): The URL of the webpage containing the data.
-            shp (str): The path to the shapefile.
-            export_path (str): The directory path where the exported data will be saved.
-            shp_out_path (str): The directory path where the exported shapefile will be saved.
+            layer (LayerInfo): The layer discovered by the crawler.
+            transport (HttpTransport): The transport used to send requests.
+            aoi (AoiCache): The area of interest shared by all workers.
+            manifest (RunManifest): The run manifest used to skip up-to-date layers and record progress.
+            sink (ResultSink): The writer of the vector, raster and error summaries.
+            cpu_stage (CpuStage): The stage where features are decoded, reprojected, clipped and written.
+            options (DownloadOptions): The output folders and download settings.
+            metrics (RunMetrics): The instrumentation recording the stages, requests and features of each layer.
 
     Returns:
         None
     """
     # Unpack args
-    url, shp, export_path, shp_out_path = args
-    # Get the bounding box and CRS of the shapefile
-    shp_gdf, shp_crs = shp_info (shp)
-     # Send a GET request to the URL
-    response = requests.get(url)
-    # Check if the request was successful (HTTP status code 200)
-    if response.status_code == 200:
-        # Parse the HTML content using BeautifulSoup
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        if check_layer_type (soup) == 'Vector':
-            # Extract and filter the layer name from the HTML content
-            layer_name, crs = filter_layer_name_and_crs (soup)
-            # Convert the geometry to the specified CRS and calculate the bounding box
-            shp_bbox = list(shp_gdf.to_crs(crs).total_bounds)
-            # Extract page data to GeoJSON
-            geojson_out_path = run_esri2geojson (url, shp_bbox, crs, layer_name, export_path)
-            # Clip the downloaded GeoJSON with the shapefile and save the clipped result as a shapefile
-            clipped_status, out_path_shp = clip_geojson_export_shp (shp_crs, shp_gdf, geojson_out_path, shp_out_path)
-
-            if not clipped_status:
-                # Export information to sheets
-                layer_name = os.path.splitext(os.path.basename(out_path_shp))[0]
-                info_to_sheets (export_path, soup, layer_name, url, out_path_shp, 'vector')
+    layer, transport, aoi, manifest, sink, cpu_stage, options, metrics = args
+    export_path, shp_out_path = options.export_path, options.shp_out_path
+    url, layer_json = layer.url, layer.metadata
+    # Layers larger than the share of one worker fetch their pages with more threads
+    page_threads = options.layer_page_threads.get(url, options.page_threads)
+    layer_type = check_layer_type (layer_json)
+    metrics.layer (url, name=layer.name, type=layer_type)
+    # Skip layers written by a previous run that were not edited since
+    if not manifest.discover (layer):
+        metrics.layer (url, state='skipped')
+        return
 
-        elif check_layer_type (soup) == 'Raster':
-            # Extract and filter the layer name from the HTML content
-            layer_name, crs = filter_layer_name_and_crs (soup)
-            # Convert the geometry to the specified CRS and calculate the bounding box
-            shp_bbox = shp_gdf.to_crs(crs).envelope
+    if layer_type == 'Vector':
+        # Extract and filter the layer name from the layer description
+        layer_name, crs = filter_layer_name_and_crs (layer_json)
+        layer_name = manifest.layer_name (url, layer_name)
+        # Spatial filter on the shapefile bounding box or polygon in the layer CRS
+        query_params = aoi_query_params (aoi, crs, options)
+        query_params.update(options.geometry_params)
 
-            if raster_bbox (soup, crs, shp_bbox).bool():
-                out_path_shp = 'None'
+        if options.stream:
+            # Stream the features through the clip straight into the layer output
+            stats = new_stats ()
+            try:
+                out_path_shp, content_hash = stream_layer (transport, url, layer_json, query_params, cpu_stage, layer_name,
+                                                           shp_out_path, page_threads, options.max_memory_mb, stats,
+                                                           options.output_format, options.transfer_format)
+            except Exception as e:
+                # Log the error in 'error_log.csv' in the export_path
+                sink.put ('error', [layer_name, url, datetime.date.today()])
+                print(f'{url} An error occurred while streaming the layer: {e}')
+                metrics.add (url, stats)
+                manifest.update (url, 'error')
+                metrics.layer (url, state='error')
+                return
+            metrics.add (url, stats)
+            if out_path_shp is not None:
                 # Export information to sheets
-                info_to_sheets (export_path, soup, layer_name, url, out_path_shp, 'raster')
+                info_to_sheets (sink, layer_json, layer_name, url, out_path_shp, 'vector')
+            manifest.update (url, 'written', content_hash=content_hash, output_paths=[out_path_shp] if out_path_shp else [])
+            metrics.layer (url, state='written')
+            return
+
+        # Query the layer features inside the area of interest and save them to GeoJSON
+        with metrics.stage ('query', url):
+            geojson_out_path, content_hash = export_layer_geojson (transport, url, layer_json, query_params, layer_name, export_path,
+                                                                   page_threads, options.transfer_format)
+        if geojson_out_path is None:
+            # Log the error in 'error_log.csv' in the export_path
+            sink.put ('error', [layer_name, url, datetime.date.today()])
+            manifest.update (url, 'error')
+            metrics.layer (url, state='error')
+            return
+        # The outputs of a previous run are still valid if the content did not change
+        if manifest.is_unchanged (url, content_hash):
+            manifest.update (url, 'written')
+            metrics.layer (url, state='unchanged')
+            return
+        manifest.update (url, 'downloaded', content_hash=content_hash, output_paths=[geojson_out_path])
+
+        # The GeoPackage container is written by the threads of this process only
+        write_in_stage = options.output_format != 'gpkg' or cpu_stage.executor is None
+
+        def written (future):
+            # Runs in the callback thread of the CPU stage
+            try:
+                out_path_shp, stats = future.result()
+                if not write_in_stage and out_path_shp is not None:
+                    with timed (stats, 'write'):
+                        out_path_shp = export_layer (out_path_shp, layer_name, shp_out_path, options.output_format)
+                metrics.add (url, stats)
+                manifest.update (url, 'clipped')
+                if out_path_shp is not None:
+                    # Export information to sheets
+                    info_to_sheets (sink, layer_json, layer_name, url, out_path_shp, 'vector')
+                    manifest.update (url, 'written', output_paths=[geojson_out_path, out_path_shp])
+                else:
+                    manifest.update (url, 'written', output_paths=[])
+                metrics.layer (url, state='written')
+            except Exception as e:
+                # Log the error in 'error_log.csv' in the export_path
+                sink.put ('error', [layer_name, url, datetime.date.today()])
+                print(f'{url} An error occurred while clipping the layer: {e}')
+                manifest.update (url, 'error')
+                metrics.layer (url, state='error')
+
+        # Clip the downloaded GeoJSON with the shapefile and save the clipped result in the CPU stage,
+        # this thread moves on to the next download
+        cpu_stage.submit (clip_export_geojson, geojson_out_path, layer_name, shp_out_path, options.output_format,
+                          write_in_stage, callback=written)
+
+    elif layer_type == 'Raster':
+        # The raster outputs only depend on the layer description and the raster settings
+        raster_settings = [options.raster_resolution, options.raster_tile_size] if options.raster else None
+        content_hash = hashlib.sha256(json.dumps([layer_json, raster_settings], sort_keys=True).encode()).hexdigest()
+        if manifest.is_unchanged (url, content_hash):
+            manifest.update (url, 'written')
+            metrics.layer (url, state='unchanged')
+            return
+        manifest.update (url, 'downloaded', content_hash=content_hash)
+        # Extract and filter the layer name from the layer description
+        layer_name, crs = filter_layer_name_and_crs (layer_json)
+        layer_name = manifest.layer_name (url, layer_name)
+        # Get the envelope of the shapefile in the raster CRS
+        aoi_envelope = aoi.get(crs).envelope
+
+        if raster_bbox (layer_json, crs, aoi_envelope):
+            out_path_shp = 'None'
+            if options.raster:
+                # Extract the pixels over the area of interest into a GeoTIFF
+                try:
+                    with metrics.stage ('raster', url):
+                        out_path_shp = export_raster_tiff (transport, layer, aoi, os.path.join(export_path, 'raster', f'{layer_name}.tif'),
+                                                           options.raster_resolution, options.raster_tile_size, page_threads) or 'None'
+                except Exception as e:
+                    # Log the error in 'error_log.csv' in the export_path
+                    sink.put ('error', [layer_name, url, datetime.date.today()])
+                    print(f'{url} An error occurred while extracting the raster: {e}')
+                    manifest.update (url, 'error')
+                    metrics.layer (url, state='error')
+                    return
+            # Export information to sheets
+            info_to_sheets (sink, layer_json, layer_name, url, out_path_shp, 'raster')
+        manifest.update (url, 'written', output_paths=[out_path_shp] if out_path_shp not in (None, 'None') else None)
+        metrics.layer (url, state='written')
+def read_aois (aois, id_column=None):
+    """
+    Read several areas of interest into one GeoDataFrame.
+
+    Each shapefile is one AOI named after its file, unless `id_column` is given, in which case the
+    features of the file(s) are grouped into one AOI per value of that column. All AOIs are
+    reprojected to the CRS of the first file. The ids are made safe to use as folder names
+    (non-word characters replaced with '_'); distinct ids that become the same name raise a ValueError.
+
+    Args:
+        aois (str or list): The path of a shapefile, or a list of paths.
+        id_column (str): The column holding the AOI identifiers. Defaults to None (one AOI per file).
+
+    Returns:
+        geopandas.GeoDataFrame: One row per AOI, with its 'aoi_id' (safe to use as a folder name) and geometry.
+    """
+    paths = [aois] if isinstance(aois, str) else list(aois)
+    frames = []
+    crs = None
+    for path in paths:
+        gdf, shp_crs = shp_info (path)
+        crs = crs or shp_crs
+        if id_column:
+            ids = gdf[id_column].astype(str).to_numpy()
         else:
-            pass   
-    else:
-        print(url, "\nRequest failed with status code:", response.status_code)
+            ids = [os.path.splitext(os.path.basename(path))[0]] * len(gdf)
+        frames.append(gpd.GeoDataFrame({'raw_id': ids, 'aoi_id': [re.sub(r'\W+', '_', aoi_id) for aoi_id in ids]},
+                                       geometry=gdf.to_crs(crs).geometry.values, crs=crs))
+    aoi_gdf = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=crs)
+    # Distinct ids must not share a folder once cleaned, their outputs would overwrite each other
+    raw_ids = aoi_gdf.groupby('aoi_id')['raw_id'].unique()
+    clashes = {aoi_id: list(ids) for aoi_id, ids in raw_ids.items() if len(ids) > 1}
+    if clashes:
+        raise ValueError(f'Distinct AOI ids map to the same folder name: {clashes}')
+    # One (multi)polygon per AOI
+    return aoi_gdf.dissolve('aoi_id').reset_index()[['aoi_id', 'geometry']]
+def cluster_aois (aoi_gdf, distance=None):
+    """
+    Group the areas of interest whose envelopes are within `distance` of each other.
+
+    Each group is queried once per layer with its own spatial filter, so AOIs far apart do not make
+    the server return everything in between.
+
+    Args:
+        aoi_gdf (geopandas.GeoDataFrame): The AOIs (see `read_aois`).
+        distance (float): The maximum gap between the envelopes of two AOIs of a group, in the units
+            of the AOI CRS. Defaults to None (one group with all AOIs).
+
+    Returns:
+        list: The row positions of the AOIs of each group.
+    """
+    if distance is None:
+        return [np.arange(len(aoi_gdf))]
+    envelopes = shapely.buffer(shapely.envelope(aoi_gdf.geometry.values), distance / 2)
+    left, right = shapely.STRtree(envelopes).query(envelopes, predicate='intersects')
+    # Union-find over the pairs of overlapping envelopes
+    parents = list(range(len(aoi_gdf)))
+    def find (index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+    for first, second in zip(left, right):
+        parents[find (first)] = find (second)
+    groups = collections.defaultdict(list)
+    for index in range(len(aoi_gdf)):
+        groups[find (index)].append(index)
+    return [np.array(group) for group in groups.values()]
+@dataclass
+class AoiBatch:
+    """
+    The areas of interest of a batch run, their spatial index and their outputs.
+
+    Attributes:
+        gdf (geopandas.GeoDataFrame): One row per AOI with its 'aoi_id' and geometry.
+        aoi (AoiCache): The union of all AOIs, used to prune the crawl and check raster extents.
+        clusters (list): An AoiCache per group of nearby AOIs, each queried once per layer.
+        tree (shapely.STRtree): The spatial index of the AOI geometries.
+        shp_paths (dict): The output folder of each AOI id (see `output_folder`).
+        sinks (dict): The ResultSink (summaries) of each AOI id.
+    """
+    gdf: object
+    aoi: object
+    clusters: list
+    tree: object
+    shp_paths: dict
+    sinks: dict
+
+    def close (self):
+        """
+        Write the remaining summary rows of every AOI.
+        """
+        for sink in self.sinks.values():
+            sink.close ()
+def build_aoi_batch (aois, export_path, id_column=None, cluster_distance=None, summary_formats=(), output_format='shp'):
+    """
+    Read the areas of interest of a batch run and create their output folders and summaries.
+
+    Args:
+        aois (str or list): The path of a shapefile, or a list of paths (see `read_aois`).
+        export_path (str): The directory path of the batch outputs. Each AOI gets a sub-folder named after its id.
+        id_column (str): The column holding the AOI identifiers. Defaults to None (one AOI per file).
+        cluster_distance (float): The maximum gap between AOIs queried together (see `cluster_aois`).
+        summary_formats (tuple): Additional summary formats (see `ResultSink`).
+        output_format (str): The format of the vector outputs (see `OUTPUT_FORMATS`).
+
+    Returns:
+        AoiBatch: The AOIs and their outputs.
+    """
+    aoi_gdf = read_aois (aois, id_column)
+    shp_paths, sinks = {}, {}
+    for aoi_id in aoi_gdf['aoi_id']:
+        os.makedirs(os.path.join(export_path, aoi_id), exist_ok=True)
+        shp_paths[aoi_id] = output_folder (os.path.join(export_path, aoi_id), output_format)
+        sinks[aoi_id] = ResultSink (os.path.join(export_path, aoi_id), summary_formats)
+    clusters = [AoiCache (aoi_gdf.iloc[group]) for group in cluster_aois (aoi_gdf, cluster_distance)]
+    return AoiBatch(aoi_gdf, AoiCache (aoi_gdf), clusters, shapely.STRtree(aoi_gdf.geometry.values), shp_paths, sinks)
+def assign_clip_features (features, layer_json, batch):
+    """
+    Decode a chunk of features, assign them to the AOIs they intersect and clip them to each AOI.
+
+    Args:
+        features (FeaturePage): The features in EPSG:4326.
+        layer_json (dict): The JSON description of the layer.
+        batch (AoiBatch): The areas of interest.
+
+    Returns:
+        tuple: A tuple containing two elements:
+            - dict: The clipped features (geopandas.GeoDataFrame) of each AOI id intersecting the chunk.
+            - dict: The decode, reproject, assign and clip times and the feature counts (see `new_stats`).
+    """
+    stats = new_stats ()
+    stats['features_in'] += len(features)
+    with timed (stats, 'decode'):
+        gdf = features_to_gdf (features, layer_json)
+    with timed (stats, 'reproject'):
+        gdf = gdf.to_crs(batch.aoi.crs)
+    # Pairs of (feature, AOI) whose geometries intersect
+    with timed (stats, 'assign'):
+        feature_index, aoi_index = batch.tree.query(gdf.geometry.values, predicate='intersects')
+    clipped = {}
+    with timed (stats, 'clip'):
+        for position in np.unique(aoi_index):
+            subset = gdf.iloc[np.sort(feature_index[aoi_index == position])]
+            clipped_gdf = clip_to_aoi (subset, batch.gdf.geometry.iloc[position])
+            if not clipped_gdf.empty:
+                clipped[batch.gdf['aoi_id'].iloc[position]] = clipped_gdf
+                stats['features_out'] += len(clipped_gdf)
+    return clipped, stats
+def download_data_batch (args):
+    """
+    Download a layer once for all the areas of interest of a batch and write the clipped features of each AOI.
+
+    Vector layers are queried once per group of nearby AOIs (once in total by default) and streamed in
+    chunks bounded by `options.max_memory_mb`. Each chunk is assigned to the AOIs through their spatial index
+    and appended to the output of every AOI it intersects. Features returned for several groups are
+    written once. Raster layers are listed in the summary of every AOI they intersect.
+
+    Args:
+        args (tuple): A tuple containing the following elements:
+            layer (LayerInfo): The layer discovered by the crawler.
+            transport (HttpTransport): The transport used to send requests.
+            batch (AoiBatch): The areas of interest and their outputs.
+            manifest (RunManifest): The run manifest used to skip up-to-date layers and record progress.
+            options (DownloadOptions): The download settings.
+            metrics (RunMetrics): The instrumentation recording the stages, requests and features of each layer.
+
+    Returns:
+        None
+    """
+    layer, transport, batch, manifest, options, metrics = args
+    url, layer_json = layer.url, layer.metadata
+    layer_type = check_layer_type (layer_json)
+    metrics.layer (url, name=layer.name, type=layer_type)
+    # Skip layers written by a previous run that were not edited since
+    if not manifest.discover (layer):
+        metrics.layer (url, state='skipped')
+        return
+    layer_name, crs = filter_layer_name_and_crs (layer_json)
+    layer_name = manifest.layer_name (url, layer_name)
+
+    if layer_type == 'Raster':
+        # The envelope of every AOI in the raster CRS
+        envelopes = shapely.envelope(batch.aoi.get(crs).gdf.geometry.values)
+        raster_box = shapely.box(*(retrieve_raster_coords (layer_json, name) for name in ('xmin', 'ymin', 'xmax', 'ymax')))
+        for aoi_id, intersects in zip(batch.gdf['aoi_id'], shapely.intersects(envelopes, raster_box)):
+            if intersects:
+                info_to_sheets (batch.sinks[aoi_id], layer_json, layer_name, url, 'None', 'raster')
+        manifest.update (url, 'written')
+        metrics.layer (url, state='written')
+        return
+    if layer_type != 'Vector':
+        return
+
+    stats = new_stats ()
+    content_hash = hashlib.sha256()
+    seen = set()
+    writers = {}
+    chunk_features = max(1, int(options.max_memory_mb * 2 ** 20 / 4 // FEATURE_BYTES_ESTIMATE))
+
+    def write (features):
+        clipped, chunk_stats = assign_clip_features (features, layer_json, batch)
+        merge_stats (stats, chunk_stats)
+        with timed (stats, 'write'):
+            for aoi_id, clipped_gdf in clipped.items():
+                if aoi_id not in writers:
+                    writers[aoi_id] = LayerWriter (batch.shp_paths[aoi_id], layer_name, options.output_format)
+                writers[aoi_id].write (clipped_gdf)
+
+    try:
+        for cluster in batch.clusters:
+            # Spatial filter on the bounding box or polygon of the group of AOIs in the layer CRS
+            query_params = aoi_query_params (cluster, crs, options)
+            buffer = []
+            buffered = 0
+            pages = iter_layer_features (transport, url, {**query_params, **options.geometry_params}, layer_json,
+                                         options.layer_page_threads.get(url, options.page_threads),
+                                         transfer_format=options.transfer_format)
+            while True:
+                with timed (stats, 'query'):
+                    page = next(pages, None)
+                if page is None:
+                    break
+                ids = page.ids ()
+                if ids is not None and len(batch.clusters) > 1:
+                    # Features of overlapping groups are returned more than once
+                    new = np.fromiter((oid not in seen for oid in ids.tolist()), dtype=bool, count=len(ids))
+                    seen.update(ids[new].tolist())
+                    page = page.take (new)
+                page.update_hash (content_hash)
+                buffer.append(page)
+                buffered += len(page)
+                if buffered >= chunk_features:
+                    write (FeaturePage.concat (buffer))
+                    buffer, buffered = [], 0
+            if buffered:
+                write (FeaturePage.concat (buffer))
+    except Exception as e:
+        for writer in writers.values():
+            writer.abort ()
+        # Log the error in the error log of every AOI
+        for sink in batch.sinks.values():
+            sink.put ('error', [layer_name, url, datetime.date.today()])
+        print(f'{url} An error occurred while processing the layer: {e}')
+        metrics.add (url, stats)
+        manifest.update (url, 'error')
+        metrics.layer (url, state='error')
+        return
+
+    output_paths = []
+    for aoi_id, writer in writers.items():
+        with timed (stats, 'write'):
+            out_path_shp = writer.close ()
+        info_to_sheets (batch.sinks[aoi_id], layer_json, layer_name, url, out_path_shp, 'vector')
+        output_paths.append(out_path_shp)
+    metrics.add (url, stats)
+    manifest.update (url, 'written', content_hash=content_hash.hexdigest(), output_paths=sorted(output_paths))
+    metrics.layer (url, state='written')
 def check_geojson (geojson_out_path, csv_path):
     """
     Check and update GeoJSON files based on a CSV file containing the list of filenames.
@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+# The extent of the synthetic layers of the mock server
+EXTENT = (115.0, -35.0, 129.0, -14.0)
+
+@pytest.fixture(scope='session')
+def aoi_path (tmp_path_factory):
+    """
+    A shapefile in EPSG:3857 covering the centre of the synthetic extent.
+    """
+    xmin, ymin, xmax, ymax = EXTENT
+    dx, dy = (xmax - xmin) / 4, (ymax - ymin) / 4
+    path = str(tmp_path_factory.mktemp('aoi') / 'aoi.shp')
+    aoi = gpd.GeoDataFrame({'id': [1]}, geometry=[box(xmin + dx, ymin + dy, xmax - dx, ymax - dy)], crs=4326)
+    aoi.to_crs(3857).to_file(path)
+    return path
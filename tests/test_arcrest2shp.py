@@ -0,0 +1,434 @@
+"""
+Offline tests of arcrest2shp against the mock ArcGIS REST server.
+"""
+import concurrent.futures.process
+import contextlib
+import csv
+import io
+import json
+import os
+import shutil
+import sqlite3
+import threading
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import requests
+import shapely
+
+from arcrest2shp import arcrest2shp, arcrest2shp_batch
+from arcrest2shp_cli import main as cli_main
+from arcrest2shp_mock import MockArcGISServer, MockLayer, MockService, synthetic_services
+from arcrest2shp_utils import (SUMMARY_COLUMNS, AoiCache, CpuStage, CrawlFilter, DownloadOptions, FeaturePage, HostLimiter,
+                               HttpTransport, ResultSink, aoi_query_params, clip_to_aoi, crawl_catalog, export_raster_tiff,
+                               iter_layer_features, read_aois)
+
+def quiet_crawl (url, transport, aoi=None, crawl_filter=None):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return crawl_catalog (url, transport, 4, aoi, crawl_filter)
+def record_requests (transport):
+    """
+    Record the method, URL and parameters of every request sent by a transport.
+    """
+    calls = []
+    send = transport.session.request
+
+    def request (method, url, params=None, data=None, **kwargs):
+        calls.append((method, url, params or data or {}))
+        return send(method, url, params=params, data=data, **kwargs)
+
+    transport.session.request = request
+    return calls
+def read_report (out_path):
+    with open(os.path.join(out_path, 'extracted_data', 'run_report.json')) as file:
+        return json.load(file)
+def manifest_states (out_path):
+    with sqlite3.connect(os.path.join(out_path, 'extracted_data', 'manifest.sqlite')) as connection:
+        return dict(connection.execute('SELECT url, state FROM layers').fetchall())
+def fake_responses (transport, outcomes):
+    """
+    Replace the session of a transport with one returning (or raising) the given outcomes in turn.
+    """
+    calls = []
+
+    def request (*args, **kwargs):
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(outcome).encode()
+        return response
+
+    transport.session.request = request
+    return calls
+
+def test_pbf_and_json_pages_match ():
+    services = synthetic_services (1, 1, 3, 700, 250, image_services=0)
+    with MockArcGISServer (services) as server:
+        transport = HttpTransport (4)
+        catalog = quiet_crawl (server.url, transport)
+        assert {layer.geometry_type for layer in catalog.layers} == {'esriGeometryPoint', 'esriGeometryPolyline', 'esriGeometryPolygon'}
+        for layer in catalog.layers:
+            pages = {transfer_format: FeaturePage.concat (list(iter_layer_features (transport, layer.url, {}, layer.metadata,
+                                                                                   transfer_format=transfer_format)))
+                     for transfer_format in ('pbf', 'json')}
+            assert len(pages['pbf']) == len(pages['json']) == 700
+            assert pages['pbf'].columns == pages['json'].columns
+            assert np.all(shapely.equals_exact(pages['pbf'].geometries (), pages['json'].geometries (), 1e-7))
+
+def test_transient_failures_are_retried ():
+    services = synthetic_services (1, 1, 1, 10, 10, image_services=0)
+    with MockArcGISServer (services, error_rate=0.2, throttle_rate=0.2, json_error_rate=0.2, retry_after=0, seed=3) as server:
+        transport = HttpTransport (4, backoff_base=0.001, max_retries=20)
+        assert all(transport.get_json (server.url) is not None for _ in range(20))
+        assert sum(stats['retries'] for stats in transport.retry_stats.values()) > 0
+
+def test_retry_after_is_honoured ():
+    transport = HttpTransport (4, backoff_base=0.001)
+    assert transport.backoff (0, '2') >= 2
+    services = synthetic_services (1, 1, 1, 10, 10, image_services=0)
+    with MockArcGISServer (services, throttle_rate=1.0, retry_after=1) as server:
+        transport = HttpTransport (4, backoff_base=0.001, max_retries=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert transport.get_json (server.url) is None
+        assert transport.retry_stats[server.url]['wait'] >= 1
+
+def test_truncated_bodies_are_retried ():
+    transport = HttpTransport (4, backoff_base=0.001)
+    calls = fake_responses (transport, [requests.exceptions.ChunkedEncodingError('truncated'), {'layers': []}])
+    assert transport.get_json ('http://example.com/arcgis/rest/services') == {'layers': []}
+    assert len(calls) == 2
+
+@pytest.mark.parametrize('code, attempts', [(400, 1), (500, 1), (503, 4)])
+def test_only_transient_json_errors_are_retried (code, attempts):
+    transport = HttpTransport (4, backoff_base=0.001, max_retries=3)
+    limit = transport.limiter.host ('http://example.com').limit
+    calls = fake_responses (transport, [{'error': {'code': code, 'message': 'Error'}}])
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert transport.get_json ('http://example.com/layer/0/query') is None
+    assert len(calls) == attempts
+    # JSON errors are not congestion
+    assert transport.limiter.host ('http://example.com').limit >= limit
+
+def test_resume_skips_unchanged_layers (aoi_path, tmp_path):
+    services = synthetic_services (1, 2, 2, 300, 100, image_services=0)
+    out_path = str(tmp_path / 'out')
+    with MockArcGISServer (services) as server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            arcrest2shp (server.url, aoi_path, out_path, stream=True)
+        assert read_report (out_path)['layers']['states'] == {'written': 4}
+        with contextlib.redirect_stdout(io.StringIO()):
+            arcrest2shp (server.url, aoi_path, out_path, stream=True)
+    report = read_report (out_path)
+    assert report['layers']['states'] == {'skipped': 4}
+    # Neither counted nor queried again
+    assert report['requests']['query']['requests'] == 0
+    assert set(manifest_states (out_path).values()) == {'written'}
+
+def test_resume_rewrites_layers_with_new_settings_or_missing_outputs (aoi_path, tmp_path):
+    services = synthetic_services (1, 1, 2, 300, 100, image_services=0)
+    out_path = str(tmp_path / 'out')
+    with MockArcGISServer (services) as server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            arcrest2shp (server.url, aoi_path, out_path, stream=True)
+            # Another output format
+            arcrest2shp (server.url, aoi_path, out_path, stream=True, output_format='fgb')
+        assert read_report (out_path)['layers']['states'] == {'written': 2}
+        fgb_folder = os.path.join(out_path, 'extracted_data', 'fgb')
+        os.remove(os.path.join(fgb_folder, 'SYN_000_Layer_0.fgb'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            # One output deleted
+            arcrest2shp (server.url, aoi_path, out_path, stream=True, output_format='fgb')
+    assert read_report (out_path)['layers']['states'] == {'written': 1, 'skipped': 1}
+    assert sorted(os.listdir(fgb_folder)) == ['SYN_000_Layer_0.fgb', 'SYN_001_Layer_1.fgb']
+
+@pytest.mark.parametrize('pixel_type, dtype', [('U8', 'uint8'), ('U16', 'uint16'), ('S8', None)])
+def test_raster_pixels_follow_the_service_pixel_type (tmp_path, pixel_type, dtype):
+    rasterio = pytest.importorskip('rasterio')
+    aoi_path = str(tmp_path / 'aoi.shp')
+    gpd.GeoDataFrame({'id': [1]}, geometry=[shapely.box(120, -30, 122, -28)], crs=4326).to_file(aoi_path)
+    out_path = str(tmp_path / 'out')
+    # The mock always returns 8-bit tiles, whatever the pixel type of the service
+    services = [MockService('Folder0/Image0', 'ImageServer', pixel_type=pixel_type, no_data_value=255 if dtype else None)]
+    with MockArcGISServer (services) as server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            arcrest2shp (server.url, aoi_path, out_path, raster=True, raster_resolution=0.005, raster_tile_size=128)
+    states = read_report (out_path)['layers']['states']
+    if dtype is None:
+        # 8-bit unsigned tiles cannot be stored as signed bytes without loss
+        assert states == {'error': 1}
+        return
+    assert states == {'written': 1}
+    with rasterio.open(os.path.join(out_path, 'extracted_data', 'raster', '_Image0.tif')) as dataset:
+        assert dataset.dtypes == (dtype,) * 3 and dataset.nodata == 255
+        assert dataset.shape == (400, 400)
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_layer_errors_are_logged (aoi_path, tmp_path, batch):
+    services = synthetic_services (1, 1, 2, 300, 100, image_services=0)
+    # An Esri-only CRS unknown to pyproj
+    services[0].layers.append(MockLayer('Esri (ESR01)', wkid=102003))
+    out_path = str(tmp_path / 'out')
+    with MockArcGISServer (services) as server:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if batch:
+                arcrest2shp_batch (server.url, [aoi_path], out_path)
+            else:
+                arcrest2shp (server.url, aoi_path, out_path)
+    error_folder = os.path.join(out_path, 'extracted_data', 'aoi' if batch else '')
+    with open(os.path.join(error_folder, 'error_log.csv'), newline='') as file:
+        rows = list(csv.reader(file))[1:]
+    assert [row[0] for row in rows] == ['ESR01_Esri']
+    states = manifest_states (out_path)
+    assert states[rows[0][1]] == 'error'
+    assert read_report (out_path)['layers']['states'] == {'written': 2, 'error': 1}
+
+def test_aoi_ids_sharing_a_folder_name_are_rejected (tmp_path):
+    def projects (ids):
+        path = str(tmp_path / f'projects_{len(ids)}.shp')
+        gpd.GeoDataFrame({'PROJECT': ids}, geometry=[shapely.box(i, 0, i + 1, 1) for i in range(len(ids))],
+                         crs=4326).to_file(path)
+        return path
+
+    with pytest.raises(ValueError, match='North_1'):
+        read_aois (projects (['North-1', 'North 1', 'South', 'South']), 'PROJECT')
+    # Features sharing an id are still one AOI
+    assert list(read_aois (projects (['North-1', 'South', 'South']), 'PROJECT')['aoi_id']) == ['North_1', 'South']
+
+def test_spatial_filters_need_a_crs (aoi_path):
+    with pytest.raises(ValueError, match='no CRS'):
+        AoiCache (gpd.GeoDataFrame(geometry=[shapely.box(0, 0, 1, 1)]))
+    options = DownloadOptions ('', '')
+    with pytest.raises(ValueError, match='no spatial reference'):
+        aoi_query_params (AoiCache (aoi_path), None, options)
+    assert aoi_query_params (AoiCache (aoi_path), 4326, options)['inSR'] == 4326
+
+def test_cli_resumes_multiple_aois (aoi_path, tmp_path, monkeypatch):
+    folder = tmp_path / 'aois'
+    folder.mkdir()
+    for name in ('north', 'south'):
+        for extension in ('shp', 'shx', 'dbf', 'prj', 'cpg'):
+            source = aoi_path[:-3] + extension
+            if os.path.exists(source):
+                shutil.copy(source, folder / f'{name}.{extension}')
+    out_path = str(tmp_path / 'out')
+    services = synthetic_services (1, 1, 2, 200, 100, image_services=0)
+    with MockArcGISServer (services) as server:
+        monkeypatch.chdir(folder)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cli_main (['extract', server.url, out_path, '--aoi', 'north.shp', '--aoi', 'south.shp'])
+        # Resume from another working directory with the relative AOI paths saved as absolute
+        monkeypatch.chdir(tmp_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cli_main (['resume', out_path])
+    assert read_report (out_path)['layers']['states'] == {'skipped': 2}
+    assert {'north', 'south'} <= set(os.listdir(os.path.join(out_path, 'extracted_data')))
+
+def read_outputs (out_path):
+    """
+    Read the vector outputs of a run listed in its summary, by layer name.
+    """
+    with open(os.path.join(out_path, 'extracted_data', 'extracted_data_vector.csv'), newline='') as file:
+        rows = list(csv.DictReader(file))
+    outputs = {}
+    for row in rows:
+        path, _, layer = row['Out Path'].partition('|layername=')
+        outputs[row['Name']] = gpd.read_parquet(path) if path.endswith('.parquet') else gpd.read_file(path, layer=layer or None)
+    return outputs
+
+@pytest.mark.parametrize('output_format', ['gpkg', 'fgb', 'parquet'])
+def test_output_formats_match_shapefiles (aoi_path, tmp_path, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    # Clipped lines and polygons mix single and multi part geometries across the chunks of a layer
+    services = synthetic_services (1, 1, 3, 3000, 500, image_services=0)
+    runs = {'shp': {}, 'single': {'output_format': output_format},
+            'streamed': {'output_format': output_format, 'stream': True, 'max_memory_mb': 1}}
+    outputs = {}
+    with MockArcGISServer (services) as server:
+        for run, kwargs in runs.items():
+            out_path = str(tmp_path / run)
+            with contextlib.redirect_stdout(io.StringIO()):
+                arcrest2shp (server.url, aoi_path, out_path, **kwargs)
+            assert read_report (out_path)['layers']['states'] == {'written': 3}
+            outputs[run] = read_outputs (out_path)
+    assert len(outputs['shp']) == 3
+    for name, expected in outputs['shp'].items():
+        for run in ('single', 'streamed'):
+            gdf = outputs[run][name]
+            assert len(gdf) == len(expected) and gdf.crs == expected.crs
+            assert np.isclose(gdf.geometry.length.sum(), expected.geometry.length.sum())
+            assert np.isclose(gdf.geometry.area.sum(), expected.geometry.area.sum())
+    if output_format != 'parquet':
+        # Layers written in several chunks are promoted to one multi part type
+        assert {frozenset(gdf.geom_type) for gdf in outputs['streamed'].values()} == {
+            frozenset({'MultiPoint'}), frozenset({'MultiLineString'}), frozenset({'MultiPolygon'})}
+
+def test_clip_keeps_features_inside_the_aoi_unchanged ():
+    aoi = shapely.box(0, 0, 10, 10)
+    geometries = [
+        shapely.box(2, 2, 3, 3),                          # inside
+        shapely.LineString([(5, 5), (15, 5)]),            # crossing the boundary
+        shapely.box(20, 20, 21, 21),                      # disjoint
+        shapely.box(10, 2, 12, 3),                        # touching the boundary from outside
+        shapely.box(0, 2, 1, 3),                          # touching the boundary from inside
+    ]
+    gdf = gpd.GeoDataFrame({'id': range(len(geometries))}, geometry=geometries, crs=3857)
+    clipped = clip_to_aoi (gdf, aoi)
+    assert list(clipped['id']) == [0, 1, 4]
+    # Features strictly inside are the input geometries, the others are intersected
+    assert clipped.geometry.iloc[0] is gdf.geometry.iloc[0]
+    assert clipped.geometry.iloc[1].equals(shapely.LineString([(5, 5), (10, 5)]))
+    assert clipped.geometry.iloc[2].equals(geometries[4])
+
+def test_long_polygon_filters_are_posted ():
+    services = synthetic_services (1, 1, 1, 2000, 500, image_services=0)
+    # A polygon with too many vertices to fit in a URL
+    aoi = AoiCache (gpd.GeoDataFrame(geometry=[shapely.Point(122, -25).buffer(4, quad_segs=32)], crs=4326))
+    polygon_options = DownloadOptions ('', '', spatial_filter='polygon')
+    with MockArcGISServer (services) as server:
+        transport = HttpTransport (4)
+        layer = quiet_crawl (server.url, transport).layers[0]
+        calls = record_requests (transport)
+        pages = {spatial_filter: FeaturePage.concat (list(iter_layer_features (
+                     transport, layer.url, aoi_query_params (aoi, 4326, DownloadOptions ('', '', spatial_filter=spatial_filter)),
+                     layer.metadata)))
+                 for spatial_filter in ('bbox', 'polygon')}
+    polygon_json = json.loads(aoi_query_params (aoi, 4326, polygon_options)['geometry'])
+    assert 'rings' in polygon_json
+    # The bounding box filter fits in the URL, the polygon one is sent as form data
+    methods = {(method, 'rings' in params.get('geometry', '')) for method, url, params in calls if url.endswith('/query')}
+    assert methods == {('GET', False), ('POST', True)}
+    # The mock server reads polygons as their bounding box
+    assert 0 < len(pages['polygon']) == len(pages['bbox']) < 2000
+
+def test_result_sink_records_each_layer_once (tmp_path):
+    export_path = str(tmp_path)
+    sink = ResultSink (export_path, batch_size=3, flush_interval=0.01)
+    rows = {f'http://example.com/{number}': ['Source', f'Layer {number}', 'Point', '', f'http://example.com/{number}',
+                                             '2024-01-01', f'/out/{number}.shp'] for number in range(20)}
+
+    def put_all ():
+        for row in rows.values():
+            sink.put ('vector', row)
+
+    threads = [threading.Thread(target=put_all) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sink.close ()
+    # A later run replaces the row of a layer it writes again
+    sink = ResultSink (export_path)
+    sink.put ('vector', rows['http://example.com/0'][:-1] + ['/out/0.gpkg'])
+    sink.close ()
+    with open(sink.paths['vector'], newline='') as file:
+        written = list(csv.reader(file))
+    assert written[0] == SUMMARY_COLUMNS['vector']
+    assert sorted(row[4] for row in written[1:]) == sorted(rows)
+    assert [row[-1] for row in written[1:] if row[4] == 'http://example.com/0'] == ['/out/0.gpkg']
+
+def test_cpu_stage_runs_tasks_in_worker_processes (aoi_path):
+    aoi = AoiCache (aoi_path)
+    # In the calling thread, the tasks receive the area of interest
+    stage = CpuStage (aoi)
+    assert stage.submit (dict).result() == {'aoi': aoi}
+    stage.close ()
+    stage = CpuStage (aoi, workers=2, max_pending=2)
+    done = []
+    futures = [stage.submit (os.getpid, callback=lambda future: done.append(threading.current_thread().name))
+               for _ in range(6)]
+    stage.close ()
+    assert os.getpid() not in {future.result() for future in futures}
+    assert done == ['cpu-stage-callbacks'] * 6
+
+def test_cpu_stage_stops_when_a_worker_dies (aoi_path):
+    stage = CpuStage (AoiCache (aoi_path), workers=1, max_pending=1)
+    errors = []
+    stage.submit (os._exit, 1, callback=lambda future: errors.append(future.exception()))
+    # Later tasks fail instead of waiting for a slot forever
+    with pytest.raises(concurrent.futures.process.BrokenProcessPool):
+        for _ in range(5):
+            stage.submit (os.getpid)
+    stage.close ()
+    assert isinstance(errors[0], concurrent.futures.process.BrokenProcessPool)
+
+def test_limiter_increases_additively_and_decreases_multiplicatively ():
+    limiter = HostLimiter (16, initial_concurrency=4, cooldown=0)
+
+    def request (status, latency=0.01, kind='metadata'):
+        limiter.acquire ()
+        limiter.release (latency, status, kind)
+
+    for _ in range(4):
+        request (200)
+    # About one more request in flight once `limit` requests succeeded
+    assert 4.9 < limiter.limit < 5.1
+    request (429)
+    assert 2.4 < limiter.limit < 2.6
+    request (None)
+    assert limiter.limit < 1.3
+    for _ in range(500):
+        request (200)
+    assert limiter.limit == 16
+    # A feature page slower than the metadata requests is not congestion, a slow down of pages is
+    request (200, 1.0, 'features')
+    assert limiter.limit == 16
+    for _ in range(20):
+        request (200, 1.0, 'features')
+    request (200, 10.0, 'features')
+    assert limiter.limit == 8
+
+def test_crawl_prunes_by_name_and_extent (aoi_path):
+    far = (140.0, -45.0, 150.0, -40.0)
+    services = synthetic_services (1, 1, 3, 10, 10, image_services=0)
+    # A service outside the AOI, and a layer outside the AOI in a service overlapping it
+    services.append(MockService('Far/Service', 'MapServer', [MockLayer('Far (FAR-001)', extent=far)], far))
+    services[0].layers.append(MockLayer('Outside (OUT-001)', extent=far))
+    with MockArcGISServer (services) as server:
+        transport = HttpTransport (4)
+        calls = record_requests (transport)
+        catalog = quiet_crawl (server.url, transport, AoiCache (aoi_path), CrawlFilter(exclude_layers=('Layer 1 *',)))
+    assert sorted(layer.name for layer in catalog.layers) == ['Layer 0 (SYN-000)', 'Layer 2 (SYN-002)']
+    assert catalog.skipped == {'name': 1, 'extent': 2}
+    # The layers of the pruned service are never requested
+    assert [url for _, url, _ in calls if '/Far/Service/' in url] == [f'{server.url}/Far/Service/MapServer']
+
+def test_raster_tiles_mosaic_into_one_geotiff (tmp_path):
+    rasterio = pytest.importorskip('rasterio')
+    # A triangle, the tiles of the grid outside it are not requested
+    aoi = AoiCache (gpd.GeoDataFrame(geometry=[shapely.Polygon([(120, -30), (122, -30), (120, -28)])], crs=4326))
+    with MockArcGISServer ([MockService('Folder0/Image0', 'ImageServer')]) as server:
+        transport = HttpTransport (4)
+        layer = quiet_crawl (server.url, transport).layers[0]
+        calls = record_requests (transport)
+        tiled = export_raster_tiff (transport, layer, aoi, str(tmp_path / 'tiled.tif'), 0.005, tile_size=50)
+        tile_requests = len(calls)
+        single = export_raster_tiff (transport, layer, aoi, str(tmp_path / 'single.tif'), 0.005, tile_size=400)
+    # 8 x 8 tiles of 0.25 degrees (rows from the top), only those intersecting or touching the triangle are requested
+    assert tile_requests == sum(column - row <= 1 for row in range(8) for column in range(8)) == 43
+    with rasterio.open(tiled) as tiled_dataset, rasterio.open(single) as single_dataset:
+        assert tiled_dataset.shape == single_dataset.shape == (400, 400)
+        assert tiled_dataset.transform == single_dataset.transform
+        tiled_pixels = tiled_dataset.read()
+        assert np.array_equal(tiled_pixels, single_dataset.read())
+        # The pixels outside the triangle are nodata
+        assert (tiled_pixels[:, 0, -1] == tiled_dataset.nodata).all()
+        assert not (tiled_pixels[:, -1, 0] == tiled_dataset.nodata).all()
+
+def test_crawl_revalidates_cached_responses (tmp_path):
+    services = synthetic_services (1, 2, 2, 10, 10, image_services=0)
+    cache_dir = str(tmp_path / 'cache')
+    with MockArcGISServer (services) as server:
+        first = quiet_crawl (server.url, HttpTransport (4, cache_dir=cache_dir))
+        assert 304 not in server.stats['status']
+        transport = HttpTransport (4, cache_dir=cache_dir)
+        second = quiet_crawl (server.url, transport)
+        revalidated = server.stats['status'].get(304, 0)
+    assert {layer.url: layer.metadata for layer in second.layers} == {layer.url: layer.metadata for layer in first.layers}
+    # Every cached response was revalidated without a body
+    assert revalidated == transport.cache_stats['revalidated'] > 0
+    assert transport.cache_stats['fetched'] == 0